@@ -0,0 +1,39 @@
+"""
+Decoding of the flow records that OFX datapath components send up,
+as numpy structured arrays.
+struct FlowKey{
+    struct  in_addr ip_src,ip_dst;
+    u_short uh_sport;
+    u_short uh_dport;
+};
+struct FlowEntryNoHash{
+    struct FlowKey key;
+    uint32_t permission;
+    uint32_t added; // Has the rule been added?
+    uint32_t byteCt; // how many bytes have we seen?
+};
+All fields are in network byte order.
+Modules that use it list it as a dependency. (apps copy it into 
+their directory, with the rest of controllerLib.)
+"""
+import numpy as np
+
+flowEntryDtype = np.dtype([('ipSrc', '>u4'), ('ipDst', '>u4'), \
+    ('sport', '>u2'), ('dport', '>u2'), ('permission', '>u4'), \
+    ('added', '>u4'), ('byteCt', '>u4')])
+
+def decodeFlowEntries(data):
+    """
+    the FlowEntryNoHash records in data, as a structured array
+    that points into data (no copy).
+    """
+    count = len(data) // flowEntryDtype.itemsize
+    return np.frombuffer(data, dtype=flowEntryDtype, count=count)
+
+def flowKeys(entries):
+    """
+    (ipSrc, ipDst, sport, dport) of each entry, with the
+    addresses as integers.
+    """
+    return list(zip(entries['ipSrc'].tolist(), entries['ipDst'].tolist(), \
+        entries['sport'].tolist(), entries['dport'].tolist()))
@@ -0,0 +1,204 @@
+"""
+Delta encoded reports of flow counters.
+A sender reports the counters of a set of flows every interval (an
+epoch). Once the receiver acks an epoch, later reports only have the
+flows that are new, changed or gone since that epoch, with each
+counter as a varint of its change. Every snapshotEvery epochs, and
+until the receiver acks anything, a report has every flow (a full
+snapshot), so a receiver that lost its state resyncs.
+Report format:
+| version (1) | kind (1) | epoch (4) | base epoch (4) |
+| changed flow count (4) | gone flow count (4) |
+| changed flows: key, one varint per counter |
+| gone flows: key |
+Keys are packed with the key format (a struct format, without the
+byte order). Counter changes are zigzag varints, so counters that
+go down (a re-added flow, a 32 bit wrap) still decode exactly.
+The same file is used by the controller library and the switch agent.
+"""
+import struct, threading
+
+REPORT_VERSION = 1
+FULL_REPORT = 0x1
+DELTA_REPORT = 0x2
+
+reportHeader = struct.Struct("!BBIIII")
+
+
+def writeVarint(out, value):
+    """
+    append value (any int) to the bytearray out, zigzag encoded.
+    """
+    value = ~(value << 1) if value < 0 else value << 1
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def readVarint(data, ptr):
+    """
+    returns the varint at data[ptr] and the position after it.
+    data is a bytearray.
+    """
+    value = 0
+    shift = 0
+    while True:
+        b = data[ptr]
+        ptr += 1
+        value |= (b & 0x7f) << shift
+        if b < 0x80:
+            break
+        shift += 7
+    if value & 1:
+        return -((value + 1) >> 1), ptr
+    return value >> 1, ptr
+
+
+class FlowDeltaEncoder(object):
+    """
+    Builds the reports of one sender. Flow keys are tuples that pack
+    with keyFormat. Each flow has counterCt counters.
+    (acks can come from another thread than the reports.)
+    """
+    def __init__(self, keyFormat, counterCt=1, snapshotEvery=30, \
+        maxUnacked=16):
+        self.keyStruct = struct.Struct("!" + keyFormat)
+        self.counterCt = counterCt
+        self.snapshotEvery = snapshotEvery
+        self.maxUnacked = maxUnacked
+        self.epoch = 0
+        self.lastSnapshot = 0
+        # the flows at the last acked epoch, and at each epoch sent
+        # since.
+        self.ackedEpoch = None
+        self.acked = {}
+        self.unacked = {}
+        self.lock = threading.Lock()
+
+    def encode(self, keys, *columns):
+        """
+        the report of the next epoch. keys[i] is a flow's key, and
+        columns[c][i] is its counter c.
+        """
+        state = dict(zip(keys, zip(*columns)))
+        with self.lock:
+            return self.encodeState(state)
+
+    def encodeState(self, state):
+        self.epoch = (self.epoch + 1) & 0xffffffff
+        full = self.ackedEpoch is None or \
+            self.epoch - self.lastSnapshot >= self.snapshotEvery
+        zeros = (0,) * self.counterCt
+        if full:
+            self.lastSnapshot = self.epoch
+            base = 0
+            baseState = {}
+            changed = state.items()
+            gone = []
+        else:
+            base = self.ackedEpoch
+            baseState = self.acked
+            changed = [(key, counters) for key, counters in state.items() \
+                if baseState.get(key) != counters]
+            gone = [key for key in baseState if key not in state]
+        out = bytearray(reportHeader.pack(REPORT_VERSION, \
+            FULL_REPORT if full else DELTA_REPORT, self.epoch, base, \
+            len(changed), len(gone)))
+        pack = self.keyStruct.pack
+        for key, counters in changed:
+            out += pack(*key)
+            old = baseState.get(key, zeros)
+            for c in range(self.counterCt):
+                writeVarint(out, counters[c] - old[c])
+        for key in gone:
+            out += pack(*key)
+        self.unacked[self.epoch] = state
+        if len(self.unacked) > self.maxUnacked:
+            del self.unacked[min(self.unacked)]
+        return bytes(out)
+
+    def ack(self, epoch):
+        """
+        the receiver has the flows of epoch. Later reports are
+        relative to it.
+        """
+        with self.lock:
+            state = self.unacked.get(epoch)
+            if state is None:
+                return
+            self.ackedEpoch = epoch
+            self.acked = state
+            for e in list(self.unacked):
+                if e <= epoch:
+                    del self.unacked[e]
+
+
+class FlowDeltaDecoder(object):
+    """
+    Rebuilds the flows of one sender from its reports. flows is
+    the latest state: key -> tuple of counters.
+    """
+    def __init__(self, keyFormat, counterCt=1, maxStates=16):
+        self.keyStruct = struct.Struct("!" + keyFormat)
+        self.counterCt = counterCt
+        self.maxStates = maxStates
+        self.epoch = None
+        self.flows = {}
+        # the flows of the epochs later reports can be relative to.
+        self.states = {}
+
+    def apply(self, data):
+        """
+        apply a report. Returns its epoch, to ack, or None if the
+        report is relative to an epoch this decoder doesn't have.
+        """
+        data = bytearray(data)
+        version, kind, epoch, base, changedCt, goneCt = \
+            reportHeader.unpack_from(data)
+        if version != REPORT_VERSION:
+            return None
+        zeros = (0,) * self.counterCt
+        if kind == FULL_REPORT:
+            state = {}
+        else:
+            baseState = self.states.get(base)
+            if baseState is None:
+                return None
+            state = dict(baseState)
+        unpack = self.keyStruct.unpack_from
+        keySize = self.keyStruct.size
+        ptr = reportHeader.size
+        for i in range(changedCt):
+            key = unpack(data, ptr)
+            ptr += keySize
+            old = state.get(key, zeros)
+            counters = []
+            for c in range(self.counterCt):
+                change, ptr = readVarint(data, ptr)
+                counters.append(old[c] + change)
+            state[key] = tuple(counters)
+        for i in range(goneCt):
+            state.pop(unpack(data, ptr), None)
+            ptr += keySize
+        # the sender's later reports are relative to base or a 
+        # later epoch.
+        if kind == DELTA_REPORT:
+            for e in list(self.states):
+                if e < base:
+                    del self.states[e]
+        self.states[epoch] = state
+        if len(self.states) > self.maxStates:
+            del self.states[min(self.states)]
+        self.flows = state
+        self.epoch = epoch
+        return epoch
+
+    def totals(self):
+        """
+        each counter, summed over the flows.
+        """
+        sums = [0] * self.counterCt
+        for counters in self.flows.values():
+            for c in range(self.counterCt):
+                sums[c] += counters[c]
+        return sums
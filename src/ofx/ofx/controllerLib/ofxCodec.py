@@ -0,0 +1,164 @@
+"""
+Binary encoding of OFX message bodies.
+A Schema declares the fields of a message body, in order. Fields
+are struct format codes ('B', 'H', 'I', 'Q', 'i', 'd', '4s', ...),
+or one of:
+IPV4:   a dotted quad address string, sent as 4 bytes.
+BYTES:  a byte string of any length.
+STRING: a text string of any length.
+An encoded body is:
+| version (1) | fixed size fields | variable size fields |
+All the fixed size fields are packed with one precompiled struct, in
+network byte order. Each variable size field is a 32 bit length
+followed by its bytes.
+Schemas with only fixed size fields can also encode sequences of
+records: | version (1) | record count (4) | record | record | ...
+The same file is used by the controller library and the switch agent.
+"""
+import socket, struct
+
+IPV4 = 'ip'
+BYTES = 'bytes'
+STRING = 'str'
+
+variableTypes = (BYTES, STRING)
+lengthStruct = struct.Struct("!I")
+
+
+class OfxCodecError(Exception):
+    """
+    A message body that doesn't match its schema.
+    """
+    pass
+
+
+class Schema(object):
+    def __init__(self, version, fields):
+        """
+        version is a tag (0 - 255) sent with every body. Decoding
+        a body with a different tag fails. fields is a list of
+        (name, type) tuples.
+        """
+        self.version = version
+        self.names = [name for name, fieldType in fields]
+        self.types = [fieldType for name, fieldType in fields]
+        self.fixedIdx = [i for i, t in enumerate(self.types) \
+            if t not in variableTypes]
+        self.variableIdx = [i for i, t in enumerate(self.types) \
+            if t in variableTypes]
+        self.ipIdx = [i for i, t in enumerate(self.types) if t == IPV4]
+        codes = ''.join('4s' if self.types[i] == IPV4 else self.types[i] \
+            for i in self.fixedIdx)
+        self.header = struct.Struct("!B" + codes)
+        self.record = struct.Struct("!" + codes)
+        self.seqHeader = struct.Struct("!BI")
+
+    def encode(self, *values):
+        """
+        encode one message body.
+        """
+        if len(values) != len(self.types):
+            raise OfxCodecError("expected %s fields, got %s"\
+                %(len(self.types), len(values)))
+        try:
+            fixed = self.header.pack(self.version, *self.fixedValues(values))
+        except (struct.error, socket.error) as e:
+            raise OfxCodecError(str(e))
+        parts = [fixed]
+        for i in self.variableIdx:
+            value = values[i]
+            if self.types[i] == STRING and not isinstance(value, bytes):
+                value = value.encode('utf-8')
+            parts.append(lengthStruct.pack(len(value)))
+            parts.append(value)
+        return b''.join(parts)
+
+    def decode(self, data):
+        """
+        decode one message body. Returns a tuple of the field values.
+        """
+        try:
+            fixed = self.header.unpack_from(data)
+        except struct.error as e:
+            raise OfxCodecError(str(e))
+        self.checkVersion(fixed[0])
+        values = [None] * len(self.types)
+        for i, value in zip(self.fixedIdx, fixed[1:]):
+            values[i] = value
+        for i in self.ipIdx:
+            values[i] = socket.inet_ntoa(values[i])
+        ptr = self.header.size
+        for i in self.variableIdx:
+            if ptr + lengthStruct.size > len(data):
+                raise OfxCodecError("body ends in field %s"%self.names[i])
+            length = lengthStruct.unpack_from(data, ptr)[0]
+            ptr += lengthStruct.size
+            if ptr + length > len(data):
+                raise OfxCodecError("body ends in field %s"%self.names[i])
+            value = bytes(data[ptr:ptr+length])
+            if self.types[i] == STRING and str is not bytes:
+                value = value.decode('utf-8')
+            values[i] = value
+            ptr += length
+        return tuple(values)
+
+    def encodeSeq(self, rows):
+        """
+        encode a sequence of records (tuples of field values).
+        """
+        if self.variableIdx:
+            raise OfxCodecError("sequences need fixed size records")
+        pack = self.record.pack
+        parts = [self.seqHeader.pack(self.version, len(rows))]
+        try:
+            if self.ipIdx:
+                for row in rows:
+                    parts.append(pack(*self.fixedValues(row)))
+            else:
+                for row in rows:
+                    parts.append(pack(*row))
+        except (struct.error, socket.error, TypeError) as e:
+            raise OfxCodecError(str(e))
+        return b''.join(parts)
+
+    def decodeSeq(self, data):
+        """
+        decode a sequence of records. Returns a list of tuples.
+        """
+        try:
+            version, count = self.seqHeader.unpack_from(data)
+        except struct.error as e:
+            raise OfxCodecError(str(e))
+        self.checkVersion(version)
+        size = self.record.size
+        if self.seqHeader.size + count * size > len(data):
+            raise OfxCodecError("body too short for %s records"%count)
+        unpack = self.record.unpack_from
+        ptr = self.seqHeader.size
+        rows = []
+        if self.ipIdx:
+            ntoa = socket.inet_ntoa
+            ipIdx = self.ipIdx
+            for n in range(count):
+                row = list(unpack(data, ptr))
+                for i in ipIdx:
+                    row[i] = ntoa(row[i])
+                rows.append(tuple(row))
+                ptr += size
+        else:
+            for n in range(count):
+                rows.append(unpack(data, ptr))
+                ptr += size
+        return rows
+
+    def fixedValues(self, values):
+        if self.ipIdx:
+            values = list(values)
+            for i in self.ipIdx:
+                values[i] = socket.inet_aton(values[i])
+        return [values[i] for i in self.fixedIdx]
+
+    def checkVersion(self, version):
+        if version != self.version:
+            raise OfxCodecError("version %s body, expected version %s"\
+                %(version, self.version))
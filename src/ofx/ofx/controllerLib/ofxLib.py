@@ -6,10 +6,14 @@ import sys
 import shutil
 import glob
 import struct
-import cPickle as pickle
 import twink.ofp4.build as ofbuild
 import twink.ofp4.parse as ofparse
 import twink.ofp4.oxm as oxm
+from ofxCodec import Schema, BYTES, STRING
+from ofxStream import StreamSender, StreamReceiver, streamMessageKind
+from ofxStream import OFX_STREAM_MODULE, STREAM_FRAGMENT, STREAM_ACK
+from ofxStream import STREAM_HELLO
+from ofxStream import compressThreshold
 
 
 # The OFX protocol:
@@ -19,11 +23,13 @@ import twink.ofp4.oxm as oxm
 #     always 0x1 to represent an OFX message
 # Experimenter type: 
 #     0xffffffff:     OFX control message
+#     0xfffffffe:     OFX stream fragment or ack (see ofxStream)
+#     0xfffffffd:     OFX envelope of several module messages
 #     0x0:0xffff:     OFX module ID.
 # Data:
 #     First 32 bits:  Message Type code (module dependent)
 #     2nd 32 bits:    length of remainder of message.
-#     Remainder:      Message (python pickleObject)
+#     Remainder:      Message (encoded with an ofxCodec Schema)
 
 
 # OFX management message types:
@@ -37,9 +43,21 @@ OFX_MANAGEMENT_MODULE=0xffffffff
 # OFX management message types.
 # start message, send files, end message.
 OFX_LOAD_MODULE_START=0x1 # payload: string containing module name.
-OFX_LOAD_MODULE_FILE=0x2 # payload: pickled tuple: (filename, contents)
+OFX_LOAD_MODULE_FILE=0x2 # payload: moduleFileSchema: (filename, contents)
 OFX_LOAD_MODULE_END=0x3 # payload: import and compilation instructions.
-OFX_LOAD_MODULE_FILE_PIECE=0x4 # payload: pickled tuple: (filename, total len, contents)
+OFX_LOAD_MODULE_FILE_PIECE=0x4 # payload: moduleFilePieceSchema: (filename, total len, contents)
+
+moduleFileSchema = Schema(1, [('fileName', STRING), ('contents', BYTES)])
+moduleFilePieceSchema = Schema(1, [('fileName', STRING), ('totalLen', 'I'), \
+    ('contents', BYTES)])
+
+# Envelopes: many module messages in one OFX message (experimenter 
+# type OFX_ENVELOPE_MODULE). Each one is:
+# | module id (4) | message type (4) | content length (4) | content |
+OFX_ENVELOPE_MODULE=0xfffffffd
+envelopeHeader = struct.Struct("!Iii")
+# content bytes per envelope. (an OpenFlow message is at most 64kB.)
+envelopeMaxLen = 60000
 
 
 class OfxInterface(object):
@@ -49,6 +67,16 @@ class OfxInterface(object):
         self.loadedDatapathBins = {}
         self.loadedDependencyBins = {}
         self.moduleHandlers = {}
+        # streams to each switch, by send function, and from each 
+        # switch, by datapath id.
+        self.streamSenders = {}
+        self.streamReceivers = {}
+        # send function of each switch's current connection, by 
+        # datapath id.
+        self.datapathSendFcns = {}
+        # compression threshold of the modules whose streams to the 
+        # switches are compressed. (module files are.)
+        self.streamCompression = {OFX_MANAGEMENT_MODULE:compressThreshold}
 
     ##### functions the control application calls. ####
     def loadModule(self, moduleFile):
@@ -99,6 +127,63 @@ class OfxInterface(object):
         data = self.buildOFXMessage(moduleId, msg)
         return data        
 
+    def streamToSwitch(self, sendToSwitchFcn, moduleId, messageType, content):
+        """
+        send a module message of any size to a switch. It is split 
+        into fragments, and the switch's module handler gets it 
+        whole. Messages streamed to a switch arrive in the order 
+        they were sent. Returns right away: the fragments go out as 
+        the switch acks the earlier ones.
+        """
+        sender = self.streamSenders.get(sendToSwitchFcn)
+        if sender is None:
+            sendFcn = lambda moduleId, content: \
+                sendToSwitchFcn(self.buildOFXMessage(moduleId, content))
+            sender = StreamSender(sendFcn)
+            for compressedId, threshold in self.streamCompression.items():
+                sender.setCompression(compressedId, threshold)
+            self.streamSenders[sendToSwitchFcn] = sender
+        return sender.send(moduleId, messageType, content)
+
+    def enableStreamCompression(self, moduleId, threshold=compressThreshold):
+        """
+        zlib compress the module's messages streamed to switches, 
+        if they are at least threshold bytes and the switch can 
+        decompress them. (threshold None turns it off.)
+        """
+        if threshold is None:
+            self.streamCompression.pop(moduleId, None)
+        else:
+            self.streamCompression[moduleId] = threshold
+        for sender in self.streamSenders.values():
+            sender.setCompression(moduleId, threshold)
+
+    def buildEnvelopeMessages(self, messages):
+        """
+        Packs module messages, (moduleId, messageType, content) tuples, 
+        into as few OFX messages as they fit in. The receiver hands 
+        each one to its module, in order, like a message of its own. 
+        (Each message must fit in an OpenFlow message: stream bigger 
+        ones.)
+        """
+        envelopes = []
+        parts = []
+        size = 0
+        for moduleId, messageType, content in messages:
+            entryLen = envelopeHeader.size + len(content)
+            if parts and size + entryLen > envelopeMaxLen:
+                envelopes.append(self.buildOFXMessage(OFX_ENVELOPE_MODULE, \
+                    b''.join(parts)))
+                parts = []
+                size = 0
+            parts.append(envelopeHeader.pack(moduleId, messageType, len(content)))
+            parts.append(content)
+            size += entryLen
+        if parts:
+            envelopes.append(self.buildOFXMessage(OFX_ENVELOPE_MODULE, \
+                b''.join(parts)))
+        return envelopes
+
     def buildOFXMessage(self, moduleId, content):
         """
         Builds an OFX message to send to a OFX agent.
@@ -121,9 +206,9 @@ class OfxInterface(object):
         """
         Unpacks an OFX message.
         """
-        messageType = struct.unpack("!i", data[0:4])[0]
-        dataLen = struct.unpack("!i", data[4:8])[0]
-        return (messageType, data[8:8+dataLen])
+        messageType, dataLen = struct.unpack_from("!ii", data)
+        # (data may be a stream's reassembly buffer.)
+        return (messageType, memoryview(data)[8:8+dataLen].tobytes())
     def pushModulesToSwitch(self, sendMsgToSwitchFcn):
         """
         pushes the loaded modules down a switch, using the controller 
@@ -131,59 +216,133 @@ class OfxInterface(object):
         """
         for moduleName in self.loadedModuleBins.keys():
             print ("pushing module %s to switch"%moduleName)
+            # all the messages go in one stream, so they stay in order.
+            send = lambda messageType, content: self.streamToSwitch(\
+                sendMsgToSwitchFcn, OFX_MANAGEMENT_MODULE, messageType, content)
             # start the transfer.
-            msg = self.buildOFXManagementMessage(OFX_LOAD_MODULE_START, moduleName)
-            sendMsgToSwitchFcn(msg)
+            send(OFX_LOAD_MODULE_START, moduleName)
             # send the python file.
             bin = self.loadedModuleBins[moduleName]
-            sendString = pickle.dumps((moduleName+".py", bin))          
-            msg = self.buildOFXManagementMessage(OFX_LOAD_MODULE_FILE, sendString)
-            sendMsgToSwitchFcn(msg)
+            send(OFX_LOAD_MODULE_FILE, moduleFileSchema.encode(moduleName+".py", bin))
             # send the c file. 
             bin = self.loadedDatapathBins[moduleName]
-            sendString = pickle.dumps((moduleName+".c", bin))          
-            msg = self.buildOFXManagementMessage(OFX_LOAD_MODULE_FILE, sendString)
-            sendMsgToSwitchFcn(msg)
-            # send the dependencies. Send 32kb at a time. All transfers should do this.
+            send(OFX_LOAD_MODULE_FILE, moduleFileSchema.encode(moduleName+".c", bin))
+            # send the dependencies, whole.
             for dep, bin in self.loadedDependencyBins[moduleName].items():
-                print ("sending file %s"%dep)
-                start = 0
-                end = 10000
-                remaining = len(bin)
-                while remaining>0:
-                    print ("remaining: %s"%remaining)
-                    partialBin = bin[start:end]
-                    content = pickle.dumps((dep, len(bin), partialBin))
-                    msg = self.buildOFXManagementMessage(OFX_LOAD_MODULE_FILE_PIECE, content)
-                    sendMsgToSwitchFcn(msg)                    
-                    start += 10000
-                    end += 10000
-                    remaining -= 10000
+                print ("sending file %s (%s bytes)"%(dep, len(bin)))
+                send(OFX_LOAD_MODULE_FILE, moduleFileSchema.encode(dep, bin))
             # end the transfer. Here, we would also pass instructions to compile 
             # anything that needs to be compiled on the switch.
-            msg = self.buildOFXManagementMessage(OFX_LOAD_MODULE_END, '')
-            sendMsgToSwitchFcn(msg)
+            send(OFX_LOAD_MODULE_END, '')
 
     def mainHandler(self, data, datapathSendFcn, datapathId):
         """
         handles experimenter messages from the switch. w
         """
+        self.datapathConnected(datapathSendFcn, datapathId)
         self.handleOFXMessage(data, datapathSendFcn, datapathId)
 
+    def datapathConnected(self, datapathSendFcn, datapathId):
+        """
+        notes the switch's current connection. When the switch 
+        reconnects, the streams to and from it start over.
+        """
+        oldSendFcn = self.datapathSendFcns.get(datapathId)
+        if oldSendFcn == datapathSendFcn:
+            return
+        if oldSendFcn is not None:
+            self.datapathDisconnected(datapathId)
+        self.datapathSendFcns[datapathId] = datapathSendFcn
+
+    def datapathDisconnected(self, datapathId):
+        """
+        drops the streams to and from a switch whose connection closed.
+        """
+        oldSendFcn = self.datapathSendFcns.pop(datapathId, None)
+        if oldSendFcn is not None:
+            self.streamSenders.pop(oldSendFcn, None)
+        self.streamReceivers.pop(datapathId, None)
+
     def handleOFXMessage(self, data, datapathSendFcn, datapathId):
         """
         Handles OFX messages (experimenter messages with appropriate 
         type code).
         """
         ofMessage = ofparse.parse(data)
-        ofxModuleId = ofMessage.exp_type
+        self.dispatchOFXMessage(ofMessage.exp_type, ofMessage.data, \
+            datapathSendFcn, datapathId)
+
+    def dispatchOFXMessage(self, ofxModuleId, data, datapathSendFcn, datapathId):
+        """
+        Passes the body of an OFX message to its handler.
+        """
         # if it goes to the OFX management module, send it there.
         if ofxModuleId==OFX_MANAGEMENT_MODULE:
-            self.handleOFXManagementMessage(ofMessage.data, datapathSendFcn, datapathId)
+            self.handleOFXManagementMessage(data, datapathSendFcn, datapathId)
+
+        # stream fragments and acks.
+        elif ofxModuleId==OFX_STREAM_MODULE:
+            self.handleStreamMessage(data, datapathSendFcn, datapathId)
+
+        # many module messages.
+        elif ofxModuleId==OFX_ENVELOPE_MODULE:
+            self.handleEnvelope(data, datapathSendFcn, datapathId)
 
         # else, send it to whatever module's function is registered to handle the id.
         elif ofxModuleId in self.moduleHandlers:
-            self.moduleHandlers[ofxModuleId](ofMessage.data, datapathSendFcn, datapathId)
+            self.moduleHandlers[ofxModuleId](data, datapathSendFcn, datapathId)
+
+    def handleEnvelope(self, data, datapathSendFcn, datapathId):
+        """
+        Handles each module message in an envelope.
+        """
+        ptr = 0
+        while ptr + envelopeHeader.size <= len(data):
+            moduleId, messageType, dataLen = envelopeHeader.unpack_from(data, ptr)
+            end = ptr + envelopeHeader.size + dataLen
+            if dataLen < 0 or end > len(data):
+                print ("envelope message of bad length %s, rest of envelope "\
+                    "dropped."%dataLen)
+                return
+            if moduleId == OFX_ENVELOPE_MODULE:
+                print ("envelope in an envelope dropped.")
+            else:
+                # (the message, from its type field on.)
+                self.dispatchOFXMessage(moduleId, data[ptr+4:end], \
+                    datapathSendFcn, datapathId)
+            ptr = end
+
+    def handleStreamMessage(self, data, datapathSendFcn, datapathId):
+        """
+        Handles a fragment of (or hello for) a stream from a switch, 
+        or an ack of a stream to a switch.
+        """
+        kind = streamMessageKind(data)
+        if kind == STREAM_FRAGMENT:
+            self.streamReceiver(datapathSendFcn, datapathId).handleFragment(data)
+        elif kind == STREAM_HELLO:
+            self.streamReceiver(datapathSendFcn, datapathId).handleHello(data)
+        elif kind == STREAM_ACK:
+            sender = self.streamSenders.get(datapathSendFcn)
+            if sender is not None:
+                sender.handleAck(data)
+
+    def streamReceiver(self, datapathSendFcn, datapathId):
+        """
+        the receiver of the streams from a switch.
+        """
+        receiver = self.streamReceivers.get(datapathId)
+        if receiver is None:
+            # (to the switch's connection at the time.)
+            sendFcn = lambda: self.datapathSendFcns.get(datapathId, \
+                datapathSendFcn)
+            deliverFcn = lambda moduleId, message: self.dispatchOFXMessage(\
+                moduleId, message, sendFcn(), datapathId)
+            ackFcn = lambda moduleId, content: \
+                sendFcn()(self.buildOFXMessage(moduleId, content))
+            receiver = StreamReceiver(deliverFcn, ackFcn)
+            self.streamReceivers[datapathId] = receiver
+        return receiver
 
     def handleOFXManagementMessage(data, datapathSendFcn, datapathId):
         """
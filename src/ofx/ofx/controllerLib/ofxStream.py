@@ -0,0 +1,255 @@
+"""
+Chunked transfer of OFX messages of any size.
+An OpenFlow message is at most 64kB, so a stream splits a module
+message (module id, message type, content) into fragments, each sent
+in its own OFX experimenter message (experimenter type
+OFX_STREAM_MODULE). The receiver copies the fragments into a buffer
+allocated when the first one arrives, and hands the whole message to
+the module's handler, in the same format as an unfragmented message.
+Fragment body:
+| kind (1) | flags (1) | pad (2) | stream id (4) | seq (4) |
+| module id (4) | message type (4) | total length (4) |
+| fragment size (4) | data |
+Ack body (and hello body, with 0 received):
+| kind (1) | flags (1) | pad (2) | fragments received (8) |
+Flow control is per sender -> receiver channel: the sender has at
+most window fragments that the receiver hasn't acked in flight. The
+receiver acks every ackEvery fragments, and at the end of each
+message. Messages (whole streams) are delivered in the order they
+were sent.
+Compression: a receiver that can decompress sets STREAM_ZLIB in its
+acks. The sender compresses the messages of the modules that enabled
+it (setCompression), if they are at least threshold bytes, and sets
+STREAM_ZLIB in their fragments. It decides when it sends a message's
+first fragment, not when the message is queued. Before the first
+message that it could compress, a sender that hasn't had an ack yet
+sends a hello, which the receiver acks right away, and holds that
+message until the ack comes. So the first burst of a fresh stream
+(a module push) is compressed too.
+Each direction has one zlib context for all its compressed messages,
+flushed (not reset) after each one, so repeated records in later
+messages compress against the earlier ones.
+The same file is used by the controller library and the switch agent.
+"""
+import struct, threading, zlib
+from collections import deque
+
+OFX_STREAM_MODULE = 0xfffffffe
+
+STREAM_FRAGMENT = 0x1
+STREAM_ACK = 0x2
+STREAM_HELLO = 0x3
+
+# flags.
+STREAM_ZLIB = 0x1
+
+fragmentHeader = struct.Struct("!BB2xIIIiII")
+ackHeader = struct.Struct("!BB2xQ")
+# the module message header (message type, content length), as
+# built by buildModuleMessage.
+moduleHeader = struct.Struct("!ii")
+
+# fits in one OpenFlow message with the experimenter and fragment
+# headers.
+fragmentSize = 60000
+streamWindow = 16
+ackEvery = 4
+# don't compress smaller messages.
+compressThreshold = 512
+
+
+class StreamSender(object):
+    """
+    Sends streams to one receiver. sendFcn(moduleId, content) sends
+    an OFX message with the content to the receiver.
+    """
+    def __init__(self, sendFcn, window=streamWindow, size=fragmentSize):
+        self.sendFcn = sendFcn
+        self.window = max(window, ackEvery)
+        self.fragmentSize = size
+        # [stream id, flags, module id, message type, content] of 
+        # each message with fragments left to send. (flags are set 
+        # when the first fragment is sent.)
+        self.queue = deque()
+        self.nextStreamId = 0
+        self.nextSeq = 0
+        self.sent = 0
+        self.acked = 0
+        # compression threshold of the modules that compress, whether 
+        # the receiver has acked (so its flags are known) and 
+        # decompresses, and the compression context.
+        self.compressModules = {}
+        self.peerKnown = False
+        self.peerDecompresses = False
+        self.helloSent = False
+        self.compressor = None
+        self.lock = threading.Lock()
+
+    def setCompression(self, moduleId, threshold=compressThreshold):
+        """
+        compress the module's messages of at least threshold bytes, 
+        if the receiver can decompress. (None: don't.) Applies to 
+        the queued messages that haven't started to go out.
+        """
+        with self.lock:
+            if threshold is None:
+                self.compressModules.pop(moduleId, None)
+            else:
+                self.compressModules[moduleId] = threshold
+
+    def send(self, moduleId, messageType, content):
+        """
+        queue a message. Returns its stream id.
+        """
+        with self.lock:
+            streamId = self.nextStreamId
+            self.nextStreamId = (self.nextStreamId + 1) & 0xffffffff
+            self.queue.append([streamId, 0, moduleId, messageType, content])
+            self.pump()
+        return streamId
+
+    def handleAck(self, data):
+        kind, flags, received = ackHeader.unpack_from(data)
+        with self.lock:
+            self.peerKnown = True
+            self.peerDecompresses = bool(flags & STREAM_ZLIB)
+            if self.acked < received <= self.sent:
+                self.acked = received
+            self.pump()
+
+    def pump(self):
+        """
+        send fragments until the window is full.
+        """
+        size = self.fragmentSize
+        while self.queue and self.sent - self.acked < self.window:
+            seq = self.nextSeq
+            if seq == 0 and not self.startMessage(self.queue[0]):
+                return
+            streamId, flags, moduleId, messageType, content = self.queue[0]
+            start = seq * size
+            header = fragmentHeader.pack(STREAM_FRAGMENT, flags, streamId, \
+                seq, moduleId, messageType, len(content), size)
+            self.sendFcn(OFX_STREAM_MODULE, header + content[start:start+size])
+            self.sent += 1
+            if start + size >= len(content):
+                self.queue.popleft()
+                self.nextSeq = 0
+            else:
+                self.nextSeq = seq + 1
+
+    def startMessage(self, message):
+        """
+        compress a message that is about to go out, if it should be. 
+        Returns False if it has to wait to know if the receiver 
+        decompresses.
+        """
+        threshold = self.compressModules.get(message[2])
+        if threshold is None or len(message[4]) < threshold:
+            return True
+        if not self.peerKnown:
+            if not self.helloSent:
+                self.helloSent = True
+                self.sendFcn(OFX_STREAM_MODULE, \
+                    ackHeader.pack(STREAM_HELLO, 0, 0))
+            return False
+        if self.peerDecompresses:
+            # (compressed in send order, the order the receiver 
+            # decompresses in.)
+            if self.compressor is None:
+                self.compressor = zlib.compressobj()
+            message[4] = self.compressor.compress(message[4]) \
+                + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            message[1] = STREAM_ZLIB
+        return True
+
+    def pending(self):
+        """
+        how many messages haven't been completely sent.
+        """
+        with self.lock:
+            return len(self.queue)
+
+
+class StreamReceiver(object):
+    """
+    Reassembles the streams from one sender.
+    deliverFcn(moduleId, data) gets each message, with data in the
+    module message format (see unpackModuleMessage).
+    ackFcn(moduleId, content) sends an OFX message back to the sender.
+    With decompress, the sender may compress messages.
+    """
+    def __init__(self, deliverFcn, ackFcn, printfcn=None, decompress=True):
+        self.deliverFcn = deliverFcn
+        self.ackFcn = ackFcn
+        self.printfcn = printfcn
+        self.received = 0
+        self.unacked = 0
+        self.ackFlags = STREAM_ZLIB if decompress else 0
+        self.decompressor = zlib.decompressobj()
+        # the message being reassembled:
+        # [stream id, module id, buffer, next seq, fragment count, flags]
+        self.current = None
+
+    def handleFragment(self, data):
+        flags, streamId, seq, moduleId, messageType, totalLen, size = \
+            fragmentHeader.unpack_from(data)[1:]
+        payload = memoryview(data)[fragmentHeader.size:]
+        self.received += 1
+        self.unacked += 1
+        if seq == 0:
+            if self.current is not None:
+                self.log("stream %s incomplete, dropped."%self.current[0])
+            # the whole message, with its module message header.
+            # (compressed messages get their header when they are 
+            # decompressed.)
+            buf = bytearray(moduleHeader.size + totalLen)
+            moduleHeader.pack_into(buf, 0, messageType, totalLen)
+            fragmentCt = max(1, (totalLen + size - 1) // size)
+            self.current = [streamId, moduleId, buf, 0, fragmentCt, flags]
+        current = self.current
+        if current is None or current[0] != streamId or current[3] != seq:
+            self.log("stream %s: unexpected fragment %s, dropped."\
+                %(streamId, seq))
+            self.current = None
+            self.ack()
+            return
+        start = moduleHeader.size + seq * size
+        current[2][start:start+len(payload)] = payload
+        current[3] = seq + 1
+        if current[3] == current[4]:
+            self.current = None
+            self.ack()
+            buf = current[2]
+            if current[5] & STREAM_ZLIB:
+                content = self.decompressor.decompress(\
+                    memoryview(buf)[moduleHeader.size:].tobytes())
+                buf = moduleHeader.pack(messageType, len(content)) + content
+            self.deliverFcn(current[1], buf)
+        elif self.unacked >= ackEvery:
+            self.ack()
+
+    def handleHello(self, data):
+        """
+        the sender asks what this receiver can do: ack right away.
+        """
+        self.unacked = 0
+        self.ackFcn(OFX_STREAM_MODULE, \
+            ackHeader.pack(STREAM_ACK, self.ackFlags, self.received))
+
+    def ack(self):
+        if self.unacked:
+            self.unacked = 0
+            self.ackFcn(OFX_STREAM_MODULE, \
+                ackHeader.pack(STREAM_ACK, self.ackFlags, self.received))
+
+    def log(self, message):
+        if self.printfcn:
+            self.printfcn(message)
+
+
+def streamMessageKind(data):
+    """
+    STREAM_FRAGMENT, STREAM_ACK or STREAM_HELLO.
+    """
+    return struct.unpack_from("!B", data)[0]
@@ -14,9 +14,10 @@ import socket
 import struct
 
 base_ofx_dir = "../.."
-# grab the latest ofxLib version and import.
-import shutil
-shutil.copy('%s/controllerLib/ofxLib.py'%base_ofx_dir, "./")
+# grab the latest ofxLib version, and the helpers it imports, and import.
+import shutil, glob
+for f in glob.glob('%s/controllerLib/*.py'%base_ofx_dir):
+    shutil.copy(f, "./")
 import ofxLib
 
 # botminer ofx module location. 
@@ -18,13 +18,15 @@ from ryu.lib import hub
 import socket
 import struct
 import time
-# grab the latest ofxLib version
-import shutil
-shutil.copy('../controller/ofxLib.py', "./")
+base_ofx_dir = "../.."
+# grab the latest ofxLib version, and the helpers it imports, and import.
+import shutil, glob
+for f in glob.glob('%s/controllerLib/*.py'%base_ofx_dir):
+    shutil.copy(f, "./")
 import ofxLib
 
 # module location. 
-modulefile = '../modules/ddosdetector/ddosdetectorModule.py'
+modulefile = '%s/ofxModules/ddosdetector/ddosdetectorModule.py'%base_ofx_dir
 
 
 class SimpleSwitch13(app_manager.RyuApp):
@@ -41,7 +43,8 @@ class SimpleSwitch13(app_manager.RyuApp):
         msg = ev.msg
         msg.serialize()
         msg_bytes = msg.buf
-        self.ofxInterface.mainHandler(msg_bytes, datapath_send)
+        dpid = ev.msg.datapath.id
+        self.ofxInterface.mainHandler(msg_bytes, datapath_send, dpid)
 
     # OFX startup: load the modules that you want onto the switch.
     ofxInterface.loadModule(modulefile)
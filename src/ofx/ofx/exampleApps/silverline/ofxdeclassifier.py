@@ -20,13 +20,15 @@ from ryu.lib import hub
 import socket
 import struct
 
-# grab the latest ofxLib version
-import shutil
-shutil.copy('../controller/ofxLib.py', "./")
+base_ofx_dir = "../.."
+# grab the latest ofxLib version, and the helpers it imports, and import.
+import shutil, glob
+for f in glob.glob('%s/controllerLib/*.py'%base_ofx_dir):
+    shutil.copy(f, "./")
 import ofxLib
 
 # silverline module location. 
-silverlinemodulefile = '../modules/silverline/silverlineModule.py'
+silverlinemodulefile = '%s/ofxModules/silverline/silverlineModule.py'%base_ofx_dir
 
 # ip address and port of the server thats protected by silverline.
 serverIp = '10.0.0.2'
@@ -47,7 +49,12 @@ class SimpleSwitch13(app_manager.RyuApp):
     ofxInterface = ofxLib.OfxInterface()
     @set_ev_cls(ofp_event.EventOFPExperimenter, MAIN_DISPATCHER)
     def switchMsgHandler(self, ev):
-        self.ofxInterface.mainHandler(ev)
+        datapath_send = ev.msg.datapath.send
+        msg = ev.msg
+        msg.serialize()
+        msg_bytes = msg.buf
+        dpid = ev.msg.datapath.id
+        self.ofxInterface.mainHandler(msg_bytes, datapath_send, dpid)
 
     # OFX startup: load the modules that you want onto the switch.
     ofxInterface.loadModule(silverlinemodulefile)
@@ -63,6 +70,7 @@ class SimpleSwitch13(app_manager.RyuApp):
         flowkeys = pickle.load(open("flowinfo.pkl", "r"))
         time.sleep(8)
         print ("sending %s permissions to switch."%len(flowkeys))
+        permissions = []
         for flow in flowkeys:
             dstip, srcip, dstport, srcport = flow
             src = srcip
@@ -70,9 +78,9 @@ class SimpleSwitch13(app_manager.RyuApp):
             sport = struct.pack("!H", srcport)
             dport = struct.pack("!H", dstport)
             permission = struct.pack("!i", 1)
-            msg = src + dst + sport + dport + permission
-            self.silverlineInterface.addFlowPermission(datapath.send, msg)
-            time.sleep(4.5/1000) # about how long it takes to add a permission on a pica8.            
+            permissions.append(src + dst + sport + dport + permission)
+        # all of them in one message.
+        self.silverlineInterface.addFlowPermissions(datapath.send, permissions)
         print ("sent all %s permissions to switch."%len(flowkeys))
 
     def __init__(self, *args, **kwargs):
@@ -219,19 +227,22 @@ class SimpleSwitch13(app_manager.RyuApp):
             print ("waiting for new connection from silverline server.")
             conn, addr = declassifierSocket.accept()
             print ("socket connected.")
+            pending = ''
             while True:
-                data = self.recv_n_bytes(16, conn)
-                if data == None:
+                # take all the permissions that have arrived.
+                chunk = conn.recv(65536)
+                if chunk == '':
                     print ("SOCKET TO SERVER CLOSED.")
                     break
-                src = data[0:4]
-                dst = data[4:8]
-                sport = struct.unpack("!H", data[8:10])[0]
-                dport = struct.unpack("!H", data[10:12])[0]
-                permission = struct.unpack("!i", data[12::])[0]
+                pending += chunk
+                end = len(pending) - (len(pending) % 16)
+                if end == 0:
+                    continue
+                data = pending[:end]
+                pending = pending[end:]
                 # forward the data to all the switches with an OFX message.
                 for datapath in self.activeDatapaths:
-                    self.silverlineInterface.addFlowPermission(datapath.send, data)
+                    self.silverlineInterface.addFlowPermissions(datapath.send, data)
 
     def recv_n_bytes(self, n, socket):
         """
@@ -7,13 +7,13 @@ import socket
 import struct
 import threading
 import time
-import cPickle as pickle
+from ofxCodec import Schema, IPV4, STRING
 from ctypes import *
 
 MODULEID = 0x40
 
 # dependencies for this module
-dependencies = ['uthash.h']
+dependencies = ['uthash.h', 'ofxCodec.py']
 
 # message type definitions for this module. 
 ENABLECONNECTIONVALIDATION=0x01 # enable TCP handshake validation. 
@@ -22,6 +22,13 @@ ENABLECONNECTIONVALIDATION=0x01 # enable TCP handshake validation.
 ADDTRIGGER=0x02 # add a trigger to the switch.
 TRIGGERRESPONSE=0x03 # trigger alert from switch to controller.
 
+# ADDTRIGGER body: a trigger. TRIGGERRESPONSE body: a trigger and 
+# the stat value that met its threshold.
+triggerSchema = Schema(1, [('src', IPV4), ('dst', IPV4), \
+    ('matchType', STRING), ('threshold', 'd')])
+triggerResponseSchema = Schema(1, [('src', IPV4), ('dst', IPV4), \
+    ('matchType', STRING), ('threshold', 'd'), ('statValue', 'Q')])
+
 # match for a trigger. 
 class Trigger(object):
     src=None
@@ -53,7 +60,7 @@ class ControllerComponent(object):
         t.dst = dstip
         t.matchType = matchType
         t.threshold = threshold
-        data = pickle.dumps(t)
+        data = triggerSchema.encode(t.src, t.dst, t.matchType, t.threshold)
         msg = self.ofxSys.buildModuleMessage(self.MODULEID, ADDTRIGGER, data)
         sendToSwitch(msg)
 
@@ -61,7 +68,10 @@ class ControllerComponent(object):
         print("avantguard module: controller message handler not implemented.")
         messageType, content = self.ofxSys.unpackModuleMessage(data)
         if messageType == TRIGGERRESPONSE:
-            print("a trigger fired on the switch.")
+            (src, dst, matchType, threshold, statValue) = \
+                triggerResponseSchema.decode(content)
+            print("a trigger fired on the switch. (%s -> %s %s = %s)"\
+                %(src, dst, matchType, statValue))
 
 class SwitchComponent(object):
     """
@@ -81,12 +91,16 @@ class SwitchComponent(object):
         # methods provided by the switch agent to send to the controller and switch.
         self.sendToSwitchFcn = ofxAgent.injectToSwitch
         self.sendToControllerFcn = ofxAgent.injectToController
+        # the flood rules of validated connections go ahead of the 
+        # other modules' flow mods: until one is in, every packet of 
+        # the connection goes through the datapath agent.
+        ofxAgent.setFlowModClass(self.MODULEID, ofxAgent.FLOWMOD_URGENT)
 
-        # start the thread that polls for triggers.
+        # the triggers are checked on the flow stats of the 
+        # module's rules (cookie = MODULEID), once there are any.
         self.activeTriggers = {} # the active triggers.
         self.triggerDelay = 1 # how long to wait before a re-poll.
-        t = threading.Thread(target=self.pollForTriggers, args=())
-        t.start()
+        self.statsSubscription = None
 
 
     def handleModuleMessage(self, data):
@@ -126,61 +140,39 @@ class SwitchComponent(object):
         Start a thread to poll it. If the threshold goes above the 
         given threshold, send an alert message to the controller. 
         """
-        t = pickle.loads(content)
+        t = Trigger()
+        (t.src, t.dst, t.matchType, t.threshold) = triggerSchema.decode(content)
         self.ofxAgent.addIpCounterFlow(t.src, t.dst, self.MODULEID)
         self.activeTriggers[(t.src, t.dst)] = t
+        if self.statsSubscription is None:
+            self.statsSubscription = self.ofxAgent.subscribeFlowStats(\
+                self.checkTriggers, self.triggerDelay, \
+                cookie=self.MODULEID, cookieMask=self.ofxAgent.COOKIE_MASK_ALL)
 
-    def pollForTriggers(self):
+    def checkTriggers(self, flowTable):
         """
-        Starts a loop to poll for all the active triggers. 
+        Checks the stats of all the active triggers. Called by the 
+        agent's flow stats poller, with the module's flows.
         """
-        while True:
-            if len(self.activeTriggers)>0:
-                # build the list of active flows.
-                activeFlows= {}
-                flowStats = self.ofxAgent.getFlowStats(self.MODULEID)
-                lines = flowStats.split('\n')
-                flowrecs = lines[1:-1]
-                for flowrec in flowrecs:
-                    fields = flowrec.split(",")
-                    src = None
-                    dst = None
-                    pct = None
-                    bct = None
-                    for field in fields:
-                        kv = field.split("=")
-                        if len(kv)<2:
-                            pass
-                        else:
-                            key=kv[0]
-                            value = kv[1]
-                            if 'nw_src' in key:
-                                src = value.split(' ')[0]
-                            elif 'nw_dst' in key:
-                                dst = value.split(' ')[0]
-                            elif 'n_packets' in key:
-                                pct = value.split(' ')[0]
-                            elif 'n_bytes' in key:
-                                bct = value.split(' ')[0]
-                    if src != None and dst != None:
-                        key = (src, dst)
-                        activeFlows[key] = {'pct':pct, 'bct':bct}
-                # check the stats of all the active triggers.
-                # if the threshold for any of them is met, alert 
-                # the controller.
-                for key, t in activeTriggers.items():
-                    if key in activeFlows:
-                        stats = activeFlows[key]
-                        if stats[t.matchType]>t.threshold:
-                            self.activateTrigger(trigger, stats[t.matchType])
-            # wait before polling again.
-            time.sleep(self.triggerDelay)
+        # build the list of active flows.
+        activeFlows= {}
+        for src, dst, sport, dport, pct, bct in flowTable.ipFlows():
+            key = (src, dst)
+            activeFlows[key] = {'pct':pct, 'bct':bct}
+        # if the threshold for any of them is met, alert 
+        # the controller.
+        for key, t in self.activeTriggers.items():
+            if key in activeFlows:
+                stats = activeFlows[key]
+                if stats[t.matchType]>t.threshold:
+                    self.activateTrigger(t, stats[t.matchType])
 
     def activateTrigger(self, trigger, statValue):
         """
         send an alert to the controller that a trigger is met.                            
         """
         trigger.statValue = statValue
-        data = pickle.dumps(trigger)
+        data = triggerResponseSchema.encode(trigger.src, trigger.dst, \
+            trigger.matchType, trigger.threshold, statValue)
         msg = self.ofxAgent.buildModuleMessage(self.MODULEID, TRIGGERRESPONSE, data)
-        self.ofxAgent.injectToController(msg)
\ No newline at end of file
+        self.ofxAgent.injectToController(msg, self.ofxAgent.LANE_EVENT)
\ No newline at end of file
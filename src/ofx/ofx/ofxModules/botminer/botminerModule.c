@@ -21,8 +21,6 @@
 
 struct timeval tv;
 
-double current_time;
-double last_time;
 
 double getMsTime(){
 	gettimeofday(&tv, NULL); // get current time
@@ -192,6 +190,7 @@ int handle_packet(unsigned char * ethpkt, unsigned char * ippkt, int pktsize){
 		// If its not there, add it.
 		if (retFlow == NULL){
 			addFlowEntry(newFlow);
+			entryAttempts +=1;
 			flow = newFlow;
 		}
 		// If it is there, use the existing flow.
@@ -201,21 +200,12 @@ int handle_packet(unsigned char * ethpkt, unsigned char * ippkt, int pktsize){
 		// Flow processing:
 		// 1) update the length.
 		flow->byteCt += ntohs(udp->uh_ulen);
-		// 2) if you've never tried to add a rule, do so now.
+		// 2) offer the flow to the ASIC. The dp agent's offload policy 
+		// gives counting rules to the heaviest flows.
+		// (the flows that get rules are marked by handle_flow_promoted.)
 		if (flow->added == 0){
-			// print_packet(ip, udp);
-			entryAttempts +=1;
-			current_time = getMsTime();
-			// dprint("LAST TICK: %f\n",last_time);
-			// dprint("CURR TICK: %f\n",current_time);
-
-			if ((current_time-last_time)>10){
-				addUDPCountingFlow(flow->key.ip_src, flow->key.ip_dst,
-				flow->key.uh_sport, flow->key.uh_dport);
-				flowsAddedToAsic +=1;
-				last_time=getMsTime();
-			}			
-			flow->added = 1;
+			offerUDPCountingFlow(flow->key.ip_src, flow->key.ip_dst,
+				flow->key.uh_sport, flow->key.uh_dport, ntohs(udp->uh_ulen));
 		}
 	}
 	// Return 0. Never send the packet back. This is a tap application.
@@ -224,8 +214,6 @@ int handle_packet(unsigned char * ethpkt, unsigned char * ippkt, int pktsize){
 
 // Botminer startup: do nothing.
 int module_startup(){
-	last_time = 0;
-	current_time = 0;
 	dprint("runnning data path start up function for botminer module.\n");
 	// 1) start a thread that sends up statistics updates.
 	pthread_t pth; // thread identifier.
@@ -241,6 +229,42 @@ int handle_message(struct ofxDpHeader * msgHeader, unsigned char* msg){
 	return 1;
 }
 
+// A flow got an ASIC counting rule: stop offering it. 
+// (the flow may not be the one whose packet is being handled.)
+void handle_flow_promoted(struct in_addr ip_src, struct in_addr ip_dst, 
+	u_short sport, u_short dport){
+	struct FlowEntry reqFlow;
+	memset(&reqFlow, 0, sizeof(reqFlow));
+	reqFlow.key.ip_src = ip_src;
+	reqFlow.key.ip_dst = ip_dst;
+	reqFlow.key.uh_sport = sport;
+	reqFlow.key.uh_dport = dport;
+	struct FlowEntry* flow = getFlowEntry(&reqFlow);
+	if (flow == NULL || flow->added){
+		return;
+	}
+	flow->added = 1;
+	flowsAddedToAsic += 1;
+}
+
+// The agent removed the counting rule of a flow that went cold. 
+// Count what the ASIC counted, and count the flow in software again.
+void handle_flow_demoted(struct in_addr ip_src, struct in_addr ip_dst, 
+	u_short sport, u_short dport, uint64_t packetCt, uint64_t byteCt){
+	struct FlowEntry reqFlow;
+	memset(&reqFlow, 0, sizeof(reqFlow));
+	reqFlow.key.ip_src = ip_src;
+	reqFlow.key.ip_dst = ip_dst;
+	reqFlow.key.uh_sport = sport;
+	reqFlow.key.uh_dport = dport;
+	struct FlowEntry* flow = getFlowEntry(&reqFlow);
+	if (flow == NULL){
+		return;
+	}
+	flow->byteCt += byteCt;
+	flow->added = 0;
+}
+
 // Example of iterating through a hash table:
 // Just open a file, then iterate through and write each struct to the file.
 // You can open and parse the hash table later.
@@ -280,7 +304,7 @@ void* statsThread(void *arg){
 			idx +=1;
 		}
 		dprint("copied %i flow entries.\n",idx);		
-		dprint("%i flow entries added to asic. (out of %i attempts)\n",flowsAddedToAsic, entryAttempts);		
+		dprint("%i flow entries added to asic. (out of %i flows)\n",flowsAddedToAsic, entryAttempts);		
 		sendMsgUp((unsigned char *)flowArray, sizeof(struct FlowEntryNoHash)*(idx),MODULEID, STATSMESSAGE);
 		sleep(10);
 	}
@@ -26,8 +26,6 @@ FLOWSTATS = 0x22;
 
 struct timeval tv;
 
-double current_time;
-double last_time;
 
 double getMsTime(){
 	gettimeofday(&tv, NULL); // get current time
@@ -105,7 +103,7 @@ struct FlowEntry{
 	struct FlowKey key;
 	uint32_t permission;
 	uint32_t added; // Has the rule been added?
-	uint32_t byteCt; // how many packets have we seen?
+	uint32_t byteCt; // how many bytes have we seen?
 	UT_hash_handle hh;
 };
 
@@ -157,7 +155,7 @@ int printFlowEntry(struct FlowEntry * flow){
     char dst[32];
     strcpy(src,inet_ntoa(flow->key.ip_src));
     strcpy(dst,inet_ntoa(flow->key.ip_dst));  
-	printf("\tFlow: %s (%i) --> %s (%i): Packet ct %i \n", 
+	printf("\tFlow: %s (%i) --> %s (%i): Byte ct %i \n", 
 		src, ntohs(flow->key.uh_sport), 
 		dst, ntohs(flow->key.uh_dport), 
 		flow->byteCt);
@@ -197,6 +195,7 @@ int handle_packet(unsigned char * ethpkt, unsigned char * ippkt, int pktsize){
 		// If its not there, add it.
 		if (retFlow == NULL){
 			addFlowEntry(newFlow);
+			entryAttempts +=1;
 			flow = newFlow;
 		}
 		// If it is there, use the existing flow.
@@ -204,23 +203,14 @@ int handle_packet(unsigned char * ethpkt, unsigned char * ippkt, int pktsize){
 			flow = retFlow;
 		}
 		// Flow processing:
-		// 1) update the packet counter.
-		flow->byteCt += 1;
-		// 2) if you've never tried to add a rule, do so now.
+		// 1) update the byte counter.
+		flow->byteCt += pktsize;
+		// 2) offer the flow to the ASIC. The dp agent's offload policy 
+		// gives counting rules to the heaviest flows.
+		// (the flows that get rules are marked by handle_flow_promoted.)
 		if (flow->added == 0){
-			// print_packet(ip, udp);
-			entryAttempts +=1;
-			current_time = getMsTime();
-			// printf("LAST TICK: %f\n",last_time);
-			// printf("CURR TICK: %f\n",current_time);
-
-			if ((current_time-last_time)>10){
-				addUDPCountingFlow(flow->key.ip_src, flow->key.ip_dst,
-				flow->key.uh_sport, flow->key.uh_dport);
-				flowsAddedToAsic +=1;
-				last_time=getMsTime();
-			}			
-			flow->added = 1; // stop trying to add the flow.
+			offerUDPCountingFlow(flow->key.ip_src, flow->key.ip_dst,
+				flow->key.uh_sport, flow->key.uh_dport, 1);
 		}
 	}
 	// Return 0. Never send the packet back. This is a tap application.
@@ -228,8 +218,6 @@ int handle_packet(unsigned char * ethpkt, unsigned char * ippkt, int pktsize){
 }
 
 int module_startup(){
-	last_time = 0;
-	current_time = 0;
 	printf("runnning data path start up function for botminer module.\n");
 	// 1) start a thread that sends up statistics updates.
 	pthread_t pth; // thread identifier.
@@ -243,6 +231,44 @@ int handle_message(struct ofxDpHeader * msgHeader, unsigned char* msg){
 	return 1;
 }
 
+// A flow got an ASIC counting rule: stop offering it. 
+// (the flow may not be the one whose packet is being handled.)
+void handle_flow_promoted(struct in_addr ip_src, struct in_addr ip_dst, 
+	u_short sport, u_short dport){
+	struct FlowEntry reqFlow;
+	memset(&reqFlow, 0, sizeof(reqFlow));
+	reqFlow.key.ip_src = ip_src;
+	reqFlow.key.ip_dst = ip_dst;
+	reqFlow.key.uh_sport = sport;
+	reqFlow.key.uh_dport = dport;
+	struct FlowEntry* flow = getFlowEntry(&reqFlow);
+	if (flow == NULL || flow->added){
+		return;
+	}
+	flow->added = 1;
+	flowsAddedToAsic += 1;
+}
+
+// The agent removed the counting rule of a flow that went cold. 
+// Count what the ASIC counted, and count the flow in software again. 
+// (the switch component takes the part of it that it already got 
+// from the ASIC's counters back out.)
+void handle_flow_demoted(struct in_addr ip_src, struct in_addr ip_dst, 
+	u_short sport, u_short dport, uint64_t packetCt, uint64_t byteCt){
+	struct FlowEntry reqFlow;
+	memset(&reqFlow, 0, sizeof(reqFlow));
+	reqFlow.key.ip_src = ip_src;
+	reqFlow.key.ip_dst = ip_dst;
+	reqFlow.key.uh_sport = sport;
+	reqFlow.key.uh_dport = dport;
+	struct FlowEntry* flow = getFlowEntry(&reqFlow);
+	if (flow == NULL){
+		return;
+	}
+	flow->byteCt += byteCt;
+	flow->added = 0;
+}
+
 
 // Example of iterating through a hash table:
 // Just open a file, then iterate through and write each struct to the file.
@@ -259,7 +285,7 @@ struct FlowEntryNoHash{
 	struct FlowKey key;
 	uint32_t permission;
 	uint32_t added; // Has the rule been added?
-	uint32_t byteCt; // how many packets have we seen?
+	uint32_t byteCt; // how many bytes have we seen?
 };
 // Entry size: 12 + 4 + 4 + 4 = 24.
 
@@ -283,7 +309,7 @@ void* statsThread(void *arg){
 			idx +=1;
 		}
 		// printf("copied %i flow entries.\n",idx);		
-		// printf("%i flow entries added to asic. (out of %i attempts)\n",flowsAddedToAsic, entryAttempts);		
+		// printf("%i flow entries added to asic. (out of %i flows)\n",flowsAddedToAsic, entryAttempts);		
 		sendTypedMsgUp((unsigned char *)flowArray, sizeof(struct FlowEntryNoHash)*(idx),MODULEID, FLOWSTATS);
 		sleep(1);
 	}
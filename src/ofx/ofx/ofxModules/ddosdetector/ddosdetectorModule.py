@@ -5,25 +5,40 @@ import socket
 import struct
 import threading
 import time
-import cPickle as pickle
+import numpy as np
+from ofxCodec import Schema
+from dpFlowEntries import decodeFlowEntries, flowKeys
 
 # Module ID, for OFX internal reference.
 MODULEID = 0x41
 
 
 # dependencies for this module
-dependencies = ['uthash.h']
+dependencies = ['uthash.h', 'dpFlowEntries.py', 'ofxCodec.py']
 
 # message type definitions for this module. 
 # controller <--> switch
 STARTMONITORING = 0x01 # add a trigger. 
 ALERT=0x02 # send an alert to the controller about a trigger.
 
+# ALERT body: the observed rate (bits / second).
+alertSchema = Schema(1, [('rate', 'd')])
+
 # switch <--> data plane
 GETFLOWS = 0x11
 FLOWSTATS = 0x22
 
 
+def columnArray(column):
+    """
+    a FlowStatsTable column (an array.array) as a numpy array that 
+    shares its memory.
+    """
+    if not len(column):
+        return np.zeros(0, dtype=np.dtype(column.typecode))
+    return np.frombuffer(column, dtype=np.dtype(column.typecode))
+
+
 class ControllerComponent(object):
     """
     The component that gets loaded by the controller.
@@ -58,7 +73,7 @@ class ControllerComponent(object):
         """
         Handles an alert from a switch.
         """
-        rate = pickle.loads(str(content))
+        (rate,) = alertSchema.decode(str(content))
         print ("got an alert from the switch (rate = %s bytes)"%rate)
 
 
@@ -82,11 +97,14 @@ class SwitchComponent(object):
         self.sendToControllerFcn = ofxAgent.injectToController
         # socket to the data path component for this module.
         self.dpSocket = None
-        self.flowStatsAsic = {} # flow stats according to the OpenFlow tables.
-        self.flowStatsOFX = {} # flow stats according to the OFX data plane agent.
+        # byte counts of each flow, according to the OpenFlow tables 
+        # ('asic') and the OFX data plane agent ('dp').
+        self.flowCounters = ofxAgent.FlowCounterStore(('asic', 'dp'))
+        # the flows that had ASIC counting rules at the last datapath 
+        # update.
+        self.promotedFlows = set()
         self.lastCheckTime = 0
         self.currentTime = 0
-        self.lastByteCts = {}
 
     def checkForDDoS(self, threshold):
         """
@@ -97,26 +115,18 @@ class SwitchComponent(object):
         # only do the check once per second.
         if (interval)<1:
             return
-        keys = set(self.flowStatsAsic.keys() + self.flowStatsOFX.keys())
-        totalChange = 0
-        # see how much the byte count of each flow has changed since 
-        # this function was last called.
-        for key in keys:
-            currentByteCt = self.flowStatsAsic.get(key, 0) + self.flowStatsOFX.get(key, 0)
-            lastByteCt = self.lastByteCts.get(key, 0)
-            self.lastByteCts[key] = currentByteCt
-            change = currentByteCt - lastByteCt
-            totalChange += change
-        byterate = totalChange / interval
+        # the byte rate of all the flows since the last sample, in 
+        # the ASIC and the datapath agent.
+        byterate = self.flowCounters.rate(total=True)
         rate = byterate * 8
         self.lastCheckTime = self.currentTime
         if rate > threshold:
             print ("THRESHOLD REACHED.")
             print ("\tobserved rate: %s"%rate)
             print ("\tthreshold: %s"%threshold)
-            data = pickle.dumps(rate)
+            data = alertSchema.encode(rate)
             msg = self.ofxAgent.buildModuleMessage(self.MODULEID, ALERT, data)
-            self.ofxAgent.injectToController(msg)        
+            self.ofxAgent.injectToController(msg, self.ofxAgent.LANE_EVENT)        
 
     def handleDpMessage(self, msgType, data):
         """
@@ -129,24 +139,32 @@ class SwitchComponent(object):
         };
         """
         if msgType == FLOWSTATS:
-            flowCt = len(data)/24
-            idx = 0
-            ptr = 0
-            while idx<flowCt:
-                ptr = idx * (24)
-                src = socket.inet_ntoa(data[ptr:ptr+4])
-                dst = socket.inet_ntoa(data[ptr+4:ptr+8])
-                sport,dport = struct.unpack("!HH", data[ptr+8:ptr+12])
-                permission,added,byteCt = struct.unpack("!III",data[ptr+12:ptr+24])
-                # print ("DP AGENT flow %s: %s (%s) --> %s (%s) -- %s bytes"%(idx, src, sport, dst, dport, byteCt))
-                key = (src,dst,sport,dport)
-                if key not in self.flowStatsOFX:
-                    self.flowStatsOFX[key] = 0
-                self.flowStatsOFX[key] =byteCt
-                idx += 1
+            entries = decodeFlowEntries(data)
+            keys = flowKeys(entries)
+            self.rebaseDemotedFlows(keys, entries['added'])
+            self.flowCounters.update('dp', keys, entries['byteCt'])
         else:
             print ("DDoS module: unknown message type.")
 
+    def rebaseDemotedFlows(self, keys, added):
+        """
+        A demoted flow's datapath counter jumps by everything its 
+        ASIC rule counted, but the ASIC's counter of the flow keeps 
+        the part that was already polled. Take that part out of the 
+        datapath's counter, so only the rest is new, and count the 
+        flow's next rule from there.
+        """
+        promoted = set(key for key, isAdded in zip(keys, added.tolist()) \
+            if isAdded)
+        demoted = [key for key in keys \
+            if key in self.promotedFlows and key not in promoted]
+        self.promotedFlows = promoted
+        if not demoted:
+            return
+        asicCounts = self.flowCounters.latest('asic', demoted)
+        self.flowCounters.rebase('dp', demoted, -asicCounts)
+        self.flowCounters.rebase('asic', demoted, asicCounts)
+
     def handleModuleMessage(self, data):
         """
         Handles messages directed to this module.
@@ -159,32 +177,40 @@ class SwitchComponent(object):
 
     def startMonitoring(self, content):
         """
-        Start monitoring for DDoS attacks. 
+        Start monitoring for DDoS attacks, in a second. (so the 
+        datapath component is loaded.)
         """
-        time.sleep(1)
         (interval, threshold) = struct.unpack("!ii", content)
-        t = threading.Thread(target=self.localMonitoringThread, args=(interval,threshold))
-        t.start()
+        self.ofxAgent.callLater(1, self.beginMonitoring, interval, threshold)
+
+    def beginMonitoring(self, interval, threshold):
+        self.threshold = threshold
+        print ("starting DDoS monitoring with update interval: %s"%interval)
+        self.ofxAgent.subscribeFlowStats(self.handleFlowStats, interval, \
+            cookie=self.MODULEID, cookieMask=self.ofxAgent.COOKIE_MASK_ALL)
         # install a tap for traffic, using OFX.
         print ("tapping UDP traffic to monitor for DDoS attacks.")
         # matchPatternIn = "priority=1, dl_type=0x0800, ip_proto=17"
         matchPatternIn = "priority=1"
         self.ofxAgent.tapToDpAgent(matchPatternIn, self.MODULEID)
 
-    def localMonitoringThread(self, interval, threshold):
+    def handleFlowStats(self, flowTable):
         """
-        Collects data from the OpenFlow component of the switch about what 
-        flows are installed. 
+        Gets data from the OpenFlow component of the switch about what 
+        flows are installed. Called by the agent's flow stats poller, 
+        every monitoring interval.
         """
-        print ("starting DDoS monitoring thread with update interval: %s"%interval)
-        while True:
-            # get the stats from the ASIC.
-            flowStats = self.ofxAgent.getFlowStatsDict(self.MODULEID)
-            # get the stats from the datapath agent.
-            self.ofxAgent.sendToDp(MODULEID, GETFLOWS, '')
-
-            self.flowStatsAsic = {k:v['bct'] for k, v in flowStats.items()}
-            # now do the check?
-            self.checkForDDoS(threshold)
-            # wait until the next interval.   
-            time.sleep(interval)
\ No newline at end of file
+        # the stats from the ASIC, keyed like the datapath's 
+        # records (integer addresses). Only the rows of IPv4 flows.
+        ipv4Src = columnArray(flowTable.ipv4Src)
+        ipFlows = ipv4Src != 0
+        keys = list(zip(ipv4Src[ipFlows].tolist(), \
+            columnArray(flowTable.ipv4Dst)[ipFlows].tolist(), \
+            columnArray(flowTable.tpSrc)[ipFlows].tolist(), \
+            columnArray(flowTable.tpDst)[ipFlows].tolist()))
+        byteCts = columnArray(flowTable.byteCount)[ipFlows]
+        self.flowCounters.update('asic', keys, byteCts)
+        # get the stats from the datapath agent.
+        self.ofxAgent.sendToDp(MODULEID, GETFLOWS, '')
+        # now do the check?
+        self.checkForDDoS(self.threshold)
@@ -5,14 +5,17 @@ import socket
 import struct
 import threading
 import time
-import cPickle as pickle
+from ofxCodec import Schema
+from flowDeltas import FlowDeltaEncoder, FlowDeltaDecoder
+from dpFlowEntries import decodeFlowEntries, flowKeys
 
 # Module ID, for OFX internal reference.
 MODULEID = 0x30
 
 
 # dependencies for this module
-dependencies = ['uthash.h']
+dependencies = ['uthash.h', 'dpFlowEntries.py', 'ofxCodec.py', \
+    'flowDeltas.py']
 
 # message type definitions for this module. 
 STARTCOLLECTION = 0x01 # controller -> switch: start collection.
@@ -21,6 +24,15 @@ NEWDATASTART = 0X02
 NEWDATAPART = 0x03
 NEWDATAFINISH = 0x04
 DPAGENTUPDATE = 0x05
+FLOWSACK = 0x06 # controller -> switch: got a flow report.
+
+# NEWDATAPART and DPAGENTUPDATE bodies are flow reports (see 
+# flowDeltas): the byte count of each flow, by (src, dst, sport, dport), 
+# with integer addresses. Only the changes since the epoch the 
+# controller last acked are sent. 
+flowKeyFormat = 'IIHH'
+# FLOWSACK body: the message type of the report, and its epoch.
+flowsAckSchema = Schema(1, [('report', 'I'), ('epoch', 'I')])
 
 
 packetLen = 1450
@@ -34,11 +46,11 @@ class ControllerComponent(object):
     MODULEID = 0x30
 
 
-    flowDictAsic = {}
-    flowDictDp = {}
-
     def __init__(self, ofxControllerInterface):
         self.ofxSys = ofxControllerInterface
+        # the flows in each switch's reports, by (switch id, report 
+        # message type).
+        self.flowReports = {}
         # the handler for messages from the switch by this module.
         self.mainHandler = self.handleModuleMessage
 
@@ -79,24 +91,10 @@ struct FlowEntryNoHash{
     uint32_t byteCt; // how many packets have we seen?
 };
         """
-        data = str(data)
-        flowCt = len(data)/24
-        print ("got info about %s flows from the datapath (switch id: %s)."%(flowCt, datapathId))
-        idx = 0
-        ptr = 0
-        while idx<flowCt:
-            ptr = idx * (24)
-            src = socket.inet_ntoa(data[ptr:ptr+4])
-            dst = socket.inet_ntoa(data[ptr+4:ptr+8])
-            sport,dport = struct.unpack("!HH", data[ptr+8:ptr+12])
-            permission,added,byteCt = struct.unpack("!III",data[ptr+12:ptr+24])
-            # print ("DP AGENT flow %s: %s (%s) --> %s (%s) -- %s bytes"%(idx, src, sport, dst, dport, byteCt))
-
-            key = (src,dst,sport,dport)
-            if key not in self.flowDictDp:
-                self.flowDictDp[key] = 0
-            self.flowDictDp[key] =byteCt
-            idx += 1
+        flows = self.applyFlowReport(DPAGENTUPDATE, data, datapathSendFcn, datapathId)
+        if flows is None:
+            return
+        print ("got info about %s flows from the datapath (switch id: %s)."%(len(flows), datapathId))
         self.botMiner()
 
     def handleSwitchUpdate(self, content, datapathSendFcn, datapathId):
@@ -104,20 +102,33 @@ struct FlowEntryNoHash{
         Handle a statistics update from the switch.
         """
         print ("got data update from switch (%s bytes)"%len(content))  
-        flowRecords = pickle.loads(str(content))
-        idx = 0
-        for r in flowRecords:
-            src = socket.inet_ntoa(r[0:4])
-            dst = socket.inet_ntoa(r[4:8])
-            sport,dport = struct.unpack("!HH", r[8:12])
-            byteCt = struct.unpack("!I", r[12::])[0]
-            # packetCt = byteCt / packetLen
-            # print ("ASIC flow %s: %s (%s) --> %s (%s) -- %s bytes"%(idx, src, sport, dst, dport, byteCt))
+        self.applyFlowReport(NEWDATAPART, content, datapathSendFcn, datapathId)
 
-            key = (src,dst,sport,dport)
-            self.flowDictAsic[key]= byteCt
-            idx += 1
+    def applyFlowReport(self, reportType, data, datapathSendFcn, datapathId):
+        """
+        Apply a flow report from a switch, and ack it. Returns the 
+        flows (key -> (byteCt,)), or None if the report can't be 
+        applied yet. (the switch sends a full report periodically.)
+        """
+        key = (datapathId, reportType)
+        if key not in self.flowReports:
+            self.flowReports[key] = FlowDeltaDecoder(flowKeyFormat)
+        decoder = self.flowReports[key]
+        epoch = decoder.apply(data)
+        if epoch is None:
+            return None
+        content = flowsAckSchema.encode(reportType, epoch)
+        msg = self.ofxSys.buildModuleMessage(self.MODULEID, FLOWSACK, content)
+        datapathSendFcn(msg)
+        return decoder.flows
 
+    def flowsByteCt(self, reportType):
+        """
+        the byte count of all the flows, on all the switches, from one 
+        kind of report.
+        """
+        return sum(decoder.totals()[0] for (datapathId, t), decoder \
+            in self.flowReports.items() if t == reportType)
 
 
     def finishSwitchUpdate(self, content, datapathSendFcn, datapathId):
@@ -129,10 +140,11 @@ struct FlowEntryNoHash{
         """
         null botMiner module.
         """
-        totalByteCt = sum(self.flowDictAsic.values()) + sum(self.flowDictDp.values())       
+        asicByteCt = self.flowsByteCt(NEWDATAPART)
+        dpByteCt = self.flowsByteCt(DPAGENTUPDATE)
+        totalByteCt = asicByteCt + dpByteCt
         print ("sending %s byte records to botminer. (%s ASIC & %s OFX)"\
-            %(totalByteCt, sum(self.flowDictAsic.values()), sum(self.flowDictDp.values())))
-        # pickle.dump((self.flowDictAsic, self.flowDictDp), open("OfxBotminerFlows.pkl", "w"))
+            %(totalByteCt, asicByteCt, dpByteCt))
 
 
 
@@ -156,6 +168,11 @@ class SwitchComponent(object):
         self.sendToControllerFcn = ofxAgent.injectToController
         # socket to the data path component for this module.
         self.dpSocket = None
+        # the reports of the ASIC's flows and the datapath's flows.
+        self.flowReports = {NEWDATAPART:FlowDeltaEncoder(flowKeyFormat), \
+            DPAGENTUPDATE:FlowDeltaEncoder(flowKeyFormat)}
+        # the reports are streams of similar records: compress them.
+        ofxAgent.enableStreamCompression(self.MODULEID)
 
     def handleDpMessage(self, msgType, data):
         """
@@ -164,15 +181,12 @@ class SwitchComponent(object):
         flowCt = len(data)/24
         self.ofxAgent.dprint( "botminer message from data path: %s"%len(data))
         self.ofxAgent.dprint ("(%s flow statuses)"%(flowCt))
-        # send the flow stats to the controller, 1k at a time.
-        start = 0     
-        while start < len(data):
-            end = start + (1000*24)
-            content = data[start:end]
-            start += 1000*24
-            self.ofxAgent.dprint ("sending up to 1000 flow statuses to controller. (%s bytes)"%len(content))
-            msg = self.ofxAgent.buildModuleMessage(self.MODULEID, DPAGENTUPDATE, content)
-            self.ofxAgent.injectToController(msg)
+        # send the changes to the controller, as one message.
+        entries = decodeFlowEntries(data)
+        report = self.flowReports[DPAGENTUPDATE].encode(flowKeys(entries), \
+            entries['byteCt'].tolist())
+        self.ofxAgent.dprint ("flow report: %s bytes"%len(report))
+        self.ofxAgent.streamToController(self.MODULEID, DPAGENTUPDATE, report)
 
     def handleModuleMessage(self, data):
         """
@@ -183,6 +197,9 @@ class SwitchComponent(object):
         #self.ofxAgent.dprint "\tmessage type: %s"%messageType
         if messageType == STARTCOLLECTION:
             self.startCollection(content)
+        elif messageType == FLOWSACK:
+            (reportType, epoch) = flowsAckSchema.decode(content)
+            self.flowReports[reportType].ack(epoch)
     def startCollection(self, content):
         """
         Start collecting data for botminer.
@@ -190,115 +207,68 @@ class SwitchComponent(object):
         # start the polling and update thread. 
         interval = struct.unpack("!i", content)[0]
         self.ofxAgent.dprint ("polling ASIC for UDP flow info (interval = %s)"%interval)
-        t = threading.Thread(target=self.dataCollectionThread, args=(interval,))
-        t.start()
+        self.ofxAgent.subscribeFlowStats(self.sendFlowRecords, interval, \
+            cookie=self.MODULEID, cookieMask=self.ofxAgent.COOKIE_MASK_ALL)
         # install a tap for udp traffic, using OFX.
         self.ofxAgent.dprint ("tapping UDP traffic for botminer.")
         matchPatternIn = "priority=1, dl_type=0x0800, ip_proto=17"
         self.ofxAgent.tapToDpAgent(matchPatternIn, self.MODULEID)
 
-    def dataCollectionThread(self, interval):
+    def sendFlowRecords(self, flowTable):
         """
-        Collects data from the OpenFlow component of the switch about what 
-        flows are installed. Returns records to the controller.
+        Sends records of the flows installed in the OpenFlow component 
+        of the switch to the controller. Called by the agent's flow 
+        stats poller, every collection interval.
         """
-        self.ofxAgent.dprint ("starting botminer data collection thread with interval: %s"%interval)
-        while True:
-            flowStats = self.ofxAgent.getFlowStats(self.MODULEID)
-            lines = flowStats.split('\n')
-            flowrecs = lines[1:-1]
-            self.ofxAgent.dprint("\tgot %s flow records."%len(flowrecs))
-            # the records botminer wants: flow and host stats.
-            flowStats = {}
-            hostStats = {}
-            for flowrec in flowrecs:
-                fields = flowrec.split(",")
-                src = None
-                dst = None
-                sport = None
-                dport = None
-                pct = None
-                bct = None
-                for field in fields:
-                    kv = field.split("=")
-                    if len(kv)<2:
-                        pass
-                    else:
-                        key=kv[0]
-                        value = kv[1]
-                        if 'nw_src' in key:
-                            src = value.split(' ')[0]
-                        elif 'nw_dst' in key:
-                            dst = value.split(' ')[0]
-                        elif 'tp_src' in key:
-                            sport = int(value.split(' ')[0])
-                        elif 'tp_dst' in key:
-                            dport = int(value.split(' ')[0])
-                        elif 'n_packets' in key:
-                            pct = value.split(' ')[0]
-                        elif 'n_bytes' in key:
-                            bct = value.split(' ')[0]
-                if src!=None:
-                    # make a flow record.
-                    flowKey = (src, dst, sport, dport)
-                    flowStats[flowKey] = {'pct':pct, 'bct':bct}
-                    # update two records.
-                    if src not in hostStats:
-                        hostStats[src] = {'ips':set([]), 'ports':set([])}
-                    if dst not in hostStats:
-                        hostStats[dst] = {'ips':set([]), 'ports':set([])}
-                    hostStats[src]['ips'].add(dst)
-                    hostStats[src]['ports'].add(dport)
-                    hostStats[dst]['ips'].add(src)
-                    hostStats[dst]['ports'].add(sport)
-            # compute all the host records. 
-            # hostRecords = []
-            # # self.ofxAgent.dprint ("host records:")
-            # # self.ofxAgent.dprint ("------------------------")
-            # for ip, data in hostStats.items():
-            #     record = "%s, %s, %s"%(ip, len(data['ips']), len(data['ports']))
-            #     # self.ofxAgent.dprint record
-            #     # a record contains the number of IPs and ports the host 
-            #     # connected to.
-            #     hostRecords.append(record)
-            # self.ofxAgent.dprint ("------------------------")
-            flowRecords = []
-            # self.ofxAgent.dprint ("flow records:")
-            # self.ofxAgent.dprint ("------------------------")
-            for key, stats in flowStats.items():
-                recordBin = socket.inet_aton(key[0]) + socket.inet_aton(key[1]) + struct.pack("!H",key[2]) + struct.pack("!H",key[3]) + struct.pack("!I",int(stats['bct']))
-                # record = "%s, %s, %s"%(str(key), stats['pct'], stats['bct'])
-                # self.ofxAgent.dprint record
-                # self.ofxAgent.dprint key
-                flowRecords.append(recordBin)
-                # self.ofxAgent.dprint record
-                # a record contains the packet and byte count of the flow.
-            # self.ofxAgent.dprint ("------------------------")
-            self.ofxAgent.dprint ("sending  %s flow records to controller."\
-                %(len(flowRecords)))
-            
-            msg = self.ofxAgent.buildModuleMessage(self.MODULEID, NEWDATASTART, '')
-            self.ofxAgent.injectToController(msg)
+        self.ofxAgent.dprint("\tgot %s flow records."%len(flowTable))
+        # the records botminer wants: flow and host stats.
+        flowStats = {}
+        hostStats = {}
+        for i in range(len(flowTable)):
+            src = flowTable.ipv4Src[i]
+            if not src:
+                continue
+            dst = flowTable.ipv4Dst[i]
+            sport = flowTable.tpSrc[i]
+            dport = flowTable.tpDst[i]
+            # make a flow record.
+            flowKey = (src, dst, sport, dport)
+            flowStats[flowKey] = {'pct':flowTable.packetCount[i], \
+                'bct':flowTable.byteCount[i]}
+            # update two records.
+            if src not in hostStats:
+                hostStats[src] = {'ips':set([]), 'ports':set([])}
+            if dst not in hostStats:
+                hostStats[dst] = {'ips':set([]), 'ports':set([])}
+            hostStats[src]['ips'].add(dst)
+            hostStats[src]['ports'].add(dport)
+            hostStats[dst]['ips'].add(src)
+            hostStats[dst]['ports'].add(sport)
+        # compute all the host records. 
+        # hostRecords = []
+        # # self.ofxAgent.dprint ("host records:")
+        # # self.ofxAgent.dprint ("------------------------")
+        # for ip, data in hostStats.items():
+        #     record = "%s, %s, %s"%(ip, len(data['ips']), len(data['ports']))
+        #     # self.ofxAgent.dprint record
+        #     # a record contains the number of IPs and ports the host 
+        #     # connected to.
+        #     hostRecords.append(record)
+        # self.ofxAgent.dprint ("------------------------")
+        # a record contains the byte count of the flow.
+        keys = list(flowStats.keys())
+        byteCts = [int(flowStats[key]['bct']) for key in keys]
+        # only the flows that changed since the last acked report.
+        controlString = self.flowReports[NEWDATAPART].encode(keys, byteCts)
+        self.ofxAgent.dprint ("sending report of %s flow records to controller. (%s bytes)"\
+            %(len(keys), len(controlString)))
+        # all the records go in one message. (streamed, so the 
+        # three messages stay in order.)
+        self.ofxAgent.streamToController(self.MODULEID, NEWDATASTART, '')
+        self.ofxAgent.streamToController(self.MODULEID, NEWDATAPART, controlString)
+        self.ofxAgent.streamToController(self.MODULEID, NEWDATAFINISH, '')
 
-            maxsendct = 500
-            start = 0
-            while start<len(flowRecords):             
-                controlString = pickle.dumps(flowRecords[start:start+maxsendct]) 
-                msg = self.ofxAgent.buildModuleMessage(self.MODULEID, NEWDATAPART, controlString)
-                self.ofxAgent.injectToController(msg)
-                start += maxsendct
-            start = 0
-            # while start<len(hostRecords):             
-            #     controlString = pickle.dumps((hostRecords[start:start+maxsendct], []))   
-            #     msg = self.ofxAgent.buildModuleMessage(self.MODULEID, NEWDATAPART, controlString)
-            #     self.ofxAgent.injectToController(msg)
-            #     start += maxsendct
-            msg = self.ofxAgent.buildModuleMessage(self.MODULEID, NEWDATAFINISH, '')
-            self.ofxAgent.injectToController(msg)
-            # wait until the next interval.   
-            time.sleep(interval)
 
-    
     def testThread(self, interval):
         """
         sends a message to the controller, waits interval, repeats.
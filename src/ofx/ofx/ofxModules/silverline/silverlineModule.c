@@ -18,11 +18,13 @@
 
 #define MODULEID 0x20
 
+// message types from the management agent.
+#define ADDFLOWPERMISSION 0x02 // one NewPermissionRequest.
+#define ADDFLOWPERMISSIONS 0x03 // an array of NewPermissionRequests.
+
 int permissionCt = 0;
 struct timeval tv;
 
-double current_time;
-double last_time;
 
 double getMsTime(){
 	gettimeofday(&tv, NULL); // get current time
@@ -160,6 +162,27 @@ struct FlowEntry* buildFlowEntryFromPermission(struct NewPermissionRequest* flow
 	return newFlow;
 }
 
+// Add the permission for a flow, or change the permission of a 
+// flow that's already in the table.
+int setFlowPermission(struct NewPermissionRequest* flowPermission){
+	struct FlowEntry* existingFlow;
+	struct FlowKey key;
+	memset(&key, 0, sizeof(struct FlowKey));
+	key.ip_src = flowPermission->ip_src;
+	key.ip_dst = flowPermission->ip_dst;
+	key.uh_sport = flowPermission->uh_sport;
+	key.uh_dport = flowPermission->uh_dport;
+	HASH_FIND(hh, flow_HT, &key, sizeof(struct FlowKey), existingFlow);
+	if (existingFlow){
+		existingFlow->permission = ntohl(flowPermission->permission);
+		return -1;
+	}
+	struct FlowEntry* newFlow = buildFlowEntryFromPermission(flowPermission);
+	HASH_ADD(hh, flow_HT, key, sizeof(struct FlowKey), newFlow);
+	flowCt += 1;
+	return 1;
+}
+
 // Print out a flow entry.
 int printFlowEntry(struct FlowEntry * flow){
 	char src[32];
@@ -239,16 +262,14 @@ int handle_packet(unsigned char * ethpkt, unsigned char * ippkt, int pktsize){
 			// printf("\ttag on packet: %i\n",packetTag);
 			if (packetTag == retFlow->permission){ 
 				// Add a new rule if you haven't already.
+				// (the switch agent paces the rules and retries them 
+				// until the switch confirms.)
 				if (retFlow->added == 0){
-					current_time = getMsTime();
-					if ((current_time-last_time)>10){
-						printf("adding another flow rule.\n");
-					addIpDscpFlow(retFlow->key.ip_src, retFlow->key.ip_dst,
+					if (addIpDscpFlow(retFlow->key.ip_src, retFlow->key.ip_dst,
 						retFlow->key.uh_sport, retFlow->key.uh_dport,
-						htonl(packetTag));
+						htonl(packetTag))){
+						retFlow->added = 1;
 					}
-					last_time=getMsTime();
-					retFlow->added = 1;
 				}
 				return 1;
 			}
@@ -269,8 +290,6 @@ int handle_packet(unsigned char * ethpkt, unsigned char * ippkt, int pktsize){
 // Nothing to do for startup.
 int module_startup(){
 	printf("runnning data path start up function for silverline module.\n");
-	last_time = 0;
-	current_time = 0;
 	return 1;
 }
 
@@ -284,26 +303,41 @@ struct ofxDpHeader {
 int handle_message(struct ofxDpHeader * msgHeader, unsigned char* msg){
 	struct NewPermissionRequest * newPermission;
 	newPermission = (struct NewPermissionRequest *) msg;
-	// printNewPermissionRequest(newPermission);
-	struct FlowEntry * newFlow = buildFlowEntryFromPermission(newPermission);
-	// printFlowEntry(newFlow);
-	int retval = addFlowEntry(newFlow);
-	if (retval>0){
-		retval=-1;
-		// printf("\tadded flow entry.\n");
+	if (msgHeader->messageType == ADDFLOWPERMISSIONS){
+		// a batch: insert all of them.
+		int count = (msgHeader->len - OFXHEADERLEN) / sizeof(struct NewPermissionRequest);
+		int i;
+		for (i = 0; i < count; i++){
+			setFlowPermission(&newPermission[i]);
+		}
+		permissionCt += count;
+		printf("%i permissions added. (batch of %i)\n", permissionCt, count);
+		return 1;
 	}
-	else{
-		struct FlowEntry * existingFlow = getFlowEntry(newFlow);
-		// printf("\tflow entry already exists. Changing permission: %i -> %i\n",
-		// 	existingFlow->permission, newFlow->permission);	
-		existingFlow->permission = newFlow->permission;
-	} 
+	// printNewPermissionRequest(newPermission);
+	setFlowPermission(newPermission);
 	permissionCt += 1;
 	if (permissionCt % 100 == 0) printf("%i permissions added.\n",permissionCt);
 
 	return 1;
 }
 
+// The agent removed the rule of a flow (it timed out, or was 
+// evicted). Add it again when the flow's next packet comes.
+void handle_flow_demoted(struct in_addr ip_src, struct in_addr ip_dst, 
+	u_short sport, u_short dport, uint64_t packetCt, uint64_t byteCt){
+	struct FlowEntry reqFlow;
+	memset(&reqFlow, 0, sizeof(reqFlow));
+	reqFlow.key.ip_src = ip_src;
+	reqFlow.key.ip_dst = ip_dst;
+	reqFlow.key.uh_sport = sport;
+	reqFlow.key.uh_dport = dport;
+	struct FlowEntry* flow = getFlowEntry(&reqFlow);
+	if (flow != NULL){
+		flow->added = 0;
+	}
+}
+
 void error(char *msg)
 {
     perror(msg);
@@ -14,6 +14,13 @@ dependencies = ['uthash.h']
 # message type definitions for this module. 
 ENABLEDECLASSIFIER = 0x01 # enable the declassifier.
 ADDFLOWPERMISSION = 0x02 # enable permissions for the flow.
+ADDFLOWPERMISSIONS = 0x03 # enable permissions for many flows.
+# a permission: | src ip (4) | dst ip (4) | src port (2) | dst port (2) | 
+# permission (4) | (struct NewPermissionRequest in the datapath.)
+permissionLen = 16
+# permissions per message to the datapath component. (its receive 
+# buffer is 640kB.)
+maxDpBatch = 32768
 
 dataPathPort = 44444 # port that the dp agent listens on.
 
@@ -49,7 +56,20 @@ class ControllerComponent(object):
         data = flowPermissionBin
         msg = self.ofxSys.buildModuleMessage(self.MODULEID, ADDFLOWPERMISSION, data)
         sendToSwitch(msg)
-    def handleModuleMessage(self, data, datapathSendFcn):
+    def addFlowPermissions(self, sendToSwitch, flowPermissionBins):
+        """
+        Adds many flow permissions to a switch, in one message.
+        flowPermissionBins is a list of 16 byte permissions (as for 
+        addFlowPermission), or a string of them back to back.
+        """
+        if not isinstance(flowPermissionBins, (bytes, bytearray)):
+            flowPermissionBins = b''.join(flowPermissionBins)
+        count = len(flowPermissionBins) // permissionLen
+        self.permissionCt += count
+        print ("%s permissions added (in OFX controller component)"%self.permissionCt)
+        self.ofxSys.streamToSwitch(sendToSwitch, self.MODULEID, \
+            ADDFLOWPERMISSIONS, flowPermissionBins)
+    def handleModuleMessage(self, data, datapathSendFcn, datapathId=None):
         """
         handle message from the switch.
         """
@@ -99,6 +119,8 @@ class SwitchComponent(object):
             self.enableDeclassifier()
         elif messageType == ADDFLOWPERMISSION:
             self.addFlowPermission(content)
+        elif messageType == ADDFLOWPERMISSIONS:
+            self.addFlowPermissions(content)
 
     def enableDeclassifier(self):
         """
@@ -129,4 +151,19 @@ class SwitchComponent(object):
             print ("%s permissions added (in OFX manager) (%s sec)"%(self.permissionCt, compTime))
         self.ofxAgent.sendToDp(self.MODULEID, ADDFLOWPERMISSION, msgContent)
 
+    def addFlowPermissions(self, msgContent):
+        """
+        add permissions for many flows. 
+        (forward them to the data path component, in batches.)
+        """
+        count = len(msgContent) // permissionLen
+        self.permissionCt += count
+        compTime = time.time() - self.time
+        self.time = time.time()
+        print ("%s permissions added (in OFX manager) (%s sec)"%(self.permissionCt, compTime))
+        batchLen = maxDpBatch * permissionLen
+        for start in range(0, count * permissionLen, batchLen):
+            self.ofxAgent.sendToDp(self.MODULEID, ADDFLOWPERMISSIONS, \
+                msgContent[start:start+batchLen])
+
 
@@ -0,0 +1,233 @@
+"""
+Per flow counter time series, for modules that compute rates
+from flow statistics.
+"""
+import time, threading
+import numpy as np
+
+
+class FlowCounterStore(object):
+    """
+    The last ringSize samples of a counter (e.g. byte count) of many
+    flows, from one or more sources (the ASIC flow table and the
+    datapath agent, by default), side by side.
+    Each source's samples are one array, flows x ringSize, with one
+    row per flow and a ring of sample columns. update() writes one
+    column for every flow at once: flows that aren't in a sample
+    keep their last value. Rates, windowed sums and EWMA rates are
+    computed over whole columns, per flow (an array indexed by row,
+    see keys) or summed over the flows (total=True). With no
+    source, queries add up the sources.
+    Counters that go down (a flow was re-added) count as no change.
+    A flow's counts can be moved from one source to another (e.g.
+    when the datapath takes over a flow, and adds what the ASIC
+    counted to its own counter) by rebasing them: see rebase.
+    A flow whose counters haven't moved in any source for expireAfter
+    samples of each source loses its row (the other rows are moved
+    down to fill the gap), so the arrays only hold the live flows.
+    Its last counts are kept, and are its starting point if it comes
+    back, so its old counts aren't counted again.
+    Safe to use from several threads (e.g. one per source).
+    """
+    def __init__(self, sources=('asic', 'dp'), ringSize=8, capacity=1024, \
+        alpha=0.5, expireAfter=32):
+        self.sources = list(sources)
+        self.sourceIdx = dict((name, i) for i, name in enumerate(self.sources))
+        # ring of samples per source.
+        self.ringSize = ringSize
+        # EWMA weight of the newest rate.
+        self.alpha = alpha
+        # (rows that changed within the ring are never expired.)
+        self.expireAfter = max(expireAfter, ringSize)
+        # flow key -> row, and row -> flow key.
+        self.flowRows = {}
+        self.keys = []
+        self.counters = np.zeros((len(self.sources), capacity, ringSize))
+        self.ewma = np.zeros((len(self.sources), capacity))
+        # added to each flow's counts, per source.
+        self.baselines = np.zeros((len(self.sources), capacity))
+        # how many samples of each source each flow has been flat for.
+        self.flatCounts = np.zeros((len(self.sources), capacity), \
+            dtype=np.intp)
+        # expired flow key -> (last counts, baselines), per source.
+        self.expired = {}
+        self.times = np.zeros((len(self.sources), ringSize))
+        self.sampleCounts = [0] * len(self.sources)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def rows(self, keys):
+        """
+        the row of each flow in keys. New flows get a row.
+        """
+        rows = np.empty(len(keys), dtype=np.intp)
+        flowRows = self.flowRows
+        for i, key in enumerate(keys):
+            row = flowRows.get(key)
+            if row is None:
+                row = self.addFlow(key)
+            rows[i] = row
+        return rows
+
+    def addFlow(self, key):
+        row = len(self.keys)
+        if row == self.counters.shape[1]:
+            # out of rows: double the capacity.
+            self.counters = np.concatenate(\
+                (self.counters, np.zeros_like(self.counters)), axis=1)
+            self.ewma = np.concatenate(\
+                (self.ewma, np.zeros_like(self.ewma)), axis=1)
+            self.baselines = np.concatenate(\
+                (self.baselines, np.zeros_like(self.baselines)), axis=1)
+            self.flatCounts = np.concatenate(\
+                (self.flatCounts, np.zeros_like(self.flatCounts)), axis=1)
+        expired = self.expired.pop(key, None)
+        if expired is not None:
+            lastCounts, baselines = expired
+            self.counters[:, row, :] = lastCounts[:, None]
+            self.baselines[:, row] = baselines
+        self.flowRows[key] = row
+        self.keys.append(key)
+        return row
+
+    def expire(self):
+        """
+        drop the rows of the flows that have been flat for 
+        expireAfter samples of every source.
+        """
+        n = len(self.keys)
+        flat = (self.flatCounts[:, :n] >= self.expireAfter).all(axis=0)
+        if not flat.any():
+            return
+        last = np.zeros((len(self.sources), n))
+        for s, sampleCount in enumerate(self.sampleCounts):
+            if sampleCount:
+                last[s] = self.counters[s, :n, (sampleCount - 1) % self.ringSize]
+        for row in np.flatnonzero(flat).tolist():
+            self.expired[self.keys[row]] = \
+                (last[:, row].copy(), self.baselines[:, row].copy())
+        live = np.flatnonzero(~flat)
+        m = len(live)
+        for array in (self.counters, self.ewma, self.baselines, \
+            self.flatCounts):
+            array[:, :m] = array[:, live]
+            array[:, m:n] = 0
+        self.keys = [self.keys[row] for row in live.tolist()]
+        self.flowRows = dict((key, row) for row, key in enumerate(self.keys))
+
+    def update(self, source, keys, counts, now=None):
+        """
+        add a sample of source's counters: counts[i] is the
+        counter of flow keys[i].
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.addSample(self.sourceIdx[source], keys, counts, now)
+
+    def addSample(self, s, keys, counts, now):
+        rows = self.rows(keys)
+        n = len(self.keys)
+        samples = self.counters[s]
+        sampleCount = self.sampleCounts[s]
+        cur = sampleCount % self.ringSize
+        if sampleCount:
+            prev = (sampleCount - 1) % self.ringSize
+            samples[:n, cur] = samples[:n, prev]
+        samples[rows, cur] = counts + self.baselines[s, rows]
+        if sampleCount:
+            flatCounts = self.flatCounts[s, :n]
+            flatCounts += 1
+            flatCounts[samples[:n, cur] != samples[:n, prev]] = 0
+            dt = now - self.times[s, prev]
+            if dt > 0:
+                rate = np.maximum(samples[:n, cur] - samples[:n, prev], 0) / dt
+                self.ewma[s, :n] = self.alpha * rate \
+                    + (1 - self.alpha) * self.ewma[s, :n]
+        self.times[s, cur] = now
+        self.sampleCounts[s] = sampleCount + 1
+        self.expire()
+
+    def latest(self, source, keys):
+        """
+        the last sample of source's counter of each flow in keys 
+        (0 for flows it has no sample of).
+        """
+        with self.lock:
+            s = self.sourceIdx[source]
+            rows = self.rows(keys)
+            if not self.sampleCounts[s]:
+                return np.zeros(len(keys))
+            cur = (self.sampleCounts[s] - 1) % self.ringSize
+            return self.counters[s, rows, cur]
+
+    def rebase(self, source, keys, baselines):
+        """
+        add baselines[i] to source's later samples of flow keys[i], 
+        instead of what was added to them so far. 
+        """
+        with self.lock:
+            rows = self.rows(keys)
+            self.baselines[self.sourceIdx[source], rows] = baselines
+
+    def sourceIndices(self, source):
+        if source is None:
+            return range(len(self.sources))
+        return [self.sourceIdx[source]]
+
+    def delta(self, s, window):
+        """
+        each flow's counter change over the last window samples of
+        source s, and the time they span.
+        """
+        sampleCount = self.sampleCounts[s]
+        window = min(window, sampleCount - 1, self.ringSize - 1)
+        n = len(self.keys)
+        if window < 1:
+            return np.zeros(n), 0.0
+        cur = (sampleCount - 1) % self.ringSize
+        old = (sampleCount - 1 - window) % self.ringSize
+        samples = self.counters[s]
+        change = np.maximum(samples[:n, cur] - samples[:n, old], 0)
+        return change, self.times[s, cur] - self.times[s, old]
+
+    def windowSum(self, window=1, source=None, total=False):
+        """
+        how much each flow's counter grew over the last window samples.
+        """
+        with self.lock:
+            result = np.zeros(len(self.keys))
+            for s in self.sourceIndices(source):
+                change, dt = self.delta(s, window)
+                result += change
+        if total:
+            return float(result.sum())
+        return result
+
+    def rate(self, window=1, source=None, total=False):
+        """
+        each flow's counter rate (per second) over the last window samples.
+        """
+        with self.lock:
+            result = np.zeros(len(self.keys))
+            for s in self.sourceIndices(source):
+                change, dt = self.delta(s, window)
+                if dt > 0:
+                    result += change / dt
+        if total:
+            return float(result.sum())
+        return result
+
+    def ewmaRate(self, source=None, total=False):
+        """
+        each flow's exponentially weighted moving average rate.
+        """
+        with self.lock:
+            result = np.zeros(len(self.keys))
+            for s in self.sourceIndices(source):
+                result += self.ewma[s, :len(self.keys)]
+        if total:
+            return float(result.sum())
+        return result
@@ -0,0 +1,340 @@
+"""
+Paced installation of the flow mods that the agent sends for modules.
+Flow mods wait in one queue per priority class, and are sent in
+batches, as a token bucket allows. Each batch is followed by a
+barrier. A mod is installed once the barrier's reply comes back
+without an error for it. If the barrier fails (timeout, lost
+connection), the batch's mods are queued again, until a barrier
+confirms them. Once the connection to the switch is closed, the
+queued mods and the ones submitted later fail.
+The bucket's rate adapts to the switch: it goes up a step for every
+batch that the switch confirms quickly, and is halved when a barrier
+is slow or fails (AIMD).
+A flow mod for the same table, priority and match as the last
+queued one, and of the same kind (ADD or MODIFY_STRICT, or
+DELETE_STRICT), replaces it, so repeated requests for a flow only go
+to the switch once. An add and a delete of a flow are both sent, in
+the order they were submitted. Mods that are retried go to the front
+of their queue, ahead of later mods for the same flows.
+The scheduler runs in the proxy's event loop. Mods can be submitted
+from any thread.
+"""
+from __future__ import print_function
+import struct, threading, time
+from collections import deque
+
+# priority classes. Lower classes are sent first.
+FLOWMOD_URGENT = 0
+FLOWMOD_NORMAL = 1
+FLOWMOD_BULK = 2
+NUM_FLOWMOD_CLASSES = 3
+
+OFPT_ERROR = 1
+OFPFC_ADD = 0
+OFPFC_MODIFY_STRICT = 2
+OFPFC_DELETE_STRICT = 4
+OFPET_FLOW_MOD_FAILED = 5
+OFPFMFC_TABLE_FULL = 1
+
+# ofp_flow_mod offsets.
+tableIdIdx = 24
+commandIdx = 25
+priorityIdx = 30
+matchIdx = 48
+
+
+def flowModKey(data):
+    """
+    (table id, priority, match) of a flow mod that names exactly one
+    flow, or None.
+    """
+    data = bytes(data)
+    if len(data) < matchIdx + 4:
+        return None
+    command = struct.unpack_from("!B", data, commandIdx)[0]
+    if command not in (OFPFC_ADD, OFPFC_MODIFY_STRICT, OFPFC_DELETE_STRICT):
+        return None
+    tableId = struct.unpack_from("!B", data, tableIdIdx)[0]
+    priority = struct.unpack_from("!H", data, priorityIdx)[0]
+    matchLen = struct.unpack_from("!H", data, matchIdx + 2)[0]
+    return (tableId, priority, data[matchIdx:matchIdx+matchLen])
+
+def isDelete(data):
+    return struct.unpack_from("!B", bytes(data), commandIdx)[0] \
+        == OFPFC_DELETE_STRICT
+
+def errorCodes(error):
+    """
+    (type, code) of an OpenFlow error message, or None if the
+    request failed some other way.
+    """
+    if isinstance(error, bytes) and len(error) >= 12:
+        return struct.unpack_from("!HH", error, 8)
+    return None
+
+
+class FlowMod(object):
+    def __init__(self, data, moduleId, key, flowKey, callback):
+        self.data = data
+        self.moduleId = moduleId
+        # the mod's own key, and its flow's key (or None).
+        self.key = key
+        self.flowKey = flowKey
+        # callback(installed, error) of each submission.
+        self.callbacks = [callback] if callback is not None else []
+        self.tries = 0
+        # the OFRequest of the last try.
+        self.request = None
+
+
+class FlowModScheduler(object):
+    """
+    Installs flow mods for one switch.
+    requestFcn(data, callback, timeout) sends a request to the switch
+    and returns its OFRequest. barrierFcn(callback, timeout) sends a
+    barrier. cancelFcn(request) drops a request that won't get a
+    reply. loop is the proxy's event loop.
+    """
+    # flow mods per second: initial, floor and ceiling.
+    minRate = 10
+    maxRate = 5000
+    # added to the rate for every confirmed batch.
+    rateStep = 10
+    # a slower barrier reply means the switch is falling behind.
+    slowBarrier = 0.5
+    barrierTimeout = 5.0
+    # wait after a failed barrier.
+    retryDelay = 1.0
+    maxBatch = 64
+    maxBatchesInFlight = 4
+
+    def __init__(self, requestFcn, barrierFcn, cancelFcn, loop, \
+        printfcn=None, rate=100):
+        self.requestFcn = requestFcn
+        self.barrierFcn = barrierFcn
+        self.cancelFcn = cancelFcn
+        self.loop = loop
+        self.dprint = printfcn
+        if self.dprint is None:
+            self.dprint = print
+        self.rate = float(rate)
+        self.tokens = float(self.maxBatch)
+        self.lastRefill = time.time()
+        # keys of the queued mods, by class, and the mods, by key.
+        self.queues = [deque() for c in range(NUM_FLOWMOD_CLASSES)]
+        self.queued = {}
+        self.nextKey = 0
+        # the key of the last mod queued for each flow.
+        self.latest = {}
+        # the class of each module's mods.
+        self.moduleClasses = {}
+        # batches waiting for their barrier.
+        self.inFlight = 0
+        self.pumpScheduled = False
+        self.retryAt = 0
+        self.installed = 0
+        self.failed = 0
+        self.retried = 0
+        # why the switch can't take mods any more, once it can't.
+        self.closed = None
+        self.lock = threading.Lock()
+
+    def setClass(self, moduleId, flowModClass):
+        with self.lock:
+            self.moduleClasses[moduleId] = flowModClass
+
+    def submit(self, data, moduleId, callback=None):
+        """
+        queue a flow mod for a module. callback(installed, error), if
+        any, is called in the loop thread once the switch has
+        installed it (installed = True), or refused it (error is the
+        OpenFlow error message).
+        """
+        flowKey = flowModKey(data)
+        with self.lock:
+            if self.closed is not None:
+                if callback is not None:
+                    self.loop.callFromThread(callback, False, self.closed)
+                return
+            mod = self.queued.get(self.latest.get(flowKey))
+            if mod is not None and isDelete(mod.data) == isDelete(data):
+                callbacks = mod.callbacks
+                if callback is not None:
+                    callbacks.append(callback)
+                if self.modClass(moduleId) == self.modClass(mod.moduleId):
+                    # the newer mod wins, in the older one's place.
+                    mod.data = data
+                    mod.moduleId = moduleId
+                else:
+                    # it wins, in its own class's queue. (pump skips 
+                    # the older one's key.)
+                    del self.queued[mod.key]
+                    mod = FlowMod(data, moduleId, self.nextKey, flowKey, None)
+                    mod.callbacks = callbacks
+                    self.nextKey += 1
+                    self.enqueue(mod, False)
+            else:
+                mod = FlowMod(data, moduleId, self.nextKey, flowKey, callback)
+                self.nextKey += 1
+                self.enqueue(mod, False)
+            self.schedulePump(0)
+
+    def enqueue(self, mod, retry):
+        """
+        queue a new mod at the back of its class's queue, or a 
+        retried one at the front. (call with lock held.)
+        """
+        latestKey = self.latest.get(mod.flowKey)
+        if retry and latestKey is not None:
+            existing = self.queued.get(latestKey)
+            if existing is not None and isDelete(existing.data) \
+                == isDelete(mod.data):
+                # a newer mod of the same kind for the flow arrived 
+                # during the last try.
+                existing.callbacks = mod.callbacks + existing.callbacks
+                return
+        elif mod.flowKey is not None:
+            self.latest[mod.flowKey] = mod.key
+        self.queued[mod.key] = mod
+        flowModClass = self.modClass(mod.moduleId)
+        if retry:
+            self.queues[flowModClass].appendleft(mod.key)
+        else:
+            self.queues[flowModClass].append(mod.key)
+
+    def modClass(self, moduleId):
+        return self.moduleClasses.get(moduleId, FLOWMOD_NORMAL)
+
+    def schedulePump(self, delay):
+        """
+        (call with lock held.)
+        """
+        if self.pumpScheduled:
+            return
+        self.pumpScheduled = True
+        if delay > 0:
+            self.loop.callLater(delay, self.pump)
+        else:
+            self.loop.callFromThread(self.pump)
+
+    def pump(self):
+        """
+        send a batch, if the bucket has tokens. (loop thread)
+        """
+        with self.lock:
+            self.pumpScheduled = False
+            if self.closed is not None or not self.queued \
+                or self.inFlight >= self.maxBatchesInFlight:
+                return
+            now = time.time()
+            if now < self.retryAt:
+                self.schedulePump(self.retryAt - now)
+                return
+            self.tokens = min(self.maxBatch, \
+                self.tokens + (now - self.lastRefill) * self.rate)
+            self.lastRefill = now
+            if self.tokens < 1:
+                self.schedulePump((1 - self.tokens) / self.rate)
+                return
+            batch = []
+            for queue in self.queues:
+                while queue and len(batch) < self.tokens:
+                    mod = self.queued.pop(queue.popleft(), None)
+                    if mod is None:
+                        # (it moved to another class's queue.)
+                        continue
+                    if self.latest.get(mod.flowKey) == mod.key:
+                        del self.latest[mod.flowKey]
+                    batch.append(mod)
+            self.tokens -= len(batch)
+            self.inFlight += 1
+        for mod in batch:
+            mod.tries += 1
+            mod.request = self.requestFcn(mod.data, None, self.barrierTimeout*2)
+        sentAt = time.time()
+        self.barrierFcn(lambda request: self.barrierDone(request, batch, \
+            sentAt), self.barrierTimeout)
+        with self.lock:
+            if self.queued:
+                self.schedulePump(0)
+
+    def barrierDone(self, barrier, batch, sentAt):
+        """
+        the switch has processed the batch, or the barrier failed.
+        (loop thread)
+        """
+        delay = time.time() - sentAt
+        confirmed = barrier.error is None
+        done = []
+        retries = []
+        with self.lock:
+            self.inFlight -= 1
+            for mod in batch:
+                request = mod.request
+                if request.done() and request.error is not None \
+                    and errorCodes(request.error) is not None:
+                    # the switch refused it.
+                    self.failed += 1
+                    done.append((mod, False, request.error))
+                    continue
+                self.cancelFcn(request)
+                if confirmed:
+                    self.installed += 1
+                    done.append((mod, True, None))
+                elif self.closed is not None:
+                    self.failed += 1
+                    done.append((mod, False, self.closed))
+                else:
+                    self.retried += 1
+                    retries.append(mod)
+            # (to the front, in the batch's order.)
+            for mod in reversed(retries):
+                self.enqueue(mod, True)
+            if confirmed and delay < self.slowBarrier:
+                self.rate = min(self.maxRate, self.rate + self.rateStep)
+            else:
+                self.rate = max(self.minRate, self.rate / 2)
+                self.tokens = min(self.tokens, 0)
+            if not confirmed and self.closed is None:
+                self.dprint("flow mod barrier failed (%s), retrying %s mods. (rate: %s/s)"\
+                    %(barrier.error, len(batch) - len(done), self.rate))
+                self.retryAt = time.time() + self.retryDelay
+            if self.queued:
+                self.schedulePump(0)
+        for mod, installed, error in done:
+            if not installed and errorCodes(error) == \
+                (OFPET_FLOW_MOD_FAILED, OFPFMFC_TABLE_FULL):
+                self.dprint("flow table full, flow mod for module %s dropped."\
+                    %mod.moduleId)
+            for callback in mod.callbacks:
+                callback(installed, error)
+
+    def close(self, reason="connection closed"):
+        """
+        the connection to the switch closed: the queued mods, the 
+        ones waiting for a barrier and the ones submitted from now 
+        on fail with error reason.
+        """
+        with self.lock:
+            if self.closed is not None:
+                return
+            self.closed = reason
+            mods = list(self.queued.values())
+            self.queued.clear()
+            self.latest.clear()
+            for queue in self.queues:
+                queue.clear()
+            self.failed += len(mods)
+        if mods:
+            self.dprint("switch connection closed, %s flow mods dropped."\
+                %len(mods))
+        for mod in mods:
+            for callback in mod.callbacks:
+                callback(False, reason)
+
+    def pending(self):
+        """
+        how many flow mods are queued.
+        """
+        with self.lock:
+            return len(self.queued)
@@ -0,0 +1,267 @@
+"""
+OpenFlow 1.3 flow mods compiled from a match and instruction spec.
+A FlowModTemplate builds the whole message once: header, OXM match
+and instructions. Match fields with a value are constants. Fields
+whose value is None are parameters: each fill() packs the cookie and
+the parameters into a copy of the compiled message, at precomputed
+offsets, so a flow mod of any match shape costs a few pack_into
+calls.
+Each thread fills its own copy, so the dp socket thread and module
+threads can build flow mods from the same template at once.
+Example:
+    udpFlow = FlowModTemplate([('eth_type', 0x0800), ('ip_proto', 17),
+        ('ipv4_src', None), ('ipv4_dst', None)], [gotoTable(1)],
+        priority=10)
+    data = udpFlow.build(cookie, '10.0.0.1', '10.0.0.2')
+Modules describe flows with ovs-ofctl style match patterns
+("priority=1, dl_type=0x0800, ip_proto=17"). parseMatchPattern turns
+one into a match spec and the flow mod's arguments.
+"""
+import copy, socket, struct, threading
+
+OFP_VERSION = 0x04
+OFPT_FLOW_MOD = 14
+OFPFC_ADD = 0
+OFPFC_MODIFY = 1
+OFPFC_MODIFY_STRICT = 2
+OFPFC_DELETE = 3
+OFPFC_DELETE_STRICT = 4
+OFPFF_SEND_FLOW_REM = 1
+OFP_NO_BUFFER = 0xffffffff
+OFPP_IN_PORT = 0xfffffff8
+OFPP_FLOOD = 0xfffffffb
+OFPP_CONTROLLER = 0xfffffffd
+OFPP_ANY = 0xffffffff
+OFPG_ANY = 0xffffffff
+OFPCML_NO_BUFFER = 0xffff
+OFPMT_OXM = 1
+OFPXMC_OPENFLOW_BASIC = 0x8000
+
+# ofp_flow_mod, up to the match.
+flowModHeader = struct.Struct("!BBHIQQBBHHHIIIH2x")
+matchHeader = struct.Struct("!HH")
+oxmHeader = struct.Struct("!HBB")
+cookieStruct = struct.Struct("!Q")
+cookieIdx = 8
+timeoutsStruct = struct.Struct("!HH")
+timeoutsIdx = 26
+
+
+def ipv4Bytes(value):
+    """
+    an address as 4 bytes, from a dotted quad string or an int.
+    """
+    if isinstance(value, str):
+        return socket.inet_aton(value)
+    return struct.pack("!I", value)
+
+def macBytes(value):
+    """
+    an ethernet address as 6 bytes, from "aa:bb:cc:dd:ee:ff" or bytes.
+    """
+    if len(value) == 6:
+        return bytes(value)
+    return bytes(bytearray(int(b, 16) for b in value.split(":")))
+
+# OXM fields: name -> (field code, struct format, value conversion).
+oxmFields = {
+    'in_port': (0, 'I', None),
+    'metadata': (2, 'Q', None),
+    'eth_dst': (3, '6s', macBytes),
+    'eth_src': (4, '6s', macBytes),
+    'eth_type': (5, 'H', None),
+    'vlan_vid': (6, 'H', None),
+    'vlan_pcp': (7, 'B', None),
+    'ip_dscp': (8, 'B', None),
+    'ip_ecn': (9, 'B', None),
+    'ip_proto': (10, 'B', None),
+    'ipv4_src': (11, '4s', ipv4Bytes),
+    'ipv4_dst': (12, '4s', ipv4Bytes),
+    'tcp_src': (13, 'H', None),
+    'tcp_dst': (14, 'H', None),
+    'udp_src': (15, 'H', None),
+    'udp_dst': (16, 'H', None),
+    'icmpv4_type': (19, 'B', None),
+    'icmpv4_code': (20, 'B', None),
+    'arp_op': (21, 'H', None),
+    'mpls_label': (34, 'I', None),
+    'mpls_tc': (35, 'B', None),
+}
+
+# ovs-ofctl match field names -> OXM field names. (tp_src and tp_dst
+# depend on the ip protocol.)
+ofctlFields = {
+    'in_port': 'in_port',
+    'dl_src': 'eth_src', 'eth_src': 'eth_src',
+    'dl_dst': 'eth_dst', 'eth_dst': 'eth_dst',
+    'dl_type': 'eth_type', 'eth_type': 'eth_type',
+    'dl_vlan': 'vlan_vid', 'dl_vlan_pcp': 'vlan_pcp', 'vlan_pcp': 'vlan_pcp',
+    'nw_proto': 'ip_proto', 'ip_proto': 'ip_proto',
+    'nw_src': 'ipv4_src', 'ip_src': 'ipv4_src', 'ipv4_src': 'ipv4_src',
+    'nw_dst': 'ipv4_dst', 'ip_dst': 'ipv4_dst', 'ipv4_dst': 'ipv4_dst',
+    'ip_dscp': 'ip_dscp', 'nw_ecn': 'ip_ecn', 'ip_ecn': 'ip_ecn',
+    'tcp_src': 'tcp_src', 'tcp_dst': 'tcp_dst',
+    'udp_src': 'udp_src', 'udp_dst': 'udp_dst',
+    'icmp_type': 'icmpv4_type', 'icmp_code': 'icmpv4_code',
+    'arp_op': 'arp_op', 'mpls_label': 'mpls_label',
+}
+# ovs-ofctl protocol shorthands.
+ofctlProtocols = {
+    'ip': {'eth_type': 0x0800},
+    'icmp': {'eth_type': 0x0800, 'ip_proto': 1},
+    'tcp': {'eth_type': 0x0800, 'ip_proto': 6},
+    'udp': {'eth_type': 0x0800, 'ip_proto': 17},
+    'arp': {'eth_type': 0x0806},
+}
+# ovs-ofctl flow arguments -> FlowModTemplate arguments.
+ofctlArgs = {'priority': 'priority', 'table': 'tableId', \
+    'idle_timeout': 'idleTimeout', 'hard_timeout': 'hardTimeout'}
+OFPVID_PRESENT = 0x1000
+
+def parseMatchPattern(pattern):
+    """
+    the match spec and FlowModTemplate keyword arguments (priority, 
+    tableId, timeouts) of an ovs-ofctl style match pattern. Fields 
+    are ordered by OXM field code, so prerequisites come first.
+    """
+    fields = {}
+    args = {}
+    for item in pattern.replace(",", " ").split():
+        name, sep, value = item.partition("=")
+        if not sep:
+            if name not in ofctlProtocols:
+                raise ValueError("unknown protocol %s"%name)
+            fields.update(ofctlProtocols[name])
+        elif name in ofctlArgs:
+            args[ofctlArgs[name]] = int(value, 0)
+        elif name in ('tp_src', 'tp_dst'):
+            fields[name] = int(value, 0)
+        elif name == 'nw_tos':
+            fields['ip_dscp'] = int(value, 0) >> 2
+        elif name in ofctlFields:
+            field = ofctlFields[name]
+            if oxmFields[field][2] is None:
+                value = int(value, 0)
+            if field == 'vlan_vid':
+                value |= OFPVID_PRESENT
+            fields[field] = value
+        else:
+            raise ValueError("unknown match field %s"%name)
+    for name in ('tp_src', 'tp_dst'):
+        if name in fields:
+            protocol = {6: 'tcp', 17: 'udp'}.get(fields.get('ip_proto'))
+            if protocol is None:
+                raise ValueError("%s needs tcp or udp"%name)
+            fields[protocol + name[2:]] = fields.pop(name)
+    match = sorted(fields.items(), key=lambda field: oxmFields[field[0]][0])
+    return match, args
+
+#### instructions and actions ####
+def gotoTable(tableId):
+    return struct.pack("!HHB3x", 1, 8, tableId)
+
+def writeActions(actions):
+    actions = b''.join(actions)
+    return struct.pack("!HH4x", 3, 8 + len(actions)) + actions
+
+def applyActions(actions):
+    actions = b''.join(actions)
+    return struct.pack("!HH4x", 4, 8 + len(actions)) + actions
+
+def clearActions():
+    return struct.pack("!HH4x", 5, 8)
+
+def outputAction(port, maxLen=OFPCML_NO_BUFFER):
+    return struct.pack("!HHIH6x", 0, 16, port, maxLen)
+
+def pushMplsAction(ethType=0x8847):
+    return struct.pack("!HHH2x", 19, 8, ethType)
+
+def popMplsAction(ethType=0x0800):
+    return struct.pack("!HHH2x", 20, 8, ethType)
+
+def groupAction(groupId):
+    return struct.pack("!HHI", 22, 8, groupId)
+
+
+class FlowModTemplate(object):
+    def __init__(self, match, instructions, priority=0, tableId=0, \
+        command=OFPFC_ADD, idleTimeout=0, hardTimeout=0, flags=0, \
+        cookieMask=0):
+        """
+        match is a list of (OXM field name, value) tuples, in the
+        order they go in the message. A value of None makes the
+        field a parameter. instructions is a list of packed
+        instructions (gotoTable, applyActions, ...).
+        """
+        # (offset, struct, conversion) of each parameter.
+        self.params = []
+        self.paramNames = []
+        oxms = []
+        offset = flowModHeader.size + matchHeader.size
+        for name, value in match:
+            if name not in oxmFields:
+                raise ValueError("unknown match field %s"%name)
+            fieldCode, fmt, convert = oxmFields[name]
+            fieldStruct = struct.Struct("!" + fmt)
+            oxm = oxmHeader.pack(OFPXMC_OPENFLOW_BASIC, fieldCode << 1, \
+                fieldStruct.size)
+            if value is None:
+                self.params.append((offset + oxmHeader.size, fieldStruct, \
+                    convert))
+                self.paramNames.append(name)
+                oxm += b'\0' * fieldStruct.size
+            else:
+                if convert is not None:
+                    value = convert(value)
+                oxm += fieldStruct.pack(value)
+            oxms.append(oxm)
+            offset += len(oxm)
+        oxms = b''.join(oxms)
+        matchLen = matchHeader.size + len(oxms)
+        matchBin = matchHeader.pack(OFPMT_OXM, matchLen) + oxms \
+            + b'\0' * ((8 - matchLen % 8) % 8)
+        instructionBin = b''.join(instructions)
+        length = flowModHeader.size + len(matchBin) + len(instructionBin)
+        header = flowModHeader.pack(OFP_VERSION, OFPT_FLOW_MOD, length, 0, \
+            0, cookieMask, tableId, command, idleTimeout, hardTimeout, \
+            priority, OFP_NO_BUFFER, OFPP_ANY, OFPG_ANY, flags)
+        self.prototype = header + matchBin + instructionBin
+        self.buffers = threading.local()
+
+    def retimed(self, idleTimeout, hardTimeout):
+        """
+        a copy of the template, with other timeouts.
+        """
+        template = copy.copy(self)
+        prototype = bytearray(self.prototype)
+        timeoutsStruct.pack_into(prototype, timeoutsIdx, idleTimeout, \
+            hardTimeout)
+        template.prototype = bytes(prototype)
+        template.buffers = threading.local()
+        return template
+
+    def fill(self, cookie, *values):
+        """
+        the flow mod with the cookie and the parameters, in match
+        order. Returns this thread's buffer, which the thread's next
+        fill overwrites: send it, or copy it (build).
+        """
+        if len(values) != len(self.params):
+            raise ValueError("expected %s parameters (%s), got %s"\
+                %(len(self.params), ", ".join(self.paramNames), len(values)))
+        buf = getattr(self.buffers, 'buf', None)
+        if buf is None:
+            buf = self.buffers.buf = bytearray(self.prototype)
+        cookieStruct.pack_into(buf, cookieIdx, cookie)
+        for (offset, fieldStruct, convert), value in zip(self.params, values):
+            if convert is not None:
+                value = convert(value)
+            fieldStruct.pack_into(buf, offset, value)
+        return buf
+
+    def build(self, cookie, *values):
+        """
+        a copy of the filled flow mod, to keep or queue.
+        """
+        return bytes(self.fill(cookie, *values))
@@ -0,0 +1,142 @@
+"""
+The rules that the agent knows are in the switch's flow tables, so
+redundant flow mods from modules are dropped before they reach the
+switch.
+A rule is keyed by its table, priority and match, in the canonical
+form of ruleOccupancy.ruleKey: the switch can send a match back in
+another field order than it was installed with. An add is redundant
+if an entry for its key has the same cookie, timeouts, flags and
+instructions.
+Entries come from the flow mods the agent sends for modules, as they
+are sent, and from the controller's flow mods that pass through the
+agent. Entries are removed when:
+- the switch refuses the flow mod;
+- a flow removed message or a strict modify or delete names the rule;
+- a non-strict modify or delete hits the entry's table. These can hit
+  any rule, so the whole table is forgotten.
+Only rules that can't disappear unseen are kept: no hard timeout,
+and no idle timeout unless the switch reports the removal
+(OFPFF_SEND_FLOW_REM).
+"""
+import struct, threading
+from collections import deque
+
+from ofProxyCore import copyBytes
+from flowModScheduler import errorCodes, OFPET_FLOW_MOD_FAILED
+from ruleOccupancy import flowModRuleKey, flowRemovedKey
+from flowModTemplate import OFPFC_ADD, OFPFC_MODIFY, OFPFC_MODIFY_STRICT
+from flowModTemplate import OFPFC_DELETE, OFPFC_DELETE_STRICT
+from flowModTemplate import OFPFF_SEND_FLOW_REM
+
+OFPTT_ALL = 0xff
+
+# ofp_flow_mod: table id, command, idle timeout, hard timeout, and flags.
+flowModFields = struct.Struct("!BBHH")
+flowModFieldsIdx = 24
+flowModFlagsIdx = 44
+
+
+class FlowShadowTable(object):
+    # controller flow mods whose errors can still come back.
+    maxTrackedXids = 4096
+
+    def __init__(self):
+        # key -> the rest of the flow mod, from the cookie on.
+        self.entries = {}
+        # xid -> (key, body) of the last controller adds.
+        self.controllerAdds = {}
+        self.controllerXids = deque()
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def install(self, data):
+        """
+        a module's flow mod is about to be sent. Returns False if it
+        adds a rule that is already there, so it can be dropped.
+        Otherwise, updates the table and returns True.
+        """
+        data = copyBytes(data)
+        with self.lock:
+            return self.apply(data)
+
+    def refused(self, data):
+        """
+        the switch refused a flow mod from install.
+        """
+        data = copyBytes(data)
+        self.forget(flowModRuleKey(data), data[8:])
+
+    def controllerFlowMod(self, data):
+        """
+        the controller sent a flow mod to the switch. (adds are
+        never dropped.)
+        """
+        data = copyBytes(data)
+        command = flowModFields.unpack_from(data, flowModFieldsIdx)[1]
+        xid = struct.unpack_from("!I", data, 4)[0]
+        with self.lock:
+            self.apply(data)
+            if command != OFPFC_ADD or xid in self.controllerAdds:
+                return
+            self.controllerAdds[xid] = (flowModRuleKey(data), data[8:])
+            self.controllerXids.append(xid)
+            if len(self.controllerXids) > self.maxTrackedXids:
+                self.controllerAdds.pop(self.controllerXids.popleft(), None)
+
+    def switchError(self, data):
+        """
+        the switch sent the controller an error. A refused add is
+        forgotten.
+        """
+        codes = errorCodes(copyBytes(data[:12]))
+        if codes is None or codes[0] != OFPET_FLOW_MOD_FAILED:
+            return
+        xid = struct.unpack_from("!I", data, 4)[0]
+        with self.lock:
+            add = self.controllerAdds.pop(xid, None)
+        if add is not None:
+            self.forget(*add)
+
+    def flowRemoved(self, data):
+        key = flowRemovedKey(copyBytes(data))
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def apply(self, data):
+        """
+        (call with lock held.)
+        """
+        tableId, command, idleTimeout, hardTimeout = \
+            flowModFields.unpack_from(data, flowModFieldsIdx)
+        if command == OFPFC_ADD:
+            key = flowModRuleKey(data)
+            body = data[8:]
+            if self.entries.get(key) == body:
+                self.suppressed += 1
+                return False
+            flags = struct.unpack_from("!H", data, flowModFlagsIdx)[0]
+            if hardTimeout == 0 and (idleTimeout == 0 or \
+                flags & OFPFF_SEND_FLOW_REM):
+                self.entries[key] = body
+            else:
+                self.entries.pop(key, None)
+        elif command in (OFPFC_MODIFY_STRICT, OFPFC_DELETE_STRICT):
+            self.entries.pop(flowModRuleKey(data), None)
+        elif command in (OFPFC_MODIFY, OFPFC_DELETE):
+            if tableId == OFPTT_ALL:
+                self.entries.clear()
+            else:
+                for key in [key for key in self.entries if key[0] == tableId]:
+                    del self.entries[key]
+        return True
+
+    def forget(self, key, body):
+        """
+        remove the entry for key, if it is still body.
+        """
+        with self.lock:
+            if self.entries.get(key) == body:
+                del self.entries[key]
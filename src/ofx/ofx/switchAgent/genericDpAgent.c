@@ -27,6 +27,7 @@
 #include  <signal.h>
 #include <stdint.h>
 #include <pthread.h>
+#include <endian.h>
 
 // Definitions for data path <--> agent communication.
 #define OFXHEADERLEN 12
@@ -71,6 +72,30 @@ int addTCPFloodFlow(struct in_addr ip_src, struct in_addr ip_dst,
 int sendPacketUp(unsigned char * ethpkt, int pktlen);
 // Send a message from the DP component of a module to the agent component.
 sendMsgUp(unsigned char * msgcontents, int msgLen, int moduleId, int msgType);
+// Offer a packet of a udp flow to the offload policy. (see below)
+// Returns 1 if the flow has an ASIC counting rule (after this 
+// packet). Flows promoted by an offer, this flow or any other, are 
+// also given to the module's handle_flow_promoted.
+int offerUDPCountingFlow(struct in_addr ip_src, struct in_addr ip_dst, 
+    u_short sport, u_short dport, uint32_t volume);
+// management agent -> datapath: a flow rule of the module was 
+// removed (demoted, evicted or timed out). The rule's final packet 
+// and byte counts, in network order.
+#define FLOWDEMOTEDMSGTYPE 0x5
+struct flowDemotedMessage {
+    struct udpFlowMessage key;
+    uint8_t ipProto;
+    uint8_t pad[3];
+    uint64_t packetCt, byteCt;
+};
+// management agent -> datapath: set the offload budget (most 
+// flows with counting rules), and the least volume of a flow in 
+// an epoch for it to be promoted.
+#define SETOFFLOADBUDGETMSGTYPE 0x6
+struct offloadBudgetMessage {
+    uint32_t budget;
+    uint32_t minVolume;
+};
 
 // Buffers, etc.
 char * msgBuffer; 
@@ -80,6 +105,11 @@ char * msgBuffer;
 // Other declarations.
 int startAgentSocket();
 void agentMessageRecvLoop(void *arg);
+void handleSysMessage(struct ofxDpHeader * msgHeader, unsigned char* msg);
+void runFlowDemotions();
+void runFlowPromotions();
+// demoted flows waiting for the packet loop.
+volatile int demotionCt = 0;
 
 
 int switchSocket;
@@ -91,6 +121,8 @@ char * modulefn = "./ofxmodule.so";
 char * handlefcnname = "handle_packet";
 char * startupfcnname = "module_startup";
 char * msgfcnname = "handle_message";
+char * demotefcnname = "handle_flow_demoted";
+char * promotefcnname = "handle_flow_promoted";
 
 // A reference to the packet handler module, packet processing function, 
 // and startup function.
@@ -98,6 +130,12 @@ void * modulelib = NULL;
 int (*handleFcn)(unsigned char* ethpkt, unsigned char* ippkt, int pktsize);
 int (*startupFcn)();
 int (*msgFcn)(struct ofxDpHeader * msgHeader, unsigned char* msg);
+// (optional) gets the counts of the module's demoted flows.
+void (*demoteFcn)(struct in_addr ip_src, struct in_addr ip_dst, 
+    u_short sport, u_short dport, uint64_t packetCt, uint64_t byteCt);
+// (optional) marks the module's flows that got a counting rule.
+void (*promoteFcn)(struct in_addr ip_src, struct in_addr ip_dst, 
+    u_short sport, u_short dport);
 
 // Reloads the module containing user code.
 // (including packet handler function and startup function)
@@ -126,6 +164,8 @@ void reload_module(){
         dprint("message function not loaded.\n");
         exit(1);
     }
+    demoteFcn = dlsym(modulelib, demotefcnname);
+    promoteFcn = dlsym(modulelib, promotefcnname);
 
     // Call the startup function that you just loaded.
     startupFcn();
@@ -242,6 +282,11 @@ int main(int argc, char *argv[])
     while (1)
     {
         nread = recv_rawpacket(sd, buffer, BUFSIZE);
+        // give the module the counts of demoted flows, in this 
+        // thread, so it doesn't have to lock its flow table.
+        if (demotionCt){
+            runFlowDemotions();
+        }
         struct sniff_ethernet *ethernet;  // Ethernet header
         ethernet = (struct sniff_ethernet*)(buffer);
         // We can either: only handle packets with the IP ecn bit set.
@@ -435,6 +480,10 @@ void agentMessageRecvLoop(void *arg){
         msgHeader->messageType = (uint32_t) ntohl(msgHeader->messageType);
         // Get the rest of the message.
         retval = recv_n_bytes(switchSocket, agentMsgBuffer+12,msgHeader->len-12);
+        if (msgHeader->moduleId == OFXSYSMODULEID){
+            handleSysMessage(msgHeader, agentMsgBuffer+12);
+            continue;
+        }
         // call the handler function, just of the single loaded module, 
         // for now.
         msgFcn(msgHeader, agentMsgBuffer+12);
@@ -557,5 +606,327 @@ int addTCPFloodFlow(struct in_addr ip_src, struct in_addr ip_dst,
 
 }
 
+/*
+Offload policy: which udp flows of a tap module get ASIC counting 
+rules. There is room for few rules, so only the heaviest flows get 
+one. 
+Modules offer every packet of the flows that they count in software 
+(offerUDPCountingFlow). The volume of the flows is tracked in a 
+space-saving summary of OFFLOADSUMMARYSIZE counters: a flow that 
+isn't in the summary takes the smallest counter, and its count as 
+the error of its volume. Every OFFLOADEPOCHMS, the flows with the 
+most volume that have no rule yet are promoted (addUDPCountingFlow), 
+as long as the offloaded flows are within the budget. Then all the 
+volumes are halved, so the summary follows recent traffic.
+The module is told about every promoted flow (handle_flow_promoted), 
+not just the one whose packet ended the epoch: the others may not 
+reach the datapath again once their rules are in the ASIC.
+The management agent sees the rules' counters, and removes the 
+rules that go cold. It sends their final counts 
+(FLOWDEMOTEDMSGTYPE), which frees their budget. The module gets 
+the counts (handle_flow_demoted), and counts the flow in software 
+again.
+*/
+#define OFFLOADSUMMARYSIZE 8192
+#define OFFLOADHASHSIZE (OFFLOADSUMMARYSIZE*2)
+#define OFFLOADEPOCHMS 1000
+// the count of an offloaded flow: never the smallest, so it 
+// stays in the summary.
+#define OFFLOADED UINT64_MAX
+
+struct offloadCounter {
+    struct udpFlowMessage key;
+    uint64_t count;
+    uint64_t error;
+    int heapIdx;
+};
+struct offloadCounter offloadCounters[OFFLOADSUMMARYSIZE];
+int offloadCounterCt = 0;
+// min heap of counter indices, by count.
+int offloadHeap[OFFLOADSUMMARYSIZE];
+// open addressing hash table of counter index + 1. (0 is empty)
+int offloadHash[OFFLOADHASHSIZE];
+int offloadedCt = 0;
+uint32_t offloadBudget = 1024;
+uint32_t offloadMinVolume = 1;
+double offloadEpochEnd = 0;
+struct flowDemotedMessage demotions[OFFLOADSUMMARYSIZE];
+// flows promoted in the last epoch, for the module.
+struct udpFlowMessage promotions[OFFLOADSUMMARYSIZE];
+int promotionCt = 0;
+pthread_mutex_t offloadLock = PTHREAD_MUTEX_INITIALIZER;
+
+double offloadMsTime(){
+    struct timeval now;
+    gettimeofday(&now, NULL);
+    return now.tv_sec * 1000.0 + now.tv_usec / 1000;
+}
+
+int offloadHome(struct udpFlowMessage * key){
+    // FNV-1a.
+    unsigned char * keyBytes = (unsigned char *) key;
+    uint32_t h = 2166136261u;
+    int i;
+    for (i = 0; i < sizeof(struct udpFlowMessage); i++){
+        h = (h ^ keyBytes[i]) * 16777619u;
+    }
+    return h & (OFFLOADHASHSIZE-1);
+}
+
+// The slot of key in the hash table, or the empty slot it goes in.
+int offloadSlot(struct udpFlowMessage * key){
+    int slot = offloadHome(key);
+    while (offloadHash[slot] && memcmp(key, 
+        &offloadCounters[offloadHash[slot]-1].key, 
+        sizeof(struct udpFlowMessage))){
+        slot = (slot+1) & (OFFLOADHASHSIZE-1);
+    }
+    return slot;
+}
+
+// Empty a slot, and move back the entries after it that 
+// would not be found past the gap.
+void offloadUnhash(int slot){
+    int next = slot;
+    int home;
+    offloadHash[slot] = 0;
+    while (1){
+        next = (next+1) & (OFFLOADHASHSIZE-1);
+        if (!offloadHash[next]){
+            return;
+        }
+        home = offloadHome(&offloadCounters[offloadHash[next]-1].key);
+        if ((next > slot && (home <= slot || home > next)) || 
+            (next < slot && (home <= slot && home > next))){
+            offloadHash[slot] = offloadHash[next];
+            offloadHash[next] = 0;
+            slot = next;
+        }
+    }
+}
+
+void offloadHeapSwap(int a, int b){
+    int idx = offloadHeap[a];
+    offloadHeap[a] = offloadHeap[b];
+    offloadHeap[b] = idx;
+    offloadCounters[offloadHeap[a]].heapIdx = a;
+    offloadCounters[offloadHeap[b]].heapIdx = b;
+}
+
+#define OFFLOADHEAPCOUNT(i) (offloadCounters[offloadHeap[i]].count)
+void offloadSiftUp(int i){
+    while (i > 0 && OFFLOADHEAPCOUNT(i) < OFFLOADHEAPCOUNT((i-1)/2)){
+        offloadHeapSwap(i, (i-1)/2);
+        i = (i-1)/2;
+    }
+}
+
+void offloadSiftDown(int i){
+    int smallest;
+    while (1){
+        smallest = i;
+        if (2*i+1 < offloadCounterCt && 
+            OFFLOADHEAPCOUNT(2*i+1) < OFFLOADHEAPCOUNT(smallest)){
+            smallest = 2*i+1;
+        }
+        if (2*i+2 < offloadCounterCt && 
+            OFFLOADHEAPCOUNT(2*i+2) < OFFLOADHEAPCOUNT(smallest)){
+            smallest = 2*i+2;
+        }
+        if (smallest == i){
+            return;
+        }
+        offloadHeapSwap(i, smallest);
+        i = smallest;
+    }
+}
+
+// Sorts counter indices by count, largest first.
+int offloadCompare(const void * a, const void * b){
+    uint64_t countA = offloadCounters[*(int *)a].count;
+    uint64_t countB = offloadCounters[*(int *)b].count;
+    return (countA < countB) - (countA > countB);
+}
+
+// Promote the heaviest flows, then age the volumes. 
+// (call with offloadLock held.)
+void offloadEpoch(){
+    static int candidates[OFFLOADSUMMARYSIZE];
+    int candidateCt = 0;
+    int i;
+    struct offloadCounter * counter;
+    for (i = 0; i < offloadCounterCt; i++){
+        counter = &offloadCounters[i];
+        if (counter->count != OFFLOADED && 
+            counter->count - counter->error >= offloadMinVolume){
+            candidates[candidateCt++] = i;
+        }
+    }
+    if (candidateCt && offloadedCt < offloadBudget){
+        qsort(candidates, candidateCt, sizeof(int), offloadCompare);
+        for (i = 0; i < candidateCt && offloadedCt < offloadBudget; i++){
+            counter = &offloadCounters[candidates[i]];
+            if (!addUDPCountingFlow(counter->key.ip_src, counter->key.ip_dst, 
+                counter->key.uh_sport, counter->key.uh_dport)){
+                break;
+            }
+            counter->count = OFFLOADED;
+            counter->error = 0;
+            offloadedCt += 1;
+            promotions[promotionCt++] = counter->key;
+            offloadSiftDown(counter->heapIdx);
+        }
+    }
+    // (halving keeps the heap in order.)
+    for (i = 0; i < offloadCounterCt; i++){
+        counter = &offloadCounters[i];
+        if (counter->count != OFFLOADED){
+            counter->count /= 2;
+            counter->error /= 2;
+        }
+    }
+    offloadEpochEnd = offloadMsTime() + OFFLOADEPOCHMS;
+}
+
+int offerUDPCountingFlow(struct in_addr ip_src, struct in_addr ip_dst, 
+    u_short sport, u_short dport, uint32_t volume){
+    struct udpFlowMessage key;
+    struct offloadCounter * counter;
+    int slot, idx, offloaded;
+    memset(&key, 0, sizeof(key));
+    key.ip_src = ip_src;
+    key.ip_dst = ip_dst;
+    key.uh_sport = sport;
+    key.uh_dport = dport;
+
+    pthread_mutex_lock(&offloadLock);
+    slot = offloadSlot(&key);
+    idx = offloadHash[slot] - 1;
+    if (idx < 0){
+        if (offloadCounterCt < OFFLOADSUMMARYSIZE){
+            idx = offloadCounterCt++;
+            offloadCounters[idx].count = 0;
+            offloadCounters[idx].error = 0;
+            offloadCounters[idx].heapIdx = idx;
+            offloadHeap[idx] = idx;
+            offloadSiftUp(idx);
+        }
+        else {
+            // take the smallest counter.
+            idx = offloadHeap[0];
+            offloadUnhash(offloadSlot(&offloadCounters[idx].key));
+            offloadCounters[idx].error = offloadCounters[idx].count;
+            slot = offloadSlot(&key);
+        }
+        offloadCounters[idx].key = key;
+        offloadHash[slot] = idx + 1;
+    }
+    counter = &offloadCounters[idx];
+    offloaded = counter->count == OFFLOADED;
+    if (!offloaded){
+        counter->count += volume;
+        offloadSiftDown(counter->heapIdx);
+    }
+    if (offloadEpochEnd == 0){
+        // the first epoch starts now.
+        offloadEpochEnd = offloadMsTime() + OFFLOADEPOCHMS;
+    }
+    else if (offloadMsTime() >= offloadEpochEnd){
+        offloadEpoch();
+        offloaded = counter->count == OFFLOADED;
+    }
+    pthread_mutex_unlock(&offloadLock);
+    if (promotionCt){
+        runFlowPromotions();
+    }
+    return offloaded;
+}
+
+// Tell the module which flows got counting rules. (the thread 
+// that offers flows: the packet thread.)
+void runFlowPromotions(){
+    static struct udpFlowMessage pending[OFFLOADSUMMARYSIZE];
+    int pendingCt, i;
+    pthread_mutex_lock(&offloadLock);
+    pendingCt = promotionCt;
+    memcpy(pending, promotions, pendingCt*sizeof(struct udpFlowMessage));
+    promotionCt = 0;
+    pthread_mutex_unlock(&offloadLock);
+    if (!promoteFcn){
+        return;
+    }
+    for (i = 0; i < pendingCt; i++){
+        promoteFcn(pending[i].ip_src, pending[i].ip_dst, 
+            pending[i].uh_sport, pending[i].uh_dport);
+    }
+}
+
+// A flow's rule was removed: free its budget, if it's a udp 
+// counting rule, and queue its counts for the module. 
+// (agent socket thread)
+void flowDemoted(struct flowDemotedMessage * demotion){
+    int idx = -1;
+    pthread_mutex_lock(&offloadLock);
+    if (demotion->ipProto == IPPROTO_UDP){
+        idx = offloadHash[offloadSlot(&demotion->key)] - 1;
+    }
+    if (idx >= 0 && offloadCounters[idx].count == OFFLOADED){
+        offloadCounters[idx].count = 0;
+        offloadedCt -= 1;
+        offloadSiftUp(offloadCounters[idx].heapIdx);
+    }
+    if (demotionCt < OFFLOADSUMMARYSIZE){
+        demotions[demotionCt++] = *demotion;
+    }
+    else {
+        dprint("demotion queue full, flow counts dropped.\n");
+    }
+    pthread_mutex_unlock(&offloadLock);
+}
+
+// Give the module the counts of the demoted flows. (packet thread)
+void runFlowDemotions(){
+    static struct flowDemotedMessage pending[OFFLOADSUMMARYSIZE];
+    int pendingCt, i;
+    pthread_mutex_lock(&offloadLock);
+    pendingCt = demotionCt;
+    memcpy(pending, demotions, pendingCt*sizeof(struct flowDemotedMessage));
+    demotionCt = 0;
+    pthread_mutex_unlock(&offloadLock);
+    if (!demoteFcn){
+        return;
+    }
+    for (i = 0; i < pendingCt; i++){
+        demoteFcn(pending[i].key.ip_src, pending[i].key.ip_dst, 
+            pending[i].key.uh_sport, pending[i].key.uh_dport, 
+            be64toh(pending[i].packetCt), be64toh(pending[i].byteCt));
+    }
+}
+
+// Handle a system message from the management agent.
+void handleSysMessage(struct ofxDpHeader * msgHeader, unsigned char* msg){
+    struct offloadBudgetMessage * budget;
+    switch (msgHeader->messageType){
+        case FLOWDEMOTEDMSGTYPE:
+            flowDemoted((struct flowDemotedMessage *) msg);
+            break;
+        case SETOFFLOADBUDGETMSGTYPE:
+            budget = (struct offloadBudgetMessage *) msg;
+            pthread_mutex_lock(&offloadLock);
+            // (offloaded flows have to leave room in the summary.)
+            offloadBudget = ntohl(budget->budget);
+            if (offloadBudget > OFFLOADSUMMARYSIZE/2){
+                offloadBudget = OFFLOADSUMMARYSIZE/2;
+            }
+            offloadMinVolume = ntohl(budget->minVolume);
+            pthread_mutex_unlock(&offloadLock);
+            dprint("offload budget: %u flows (min volume: %u)\n", 
+                offloadBudget, offloadMinVolume);
+            break;
+        default:
+            dprint("unknown system message type: %u\n", msgHeader->messageType);
+    }
+}
+
 // End methods that should be exported to the data path agent.
 
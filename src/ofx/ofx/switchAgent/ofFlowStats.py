@@ -0,0 +1,345 @@
+"""
+OpenFlow 1.3 flow statistics (OFPMP_FLOW) requests, and a compact
+table of the replies, so the agent doesn't have to run
+ovs-ofctl dump-flows and parse its text output.
+Also the poller that shares one dump of the table among modules.
+"""
+from __future__ import print_function
+import struct, socket, array, threading, time, traceback
+
+from ofProxyCore import OFRequestError
+
+OFPT_MULTIPART_REQUEST = 18
+OFPT_MULTIPART_REPLY = 19
+OFPMP_FLOW = 1
+OFPTT_ALL = 0xff
+OFPP_ANY = 0xffffffff
+OFPG_ANY = 0xffffffff
+OFPMT_OXM = 1
+# a cookie mask that matches the whole cookie.
+COOKIE_MASK_ALL = 0xffffffffffffffff
+
+# OXM fields (class OFPXMC_OPENFLOW_BASIC) that go in the table.
+OXM_CLASS_BASIC = 0x8000
+OXM_IN_PORT = 0
+OXM_ETH_TYPE = 5
+OXM_IP_DSCP = 8
+OXM_IP_PROTO = 10
+OXM_IPV4_SRC = 11
+OXM_IPV4_DST = 12
+OXM_TCP_SRC = 13
+OXM_TCP_DST = 14
+OXM_UDP_SRC = 15
+OXM_UDP_DST = 16
+
+# multipart header: ofp header, type, flags, pad.
+multipartHeader = struct.Struct("!BBHIHH4x")
+# ofp_flow_stats_request, without the match.
+flowStatsRequest = struct.Struct("!B3xII4xQQ")
+# ofp_flow_stats, up to the match.
+flowStatsEntry = struct.Struct("!HBxIIHHHH4xQQQ")
+oxmHeader = struct.Struct("!HBB")
+
+# 64 bit counters. (unsigned long is only 32 bits on some
+# switch CPUs, use doubles there: exact up to 2^53.)
+if array.array('L').itemsize >= 8:
+    COUNTER_TYPE = 'L'
+else:
+    COUNTER_TYPE = 'd'
+
+def buildFlowStatsRequest(tableId=OFPTT_ALL, cookie=0, cookieMask=0, \
+    outPort=OFPP_ANY, outGroup=OFPG_ANY, xid=0):
+    """
+    an OFPMP_FLOW request for every flow (empty match) in tableId,
+    whose cookie matches cookie under cookieMask.
+    """
+    # empty OXM match, padded to 8 bytes.
+    match = struct.pack("!HH4x", OFPMT_OXM, 4)
+    body = flowStatsRequest.pack(tableId, outPort, outGroup, \
+        cookie, cookieMask) + match
+    header = multipartHeader.pack(4, OFPT_MULTIPART_REQUEST, \
+        multipartHeader.size + len(body), xid, OFPMP_FLOW, 0)
+    return header + body
+
+def intToIp(value):
+    return socket.inet_ntoa(struct.pack("!I", value))
+
+
+class FlowStatsTable(object):
+    """
+    Flow statistics, stored by column: one typed array per field,
+    with one entry per flow. Match fields that a flow doesn't
+    match on are 0. Masked fields keep the value, not the mask.
+    The whole ofp_match of each flow, with the fields that have no
+    column, is kept too (matches, a list of bytes).
+    """
+    columns = (('tableId', 'B'), ('priority', 'H'), \
+        ('cookie', COUNTER_TYPE), ('packetCount', COUNTER_TYPE), \
+        ('byteCount', COUNTER_TYPE), ('durationSec', 'I'), \
+        ('inPort', 'I'), ('ethType', 'H'), ('ipDscp', 'B'), \
+        ('ipProto', 'B'), ('ipv4Src', 'I'), ('ipv4Dst', 'I'), \
+        ('tpSrc', 'H'), ('tpDst', 'H'))
+    # OXM field -> column. tcp and udp ports share a column.
+    oxmColumns = {
+        OXM_IN_PORT : ('inPort', "!I"),
+        OXM_ETH_TYPE : ('ethType', "!H"),
+        OXM_IP_DSCP : ('ipDscp', "!B"),
+        OXM_IP_PROTO : ('ipProto', "!B"),
+        OXM_IPV4_SRC : ('ipv4Src', "!I"),
+        OXM_IPV4_DST : ('ipv4Dst', "!I"),
+        OXM_TCP_SRC : ('tpSrc', "!H"),
+        OXM_TCP_DST : ('tpDst', "!H"),
+        OXM_UDP_SRC : ('tpSrc', "!H"),
+        OXM_UDP_DST : ('tpDst', "!H")
+        }
+
+    idColumns = ('tableId', 'priority', 'cookie', 'inPort', 'ethType', \
+        'ipDscp', 'ipProto', 'ipv4Src', 'ipv4Dst', 'tpSrc', 'tpDst')
+
+    def __init__(self):
+        for name, typecode in self.columns:
+            setattr(self, name, array.array(typecode))
+        self.matches = []
+
+    def __len__(self):
+        return len(self.tableId)
+
+    def addReply(self, data):
+        """
+        add the flows in one OFPMP_FLOW reply message.
+        """
+        data = bytes(data)
+        off = multipartHeader.size
+        end = min(len(data), struct.unpack_from("!H", data, 2)[0])
+        while off + flowStatsEntry.size <= end:
+            (length, tableId, durationSec, durationNsec, priority, \
+                idleTimeout, hardTimeout, flags, cookie, packetCount, \
+                byteCount) = flowStatsEntry.unpack_from(data, off)
+            if length < flowStatsEntry.size:
+                raise ValueError("bad flow stats length: %s"%length)
+            matchOff = off + flowStatsEntry.size
+            fields = self.parseMatch(data, matchOff)
+            matchLen = struct.unpack_from("!H", data, matchOff + 2)[0]
+            self.matches.append(data[matchOff:matchOff+matchLen])
+            self.tableId.append(tableId)
+            self.priority.append(priority)
+            self.cookie.append(cookie)
+            self.packetCount.append(packetCount)
+            self.byteCount.append(byteCount)
+            self.durationSec.append(durationSec)
+            for name, typecode in self.columns[6:]:
+                getattr(self, name).append(fields.get(name, 0))
+            off += length
+
+    def parseMatch(self, data, off):
+        """
+        the fields of the ofp_match at off, by column name.
+        """
+        matchType, matchLen = struct.unpack_from("!HH", data, off)
+        fields = {}
+        pos = off + 4
+        end = off + matchLen
+        while pos + oxmHeader.size <= end:
+            oxmClass, fieldAndMask, oxmLen = oxmHeader.unpack_from(data, pos)
+            pos += oxmHeader.size
+            column = self.oxmColumns.get(fieldAndMask >> 1)
+            if oxmClass == OXM_CLASS_BASIC and column is not None:
+                name, fmt = column
+                fields[name] = struct.unpack_from(fmt, data, pos)[0]
+            pos += oxmLen
+        return fields
+
+    def select(self, rows):
+        """
+        a new table with the given rows (indices) of this one.
+        """
+        table = FlowStatsTable()
+        for name, typecode in self.columns:
+            column = getattr(self, name)
+            getattr(table, name).extend(column[i] for i in rows)
+        table.matches.extend(self.matches[i] for i in rows)
+        return table
+
+    def filter(self, cookie=0, cookieMask=0, match=None):
+        """
+        the flows whose cookie matches cookie under cookieMask, and 
+        whose columns have the values in match ({column name: value}). 
+        Returns this table itself if there is nothing to filter.
+        """
+        if not cookieMask and not match:
+            return self
+        rows = range(len(self))
+        if cookieMask:
+            cookie &= cookieMask
+            rows = [i for i in rows \
+                if int(self.cookie[i]) & cookieMask == cookie]
+        for name, value in (match or {}).items():
+            column = getattr(self, name)
+            rows = [i for i in rows if column[i] == value]
+        return self.select(rows)
+
+    def flowId(self, i):
+        """
+        what identifies flow i from one poll to the next: its 
+        table, priority, cookie and match fields.
+        """
+        return tuple(getattr(self, name)[i] for name in self.idColumns)
+
+    def changedSince(self, lastCounts):
+        """
+        the flows whose counters moved since lastCounts, and the 
+        counters of every flow now, for the next call. 
+        (counters: {flow id: (packetCount, byteCount)}) 
+        New flows count as changed.
+        """
+        counts = {}
+        rows = []
+        for i in range(len(self)):
+            flowId = self.flowId(i)
+            flowCounts = (self.packetCount[i], self.byteCount[i])
+            counts[flowId] = flowCounts
+            if lastCounts.get(flowId) != flowCounts:
+                rows.append(i)
+        return self.select(rows), counts
+
+    def ipFlows(self):
+        """
+        yields (src, dst, sport, dport, packetCount, byteCount)
+        for every flow that matches an IPv4 source, with the
+        addresses as dotted quad strings.
+        """
+        for i in range(len(self)):
+            if self.ipv4Src[i]:
+                yield (intToIp(self.ipv4Src[i]), intToIp(self.ipv4Dst[i]), \
+                    self.tpSrc[i], self.tpDst[i], \
+                    int(self.packetCount[i]), int(self.byteCount[i]))
+
+
+def parseFlowStatsReplies(replies):
+    """
+    a FlowStatsTable of the reply messages to a flow stats request.
+    """
+    table = FlowStatsTable()
+    for data in replies:
+        table.addReply(data)
+    return table
+
+
+class FlowStatsSubscription(object):
+    def __init__(self, callback, cookie, cookieMask, match, interval, \
+        changedOnly):
+        self.callback = callback
+        self.cookie = cookie & cookieMask
+        self.cookieMask = cookieMask
+        self.match = match
+        self.interval = interval
+        self.nextPoll = 0
+        # counters at the last poll, for changedOnly.
+        self.changedOnly = changedOnly
+        self.lastCounts = {}
+
+
+class FlowStatsPoller(object):
+    """
+    Polls the switch's flow table for any number of subscribers, 
+    with one flow stats request per interval. Every subscriber that 
+    is due gets the flows of the same snapshot that match its filter, 
+    as a FlowStatsTable. Subscribers share the tables, and must not 
+    change them.
+    If every due subscriber filters by cookie, the switch is only 
+    asked for the flows with those cookies, one request per cookie, 
+    all in flight at once. Otherwise one request gets every flow.
+    A changedOnly subscriber only gets the flows whose counters 
+    moved since its last poll.
+    The poller runs in its own thread while it has subscribers, and 
+    callbacks run in that thread.
+    """
+    # shortest time between polls.
+    minInterval = 0.1
+
+    def __init__(self, requestFcn, printfcn=None):
+        # requestFcn(cookie, cookieMask) -> OFRequest for the flows 
+        # whose cookie matches.
+        self.requestFcn = requestFcn
+        self.dprint = printfcn
+        if self.dprint is None:
+            self.dprint = print
+        self.subscriptions = {}
+        self.nextSubscriptionId = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def subscribe(self, callback, interval=1.0, cookie=0, cookieMask=0, \
+        match=None, changedOnly=False):
+        """
+        call callback(flowTable) every interval seconds, with the 
+        flows that pass the filter (see FlowStatsTable.filter). 
+        Returns an id for unsubscribe.
+        """
+        subscription = FlowStatsSubscription(callback, cookie, cookieMask, \
+            match, max(interval, self.minInterval), changedOnly)
+        with self.lock:
+            self.nextSubscriptionId += 1
+            subscriptionId = self.nextSubscriptionId
+            self.subscriptions[subscriptionId] = subscription
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.pollLoop)
+                self.thread.daemon = True
+                self.thread.start()
+        return subscriptionId
+
+    def unsubscribe(self, subscriptionId):
+        with self.lock:
+            self.subscriptions.pop(subscriptionId, None)
+
+    def pollLoop(self):
+        while True:
+            with self.lock:
+                subscriptions = list(self.subscriptions.values())
+                if not subscriptions:
+                    self.thread = None
+                    return
+            now = time.time()
+            if min(sub.nextPoll for sub in subscriptions) <= now:
+                # subscribers that are due soon share this snapshot, 
+                # so they stay in step after that.
+                due = [sub for sub in subscriptions \
+                    if sub.nextPoll - now <= sub.interval / 2.0]
+                self.poll(due, now)
+            wakeup = min(sub.nextPoll for sub in subscriptions)
+            time.sleep(max(wakeup - time.time(), self.minInterval))
+
+    def poll(self, due, now):
+        """
+        take one snapshot of the flow table, and hand it out.
+        """
+        for sub in due:
+            sub.nextPoll = now + sub.interval
+        # the requests this snapshot needs, by (cookie, cookieMask).
+        if [sub for sub in due if not sub.cookieMask]:
+            scopes = [(0, 0)]
+        else:
+            scopes = set((sub.cookie, sub.cookieMask) for sub in due)
+        requests = [(scope, self.requestFcn(*scope)) for scope in scopes]
+        tables = {}
+        for scope, request in requests:
+            try:
+                tables[scope] = parseFlowStatsReplies(request.wait())
+            except (OFRequestError, ValueError) as e:
+                self.dprint("flow stats poll failed: %s"%e)
+        for sub in due:
+            table = tables.get((sub.cookie, sub.cookieMask))
+            if table is not None:
+                # the switch already filtered by cookie.
+                table = table.filter(match=sub.match)
+            elif (0, 0) in tables:
+                table = tables[(0, 0)].filter(sub.cookie, sub.cookieMask, \
+                    sub.match)
+            else:
+                continue
+            if sub.changedOnly:
+                table, sub.lastCounts = table.changedSince(sub.lastCounts)
+            try:
+                sub.callback(table)
+            except Exception:
+                traceback.print_exc()
@@ -0,0 +1,56 @@
+"""
+OpenFlow 1.3 port descriptions (OFPMP_PORT_DESC), so the agent can
+find the switch's ports, and the port of the datapath link, without
+ovs-ofctl.
+"""
+import struct
+
+from ofFlowStats import multipartHeader, OFPT_MULTIPART_REQUEST
+
+OFPMP_PORT_DESC = 13
+# ports above this are reserved (LOCAL, CONTROLLER, ...).
+OFPP_MAX = 0xffffff00
+OFPPC_PORT_DOWN = 1
+OFPPS_LINK_DOWN = 1
+
+# ofp_port: port no, hw addr, name, config, state, and the
+# features and speeds.
+portStruct = struct.Struct("!I4x6s2x16sIIIIIIII")
+
+
+class PortDesc(object):
+    def __init__(self, portNo, hwAddr, name, config, state):
+        self.portNo = portNo
+        self.hwAddr = hwAddr
+        self.name = name
+        self.config = config
+        self.state = state
+
+    def isUp(self):
+        return not (self.config & OFPPC_PORT_DOWN or \
+            self.state & OFPPS_LINK_DOWN)
+
+
+def buildPortDescRequest(xid=0):
+    return multipartHeader.pack(4, OFPT_MULTIPART_REQUEST, \
+        multipartHeader.size, xid, OFPMP_PORT_DESC, 0)
+
+def parsePortDescReplies(replies):
+    """
+    the switch's ports (not the reserved ones), from the reply
+    messages to a port desc request, as PortDescs.
+    """
+    ports = []
+    for data in replies:
+        data = bytes(data)
+        end = min(len(data), struct.unpack_from("!H", data, 2)[0])
+        off = multipartHeader.size
+        while off + portStruct.size <= end:
+            (portNo, hwAddr, name, config, state) = \
+                portStruct.unpack_from(data, off)[:5]
+            off += portStruct.size
+            if portNo > OFPP_MAX:
+                continue
+            name = name.split(b'\0', 1)[0].decode('ascii', 'replace')
+            ports.append(PortDesc(portNo, hwAddr, name, config, state))
+    return ports
@@ -0,0 +1,1337 @@
+"""
+Event driven core of the OpenFlow proxy.
+One EventLoop multiplexes the switch and controller sockets of
+any number of proxied switches, with non-blocking reads and writes.
+(of_proxy/ofProxy.py uses it too.)
+"""
+from __future__ import print_function
+import time, sys, struct, threading, socket, os, select, errno, fcntl
+import heapq
+import traceback
+import collections
+import ctypes, ctypes.util
+
+# errors that just mean "try again later" on a non-blocking socket.
+retryErrors = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# OpenFlow 1.3 header: version, type, length, xid.
+OFP_HEADER_LEN = 8
+# largest message the 16 bit length field allows.
+OFP_MAX_MESSAGE_LEN = 0xffff
+# message types that are never held back to batch writes:
+# echo request / reply and barrier request / reply.
+OFPT_ECHO_REQUEST = 2
+OFPT_ECHO_REPLY = 3
+OFPT_BARRIER_REQUEST = 20
+OFPT_BARRIER_REPLY = 21
+# other message types.
+OFPT_ERROR = 1
+OFPT_PACKET_IN = 10
+OFPT_FLOW_REMOVED = 11
+OFPT_PORT_STATUS = 12
+OFPT_MULTIPART_REQUEST = 18
+OFPT_MULTIPART_REPLY = 19
+# more parts of a multipart reply follow.
+OFPMPF_REPLY_MORE = 1
+
+# OpenFlow 1.3 message type codes, by twink class name.
+OFP_TYPE_CODES = {
+    'ofp_hello' : 0,
+    'ofp_error_msg' : 1,
+    'ofp_echo_request' : 2,
+    'ofp_echo_reply' : 3,
+    'ofp_experimenter_' : 4,
+    'ofp_switch_features_request' : 5,
+    'ofp_switch_features' : 6,
+    'ofp_get_config_request' : 7,
+    'ofp_get_config_reply' : 8,
+    'ofp_set_config' : 9,
+    'ofp_packet_in' : 10,
+    'ofp_flow_removed' : 11,
+    'ofp_port_status' : 12,
+    'ofp_packet_out' : 13,
+    'ofp_flow_mod' : 14,
+    'ofp_group_mod' : 15,
+    'ofp_port_mod' : 16,
+    'ofp_table_mod' : 17,
+    'ofp_multipart_request' : 18,
+    'ofp_multipart_reply' : 19,
+    'ofp_barrier_request' : 20,
+    'ofp_barrier_reply' : 21,
+    'ofp_queue_get_config_request' : 22,
+    'ofp_queue_get_config_reply' : 23,
+    'ofp_role_request' : 24,
+    'ofp_role_reply' : 25,
+    'ofp_get_async_request' : 26,
+    'ofp_get_async_reply' : 27,
+    'ofp_set_async' : 28,
+    'ofp_meter_mod' : 29
+    }
+
+def ofTypeCode(messageType):
+    """
+    the type code of an OpenFlow message type, given either as
+    a code or as a twink class name.
+    """
+    if isinstance(messageType, int):
+        return messageType
+    return OFP_TYPE_CODES[messageType]
+
+# send lanes, highest priority first.
+LANE_URGENT = 0 # echos.
+LANE_EVENT = 1 # generated packet ins, module alerts.
+LANE_CONTROL = 2 # everything else. (default)
+LANE_BULK = 3 # stats and bulk module data.
+NUM_LANES = 4
+# most buffers the kernel takes in one sendmsg.
+IOV_MAX = 1024
+# python 2 sockets have no sendmsg, batches are joined into one send there.
+hasSendmsg = hasattr(socket.socket, "sendmsg")
+
+# splice(2), to move passthrough messages between sockets in the kernel.
+# (os.splice in python 3.10+, libc through ctypes before that.)
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+F_SETPIPE_SZ = 1031
+libcSplice = None
+if not hasattr(os, "splice") and sys.platform.startswith("linux"):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libcSplice = libc.splice
+        libcSplice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, \
+            ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+        libcSplice.restype = ctypes.c_ssize_t
+    except (OSError, AttributeError):
+        libcSplice = None
+hasSplice = hasattr(os, "splice") or libcSplice is not None
+
+
+class EpollPoller(object):
+    """
+    Readiness notification with epoll (linux).
+    """
+    def __init__(self):
+        self.epoll = select.epoll()
+
+    def mask(self, read, write):
+        mask = 0
+        if read:
+            mask |= select.EPOLLIN
+        if write:
+            mask |= select.EPOLLOUT
+        return mask
+
+    def register(self, fd, read, write):
+        self.epoll.register(fd, self.mask(read, write))
+
+    def modify(self, fd, read, write):
+        self.epoll.modify(fd, self.mask(read, write))
+
+    def unregister(self, fd):
+        self.epoll.unregister(fd)
+
+    def poll(self, timeout):
+        """
+        returns a list of (fd, readable, writable).
+        Errors and hangups are reported as readable, so that the
+        next read on the socket sees them.
+        """
+        if timeout is None:
+            timeout = -1
+        try:
+            events = self.epoll.poll(timeout)
+        except IOError as e:
+            if e.errno == errno.EINTR:
+                return []
+            raise
+        errMask = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+        return [(fd, bool(ev & errMask), bool(ev & select.EPOLLOUT)) \
+            for fd, ev in events]
+
+
+class SelectPoller(object):
+    """
+    Readiness notification with select, for platforms without epoll.
+    """
+    def __init__(self):
+        self.readers = set()
+        self.writers = set()
+
+    def register(self, fd, read, write):
+        self.modify(fd, read, write)
+
+    def modify(self, fd, read, write):
+        self.unregister(fd)
+        if read:
+            self.readers.add(fd)
+        if write:
+            self.writers.add(fd)
+
+    def unregister(self, fd):
+        self.readers.discard(fd)
+        self.writers.discard(fd)
+
+    def poll(self, timeout):
+        try:
+            r, w, x = select.select(self.readers, self.writers, \
+                self.readers, timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        r = set(r) | set(x)
+        w = set(w)
+        return [(fd, fd in r, fd in w) for fd in r | w]
+
+
+class EventLoop(object):
+    """
+    Single threaded event loop. Dispatches socket readiness to the
+    registered read and write handlers, runs timers, and runs calls
+    that other threads hand over with callFromThread.
+    """
+    def __init__(self):
+        if hasattr(select, "epoll"):
+            self.poller = EpollPoller()
+        else:
+            self.poller = SelectPoller()
+        self.handlers = {} # fd -> [read handler, write handler]
+        self.interest = {} # fd -> (want read, want write)
+        self.timers = [] # heap of (deadline, sequence #, fcn, args)
+        self.timerSeq = 0
+        self.timerLock = threading.Lock()
+        self.pendingCalls = collections.deque()
+        self.loopThread = None
+        self.running = False
+        # other threads write a byte to this pipe to wake the loop up.
+        self.wakeupRead, self.wakeupWrite = os.pipe()
+        for fd in (self.wakeupRead, self.wakeupWrite):
+            setNonBlocking(fd)
+        self.register(self.wakeupRead, self.drainWakeup, None)
+        self.setInterest(self.wakeupRead, True, False)
+
+    def inLoopThread(self):
+        return threading.current_thread() is self.loopThread
+
+    def register(self, fd, readFcn, writeFcn):
+        """
+        register handlers for a file descriptor.
+        Interest starts out empty, use setInterest to enable it.
+        """
+        self.handlers[fd] = [readFcn, writeFcn]
+        self.interest[fd] = (False, False)
+        self.poller.register(fd, False, False)
+
+    def setInterest(self, fd, read, write):
+        if fd not in self.handlers:
+            return
+        if self.interest[fd] == (read, write):
+            return
+        self.interest[fd] = (read, write)
+        self.poller.modify(fd, read, write)
+
+    def unregister(self, fd):
+        if fd not in self.handlers:
+            return
+        del self.handlers[fd]
+        del self.interest[fd]
+        self.poller.unregister(fd)
+
+    def callLater(self, delay, fcn, *args):
+        """
+        run fcn(*args) in the loop thread, after delay seconds.
+        """
+        with self.timerLock:
+            self.timerSeq += 1
+            heapq.heappush(self.timers, \
+                (time.time() + delay, self.timerSeq, fcn, args))
+        if not self.inLoopThread():
+            self.wakeup()
+
+    def callFromThread(self, fcn, *args):
+        """
+        run fcn(*args) in the loop thread, as soon as possible.
+        Safe to call from any thread.
+        """
+        self.pendingCalls.append((fcn, args))
+        if not self.inLoopThread():
+            self.wakeup()
+
+    def wakeup(self):
+        try:
+            os.write(self.wakeupWrite, b'x')
+        except OSError as e:
+            # pipe full: the loop is already going to wake up.
+            if e.errno not in retryErrors:
+                raise
+
+    def drainWakeup(self):
+        try:
+            while os.read(self.wakeupRead, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in retryErrors:
+                raise
+
+    def nextTimeout(self):
+        if self.pendingCalls:
+            return 0
+        with self.timerLock:
+            if not self.timers:
+                return None
+            return max(0, self.timers[0][0] - time.time())
+
+    def runTimers(self):
+        now = time.time()
+        while True:
+            with self.timerLock:
+                if not self.timers or self.timers[0][0] > now:
+                    return
+                deadline, seq, fcn, args = heapq.heappop(self.timers)
+            self.dispatch(fcn, args)
+
+    def runPendingCalls(self):
+        # only run the calls that are already queued, so a call that
+        # queues another call can't starve the sockets.
+        for i in range(len(self.pendingCalls)):
+            fcn, args = self.pendingCalls.popleft()
+            self.dispatch(fcn, args)
+
+    def dispatch(self, fcn, args):
+        """
+        call a handler. One broken handler should not take down the
+        proxies of every other switch in the loop.
+        """
+        try:
+            fcn(*args)
+        except Exception:
+            traceback.print_exc()
+
+    def run(self):
+        """
+        run the loop in the current thread until stop() is called.
+        """
+        self.loopThread = threading.current_thread()
+        self.running = True
+        while self.running:
+            events = self.poller.poll(self.nextTimeout())
+            for fd, readable, writable in events:
+                handlers = self.handlers.get(fd)
+                if handlers is not None and readable and handlers[0]:
+                    self.dispatch(handlers[0], ())
+                # the read handler may have closed the fd.
+                handlers = self.handlers.get(fd)
+                if handlers is not None and writable and handlers[1]:
+                    self.dispatch(handlers[1], ())
+            self.runTimers()
+            self.runPendingCalls()
+
+    def stop(self):
+        self.running = False
+        self.wakeup()
+
+
+def setNonBlocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+# the loop shared by every proxy in this process.
+defaultLoop = None
+def getEventLoop():
+    global defaultLoop
+    if defaultLoop is None:
+        defaultLoop = EventLoop()
+    return defaultLoop
+
+
+class FrameReader(object):
+    """
+    Reads OpenFlow messages from a socket with recv_into, into a 
+    preallocated buffer. Each read yields a memoryview slice of every 
+    complete message that is in the buffer. 
+    The views point into the buffer, so they are only valid until the 
+    next read. Copy (view.tobytes()) anything that has to be kept.
+    """
+    def __init__(self, size=256*1024):
+        # must hold a partial message plus a maximum size message.
+        size = max(size, 2*OFP_MAX_MESSAGE_LEN)
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0 # first byte that hasn't been handed out.
+        self.end = 0 # end of the data read so far.
+
+    def readFrom(self, sock):
+        """
+        read whatever the socket has. Returns the number of bytes read 
+        (0 at the end of the stream). Raises socket.error.
+        """
+        self.compact()
+        n = sock.recv_into(self.view[self.end:])
+        self.end += n
+        return n
+
+    def buffered(self):
+        return self.end - self.start
+
+    def partial(self):
+        """
+        view of the data after the last complete message.
+        """
+        return self.view[self.start:self.end]
+
+    def skip(self, n):
+        self.start += n
+
+    def compact(self):
+        """
+        wrap around: once the free space at the end can't hold a 
+        maximum size message, move the partial message at the 
+        read position back to the front of the buffer.
+        """
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buf) - self.end < OFP_MAX_MESSAGE_LEN:
+            remaining = self.end - self.start
+            self.buf[0:remaining] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = remaining
+
+    def frames(self):
+        """
+        yields a view of each complete message in the buffer.
+        Raises ValueError on a broken length field.
+        """
+        while self.end - self.start >= 4:
+            size = struct.unpack_from("!H", self.buf, self.start+2)[0]
+            if size < OFP_HEADER_LEN:
+                raise ValueError("bad OpenFlow message length: %s"%size)
+            if self.end - self.start < size:
+                return
+            frame = self.view[self.start:self.start+size]
+            self.start += size
+            yield frame
+
+
+def copyBytes(data):
+    """
+    copy a message out of a (possibly reused) buffer.
+    """
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return bytes(data)
+
+def splice(fdIn, fdOut, count):
+    """
+    move up to count bytes from fdIn to fdOut, one of which must 
+    be a pipe, without copying them to user space. Non-blocking. 
+    Returns the number of bytes moved, raises OSError.
+    """
+    flags = SPLICE_F_MOVE | SPLICE_F_NONBLOCK
+    if libcSplice is None:
+        return os.splice(fdIn, fdOut, count, flags=flags)
+    n = libcSplice(fdIn, None, fdOut, None, count, flags)
+    if n < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return n
+
+def sendBuffers(sock, bufs):
+    """
+    write a list of buffers with one system call.
+    """
+    if hasSendmsg:
+        return sock.sendmsg(bufs)
+    return sock.send(b"".join(bufs))
+
+
+class OFConnection(object):
+    """
+    A non-blocking OpenFlow connection.
+    Splits the incoming byte stream into OpenFlow messages and passes
+    each one to onMessage, as a memoryview that is only valid during 
+    the call (see FrameReader). Buffers outgoing data until the socket
+    can take it. send() can be called from any thread, and can be
+    called before a socket is attached.
+
+    The send queue is bounded by watermarks. When more than 
+    highWatermark bytes are queued, reads from the peer connection 
+    are paused, and threads other than the loop thread block in 
+    send(). Both resume once the queue drains below lowWatermark.
+
+    Writes are batched: queued messages go out together in one 
+    sendmsg, once maxBatchBytes are queued or the oldest message 
+    has waited maxFlushDelay seconds. Messages of a type in 
+    urgentTypes (echos and barriers by default) flush the queue 
+    right away. Set maxFlushDelay to 0 to write every message as 
+    soon as it is sent.
+
+    Each message is queued in one of NUM_LANES send lanes (LANE_*), 
+    picked by the caller. Messages sent without a lane go on 
+    LANE_CONTROL (echos on LANE_URGENT), so proxied messages keep 
+    their order; callers pick other lanes for messages they 
+    generate, that don't have to be ordered with the rest. Lanes are served 
+    by deficit round robin: every round, a lane may write up to 
+    laneQuantum * laneWeights[lane] bytes. So bulk data can use 
+    the whole link when nothing else is queued, but a message on a 
+    higher lane waits for at most about maxBatchBytes of bulk data.
+    Threads block in send() on their own lane's backlog only.
+
+    If spliceFilter is set, large messages that it accepts (by 
+    OpenFlow type and xid) are moved straight to the peer connection with 
+    splice, through a pipe, and never reach onMessage. At a message 
+    boundary, the header is peeked from the socket. A message that 
+    was partly read into user space can also be spliced: the part 
+    that was read is written into the pipe first. Splicing only 
+    starts once the peer's send queue is flushed, so the order of 
+    messages on both connections is kept. While a spliced message 
+    is in flight, the peer holds back its send queue.
+    """
+    highWatermark = 1024*1024
+    lowWatermark = 256*1024
+    # longest a thread waits in send() before checking the connection again.
+    sendWaitTimeout = 1.0
+    # flush policy.
+    maxBatchBytes = 64*1024
+    maxFlushDelay = 0.001
+    urgentTypes = frozenset([OFPT_ECHO_REQUEST, OFPT_ECHO_REPLY, \
+        OFPT_BARRIER_REQUEST, OFPT_BARRIER_REPLY])
+    # lane scheduling.
+    laneQuantum = 4*1024
+    laneWeights = (8, 4, 2, 1)
+    # default lanes. Only echos can jump ahead of other messages: 
+    # barriers, replies and packet ins must stay in order.
+    laneTypes = {
+        OFPT_ECHO_REQUEST : LANE_URGENT,
+        OFPT_ECHO_REPLY : LANE_URGENT
+        }
+    # smaller messages are cheaper to copy than to splice.
+    spliceThreshold = 4096
+
+    def __init__(self, loop, name, onMessage, onClose):
+        self.loop = loop
+        self.name = name
+        self.onMessage = onMessage
+        self.onClose = onClose
+        self.sock = None
+        self.fd = None
+        self.closed = False
+        self.reader = FrameReader()
+        # messages waiting in each lane.
+        self.lanes = [collections.deque() for i in range(NUM_LANES)]
+        self.laneBytes = [0] * NUM_LANES
+        self.deficits = [0] * NUM_LANES
+        # messages the scheduler picked for the next writes,
+        # the first one may be partly written.
+        self.outQueue = collections.deque()
+        self.outQueueBytes = 0
+        self.headOffset = 0
+        self.queued = 0
+        self.outLock = threading.Lock()
+        # signalled when the queue drains, or the connection closes.
+        self.drained = threading.Condition(self.outLock)
+        self.congested = False
+        self.writing = False
+        self.flushPending = False
+        # the connection whose reads feed this connection's send queue.
+        self.peer = None
+        self.readPaused = False
+        # spliceFilter(messageType, xid) -> True if the message can 
+        # go straight to the peer.
+        self.spliceFilter = None
+        # splice state of messages read from this connection: the 
+        # pipe, bytes of the current message left to read from the 
+        # socket, and bytes in the pipe.
+        self.pipeRead = self.pipeWrite = None
+        self.spliceToRead = 0
+        self.spliceInPipe = 0
+        # the connection whose spliced message this one is writing.
+        self.splicingFrom = None
+
+    def setFlushPolicy(self, maxBatchBytes=None, maxFlushDelay=None, \
+        urgentTypes=None):
+        """
+        override the class wide flush policy for this connection.
+        """
+        if maxBatchBytes is not None:
+            self.maxBatchBytes = maxBatchBytes
+        if maxFlushDelay is not None:
+            self.maxFlushDelay = maxFlushDelay
+        if urgentTypes is not None:
+            self.urgentTypes = frozenset(urgentTypes)
+
+    def attach(self, sock):
+        """
+        start using a connected socket. (call from the loop thread)
+        """
+        sock.setblocking(0)
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.loop.register(self.fd, self.handleRead, self.handleWrite)
+        with self.outLock:
+            self.writing = self.queued > 0
+        self.updateInterest()
+
+    def updateInterest(self):
+        if self.closed or self.sock is None:
+            return
+        self.loop.setInterest(self.fd, not self.readPaused, self.writing)
+
+    def pauseReading(self):
+        self.readPaused = True
+        self.updateInterest()
+
+    def resumeReading(self):
+        self.readPaused = False
+        self.updateInterest()
+
+    def messageType(self, data):
+        if len(data) < OFP_HEADER_LEN:
+            return None
+        return struct.unpack_from("!B", data, 1)[0]
+
+    def send(self, data, urgent=None, lane=None):
+        """
+        queue data to send on the connection.
+        urgent data flushes the queue right away. lane is one of 
+        the LANE_* constants. By default, both are decided by the 
+        OpenFlow message type in data's header.
+        Blocks a thread other than the loop thread while the lane's 
+        backlog is over the high watermark.
+        """
+        ofType = self.messageType(data)
+        if urgent is None:
+            urgent = ofType in self.urgentTypes
+        if lane is None:
+            lane = self.laneTypes.get(ofType, LANE_CONTROL)
+        inLoop = self.loop.inLoopThread()
+        scheduleFlush = False
+        with self.outLock:
+            if not inLoop:
+                while self.laneBytes[lane] >= self.highWatermark \
+                    and not self.closed:
+                    self.drained.wait(self.sendWaitTimeout)
+            if self.closed:
+                return
+            data = copyBytes(data)
+            self.lanes[lane].append(data)
+            self.laneBytes[lane] += len(data)
+            self.queued += len(data)
+            becameCongested = not self.congested and \
+                self.queued >= self.highWatermark
+            if becameCongested:
+                self.congested = True
+            # attach, or the socket becoming writable, flushes the queue.
+            idle = self.sock is not None and not self.writing
+            flushNow = urgent or self.queued >= self.maxBatchBytes \
+                or self.maxFlushDelay <= 0
+            if idle and not flushNow and not self.flushPending:
+                self.flushPending = scheduleFlush = True
+        if becameCongested:
+            if inLoop:
+                self.syncPeer()
+            else:
+                self.loop.callFromThread(self.syncPeer)
+        if not idle:
+            return
+        if flushNow:
+            if inLoop:
+                self.handleWrite()
+            else:
+                self.loop.callFromThread(self.handleWrite)
+        elif scheduleFlush:
+            self.loop.callLater(self.maxFlushDelay, self.flushTimeout)
+
+    def flushTimeout(self):
+        with self.outLock:
+            self.flushPending = False
+        if not self.writing:
+            self.handleWrite()
+
+    def syncPeer(self):
+        """
+        pause or resume reads on the peer, to match the current 
+        congestion state. (the state may have changed again since 
+        the call was scheduled)
+        """
+        if self.peer is None:
+            return
+        if self.congested:
+            self.peer.pauseReading()
+        else:
+            self.peer.resumeReading()
+
+    def handleRead(self):
+        if self.spliceToRead:
+            self.spliceIn()
+            return
+        if self.spliceFilter is not None and hasSplice \
+            and self.reader.buffered() == 0 and self.startSplice():
+            return
+        try:
+            n = self.reader.readFrom(self.sock)
+        except socket.error as e:
+            if e.errno in retryErrors:
+                return
+            self.close()
+            return
+        if n == 0:
+            self.close()
+            return
+        # pass along every complete message in the buffer.
+        try:
+            for data in self.reader.frames():
+                self.onMessage(data)
+                if self.closed:
+                    return
+        except ValueError:
+            # can't resync a stream with a broken length field.
+            self.close()
+            return
+        if self.spliceFilter is not None and hasSplice:
+            self.spliceBuffered()
+
+    def spliceLength(self, header):
+        """
+        length of the message starting with header, if it should 
+        be spliced, 0 otherwise.
+        """
+        msgType, length, xid = struct.unpack_from("!xBHI", header)
+        if length < self.spliceThreshold or not self.spliceFilter(msgType, xid):
+            return 0
+        return length
+
+    def peerReady(self):
+        """
+        True if the peer can take a spliced message now: it is 
+        connected, and has nothing queued that the message would 
+        overtake. Flushes the peer's queue if it can.
+        """
+        dest = self.peer
+        if dest is None or dest.sock is None or dest.closed \
+            or dest.splicingFrom is not None:
+            return False
+        if dest.queued and not dest.writing:
+            dest.handleWrite()
+        return not dest.queued and not dest.closed
+
+    def startSplice(self):
+        """
+        peek at the next message's header, and start splicing it to 
+        the peer if it qualifies. Returns True if the read was handled.
+        """
+        try:
+            header = self.sock.recv(OFP_HEADER_LEN, socket.MSG_PEEK)
+        except socket.error as e:
+            return e.errno in retryErrors
+        if len(header) < OFP_HEADER_LEN:
+            return False
+        length = self.spliceLength(header)
+        if not length or not self.peerReady():
+            return False
+        if self.pipeRead is None:
+            self.openPipe()
+        self.spliceToRead = length
+        self.peer.splicingFrom = self
+        self.spliceIn()
+        return True
+
+    def spliceBuffered(self):
+        """
+        splice the partly read message at the end of the buffer, 
+        if it qualifies. The part that was read goes into the 
+        pipe, the rest is spliced from the socket.
+        """
+        data = self.reader.partial()
+        if len(data) < OFP_HEADER_LEN:
+            return
+        length = self.spliceLength(data)
+        if not length or not self.peerReady():
+            return
+        if self.pipeRead is None:
+            self.openPipe()
+        # the pipe is empty and holds a whole message, 
+        # so this doesn't block or write short.
+        n = os.write(self.pipeWrite, data)
+        self.reader.skip(n)
+        self.spliceToRead = length - n
+        self.spliceInPipe = n
+        self.peer.splicingFrom = self
+        self.peer.handleWrite()
+
+    def openPipe(self):
+        self.pipeRead, self.pipeWrite = os.pipe()
+        for fd in (self.pipeRead, self.pipeWrite):
+            setNonBlocking(fd)
+        # the pipe must hold a whole message. (linux pipes 
+        # hold 64KB by default, so this is just in case.)
+        try:
+            fcntl.fcntl(self.pipeWrite, F_SETPIPE_SZ, 2*OFP_MAX_MESSAGE_LEN)
+        except IOError:
+            pass
+
+    def spliceIn(self):
+        """
+        move the part of the spliced message that has arrived into 
+        the pipe, then on to the peer.
+        """
+        try:
+            n = splice(self.fd, self.pipeWrite, self.spliceToRead)
+        except OSError as e:
+            if e.errno in retryErrors:
+                return
+            self.close()
+            return
+        if n == 0:
+            self.close()
+            return
+        self.spliceToRead -= n
+        self.spliceInPipe += n
+        self.peer.handleWrite()
+
+    def spliceOut(self):
+        """
+        write the piped part of the spliced message from splicingFrom. 
+        Returns True once the whole message has been written.
+        """
+        src = self.splicingFrom
+        while src.spliceInPipe:
+            try:
+                n = splice(src.pipeRead, self.fd, src.spliceInPipe)
+            except OSError as e:
+                if e.errno not in retryErrors:
+                    self.close()
+                    return False
+                # wait for the socket to be writable.
+                self.writing = True
+                self.updateInterest()
+                return False
+            src.spliceInPipe -= n
+        if src.spliceToRead:
+            # wait for the rest of the message to arrive.
+            self.writing = False
+            self.updateInterest()
+            return False
+        self.splicingFrom = None
+        return True
+
+    def schedule(self):
+        """
+        move messages from the lanes to the write queue, by deficit 
+        round robin, until a batch is ready or the lanes are empty.
+        """
+        while self.outQueueBytes < self.maxBatchBytes and \
+            self.outQueueBytes < self.queued:
+            for lane in range(NUM_LANES):
+                queue = self.lanes[lane]
+                if not queue:
+                    continue
+                self.deficits[lane] += self.laneQuantum * self.laneWeights[lane]
+                while queue and len(queue[0]) <= self.deficits[lane]:
+                    data = queue.popleft()
+                    self.deficits[lane] -= len(data)
+                    self.laneBytes[lane] -= len(data)
+                    self.outQueue.append(data)
+                    self.outQueueBytes += len(data)
+                # an idle lane doesn't save up credit.
+                if not queue:
+                    self.deficits[lane] = 0
+
+    def gatherBatch(self):
+        """
+        the buffers for the next write: up to maxBatchBytes of queued 
+        messages (at least one), starting with the unwritten part of 
+        the first.
+        """
+        bufs = []
+        size = 0
+        for data in self.outQueue:
+            if not bufs and self.headOffset:
+                if hasSendmsg:
+                    data = memoryview(data)[self.headOffset:]
+                else:
+                    data = data[self.headOffset:]
+            bufs.append(data)
+            size += len(data)
+            if size >= self.maxBatchBytes or len(bufs) >= IOV_MAX:
+                break
+        return bufs
+
+    def consume(self, sent):
+        """
+        drop sent bytes from the front of the queue.
+        """
+        self.queued -= sent
+        self.outQueueBytes -= sent
+        sent += self.headOffset
+        while sent and sent >= len(self.outQueue[0]):
+            sent -= len(self.outQueue.popleft())
+        self.headOffset = sent
+
+    def handleWrite(self):
+        """
+        write batches until the queue is empty or the socket is full.
+        Messages that are only partly written stay at the front 
+        of the queue.
+        """
+        if self.closed or self.sock is None:
+            return
+        if self.splicingFrom is not None and not self.spliceOut():
+            return
+        failed = False
+        with self.outLock:
+            while True:
+                self.schedule()
+                if not self.outQueue:
+                    break
+                try:
+                    sent = sendBuffers(self.sock, self.gatherBatch())
+                except socket.error as e:
+                    if e.errno not in retryErrors:
+                        failed = True
+                    break
+                self.consume(sent)
+            queued = self.queued
+            becameDrained = self.congested and queued < self.lowWatermark
+            if becameDrained:
+                self.congested = False
+            # wake up threads waiting on any lane.
+            self.drained.notify_all()
+        if failed:
+            self.close()
+            return
+        if becameDrained:
+            self.syncPeer()
+        self.writing = queued > 0
+        self.updateInterest()
+
+    def close(self):
+        if self.closed:
+            return
+        with self.outLock:
+            self.closed = True
+            self.drained.notify_all()
+        if self.sock is not None:
+            self.loop.unregister(self.fd)
+            self.sock.close()
+        if self.pipeRead is not None:
+            os.close(self.pipeRead)
+            os.close(self.pipeWrite)
+        if self.onClose is not None:
+            self.onClose(self)
+
+
+def passAll(messageType):
+    return True
+
+
+class OFRequestError(Exception):
+    """
+    an OpenFlow request failed: the switch answered with an error, 
+    the request timed out, or the connection closed.
+    """
+    pass
+
+
+class OFRequest(object):
+    """
+    An OpenFlow request that a proxy sent to the switch on its own 
+    behalf, and the replies to it. Works like a future: wait() 
+    blocks until the request is done, and the callback, if any, 
+    is called with the request in the loop thread once it is.
+    A multipart request is done at the last part of its reply.
+    """
+    def __init__(self, data, callback=None, loop=None):
+        self.data = data
+        self.callback = callback
+        # the loop whose thread reads the replies.
+        self.loop = loop
+        self.xid = None
+        # the reply messages, in order.
+        self.replies = []
+        # the error message from the switch, or a description.
+        self.error = None
+        self.finished = threading.Event()
+
+    def done(self):
+        return self.finished.is_set()
+
+    def wait(self, timeout=None):
+        """
+        wait for the request to finish, and return its replies.
+        Raises OFRequestError if it failed, or if it isn't done and 
+        this is the loop thread, which would wait for the replies it 
+        has to read itself. (use a callback there.)
+        """
+        if not self.finished.is_set() and self.loop is not None \
+            and self.loop.inLoopThread():
+            raise OFRequestError("can't wait for request %s in the loop "\
+                "thread"%self.xid)
+        if not self.finished.wait(timeout):
+            raise OFRequestError("no reply to request %s yet"%self.xid)
+        if self.error is not None:
+            raise OFRequestError(self.error)
+        return self.replies
+
+
+class BaseProxy(object):
+    """
+    Simple proxy between an OpenFlow switch and a controller.
+    The proxy can take an intercept method for each direction.
+    If one is provided, the proxy passes messages to that method,
+    instead of forwarding them.
+    Also sends keepalive echos to the switch.
+    Messages a direction doesn't need to see are spliced from one 
+    socket to the other in the kernel: every message, in a direction 
+    without an intercept method, or, with one, messages of the types 
+    the direction's passthrough filter accepts. 
+    (passthrough(messageType) -> True if the message can skip the 
+    intercept method)
+    All of the proxy's sockets are serviced by an EventLoop, which
+    can be shared by the proxies of many switches.
+
+    sendRequest sends a request to the switch for the proxy's owner. 
+    Its xid is rewritten to one that the controller isn't using, and 
+    the replies with that xid go to the request, not to the 
+    controller. Any number of requests can be in flight. 
+    The proxy notes the xid of every message from the controller. A 
+    request gets an xid that the controller hasn't used in the last 
+    controllerXidAge seconds. A controller message that reuses the 
+    xid of a request in flight gets another xid on its way to the 
+    switch, and the replies to it get the controller's xid back.
+    """
+    echoInterval = 2
+    connectRetryDelay = 1
+    # the proxy's xids count up from here, where controllers, which 
+    # count up from 0 or pick at random, rarely are.
+    requestXidStart = 0xff000000
+    # seconds that the controller's xids stay reserved.
+    controllerXidAge = 30
+    # seconds before a request without a reply fails.
+    requestTimeout = 10
+
+    def __init__(self, controllerIp, controllerPort, \
+        switchListenIp, switchListenPort, \
+        controlInterceptMethod = None, switchInterceptMethod = None,
+        printfcn = None, loop = None, \
+        controlPassthrough = None, switchPassthrough = None, \
+        switchClosedMethod = None):
+        self.controllerIp = controllerIp
+        self.controllerPort = controllerPort
+        self.switchListenIp = switchListenIp
+        self.switchListenPort = switchListenPort
+        self.switchInterceptMethod = switchInterceptMethod
+        self.controlInterceptMethod = controlInterceptMethod
+        # called once the switch connection closes.
+        self.switchClosedMethod = switchClosedMethod
+        self.dprint = printfcn
+        if self.dprint is None:
+            self.dprint = print
+        if loop is None:
+            loop = getEventLoop()
+        self.loop = loop
+        # sockets to switch and controller.
+        self.switchSock = None
+        self.controllerSock = None
+        self.listenSock = None
+        self.connectingSock = None
+        # connections to switch and controller. Messages sent
+        # before a connection is up are queued.
+        self.switchConn = OFConnection(loop, "s->c", \
+            self.fromSwitch, self.connectionEnded)
+        self.controllerConn = OFConnection(loop, "c->s", \
+            self.fromController, self.connectionEnded)
+        # a congested send queue pauses reads on the other side.
+        self.switchConn.peer = self.controllerConn
+        self.controllerConn.peer = self.switchConn
+        # messages that can skip the intercept methods are spliced.
+        if switchInterceptMethod is None:
+            switchPassthrough = passAll
+        if controlInterceptMethod is None:
+            controlPassthrough = passAll
+        self.switchPassthrough = switchPassthrough
+        self.controlPassthrough = controlPassthrough
+        if switchPassthrough is not None:
+            self.switchConn.spliceFilter = self.spliceFromSwitch
+        if controlPassthrough is not None:
+            self.controllerConn.spliceFilter = self.spliceFromController
+        # the proxy's own requests in flight, by xid.
+        self.pendingRequests = {}
+        self.requestLock = threading.Lock()
+        self.nextRequestXid = self.requestXidStart
+        # when each xid was last used by the controller, oldest first, 
+        # and the controller's xid of the messages the proxy gave 
+        # another one, by that one. (both kept for controllerXidAge)
+        self.controllerXids = collections.OrderedDict()
+        self.remappedXids = {}
+
+        self.controllerConnected = False
+        self.switchConnected = False
+
+    def startProxy(self):
+        """
+        Starts the proxy. Returns right away, the connections
+        are made by the event loop.
+        """
+        self.loop.callFromThread(self.connectController)
+        self.dprint ("connecting to controller at IP: %s port: %s (retrying every second)"%(self.controllerIp, self.controllerPort))
+
+    def runProxy(self):
+        """
+        run the event loop in this thread.
+        """
+        self.loop.run()
+
+    def sendToSwitch(self, data, lane=None):
+        self.switchConn.send(data, lane=lane)
+
+    def sendToController(self, data, lane=None):
+        self.controllerConn.send(data, lane=lane)
+
+    def sendRequest(self, data, callback=None, timeout=None, lane=None):
+        """
+        send an OpenFlow request to the switch, and collect its 
+        replies instead of passing them to the controller. 
+        Returns an OFRequest. Can be called from any thread.
+        """
+        request = OFRequest(data, callback, self.loop)
+        with self.requestLock:
+            if self.switchConn.closed:
+                request.error = "connection closed"
+                request.finished.set()
+                if callback is not None:
+                    self.loop.callFromThread(callback, request)
+                return request
+            request.xid = self.allocateXid()
+            self.pendingRequests[request.xid] = request
+        data = bytearray(data)
+        struct.pack_into("!I", data, 4, request.xid)
+        if timeout is None:
+            timeout = self.requestTimeout
+        self.loop.callLater(timeout, self.failRequest, request, \
+            "request %s timed out"%request.xid)
+        self.switchConn.send(bytes(data), lane=lane)
+        return request
+
+    def allocateXid(self):
+        """
+        the next xid that neither the proxy nor the controller is 
+        using. (call with requestLock held)
+        """
+        while True:
+            xid = self.nextRequestXid
+            self.nextRequestXid = (xid + 1) & 0xffffffff
+            if xid not in self.pendingRequests \
+                and xid not in self.controllerXids:
+                return xid
+
+    def noteControllerXid(self, xid):
+        """
+        the controller used xid just now. (call with requestLock held)
+        """
+        xids = self.controllerXids
+        now = time.time()
+        xids.pop(xid, None)
+        xids[xid] = now
+        while xids:
+            oldXid = next(iter(xids))
+            if now - xids[oldXid] < self.controllerXidAge:
+                return
+            del xids[oldXid]
+            self.remappedXids.pop(oldXid, None)
+
+    def controllerXid(self, data):
+        """
+        notes the xid of a message from the controller. Returns the 
+        message, with another xid if a request of the proxy has its xid.
+        """
+        xid = struct.unpack_from("!I", data, 4)[0]
+        with self.requestLock:
+            self.noteControllerXid(xid)
+            if xid not in self.pendingRequests:
+                return data
+            newXid = self.allocateXid()
+            self.noteControllerXid(newXid)
+            self.remappedXids[newXid] = xid
+        data = bytearray(data)
+        struct.pack_into("!I", data, 4, newXid)
+        return bytes(data)
+
+    def restoreXid(self, data):
+        """
+        gives a reply to a controller message that got another xid 
+        the controller's xid back.
+        """
+        xid = struct.unpack_from("!I", data, 4)[0]
+        with self.requestLock:
+            controllerXid = self.remappedXids.get(xid)
+        if controllerXid is None:
+            return data
+        data = bytearray(data)
+        struct.pack_into("!I", data, 4, controllerXid)
+        return bytes(data)
+
+    def takeReply(self, data):
+        """
+        if data is a reply to one of the proxy's requests, add it 
+        to the request and return True.
+        """
+        xid = struct.unpack_from("!I", data, 4)[0]
+        with self.requestLock:
+            request = self.pendingRequests.get(xid)
+            if request is None:
+                return False
+            msgType, = struct.unpack_from("!B", data, 1)
+            if msgType == OFPT_MULTIPART_REPLY and len(data) >= 12 \
+                and struct.unpack_from("!H", data, 10)[0] & OFPMPF_REPLY_MORE:
+                request.replies.append(copyBytes(data))
+                return True
+            del self.pendingRequests[xid]
+        if msgType == OFPT_ERROR:
+            request.error = copyBytes(data)
+        else:
+            request.replies.append(copyBytes(data))
+        self.finishRequest(request)
+        return True
+
+    def cancelRequest(self, request):
+        """
+        stop waiting for the replies to a request that won't get any 
+        (a flow mod, once a barrier after it is answered). Its 
+        callback is not called.
+        """
+        with self.requestLock:
+            if self.pendingRequests.get(request.xid) is request:
+                del self.pendingRequests[request.xid]
+
+    def failRequest(self, request, reason):
+        with self.requestLock:
+            if self.pendingRequests.get(request.xid) is not request:
+                return
+            del self.pendingRequests[request.xid]
+        request.error = reason
+        self.finishRequest(request)
+
+    def finishRequest(self, request):
+        request.finished.set()
+        if request.callback is not None:
+            self.loop.dispatch(request.callback, (request,))
+
+    def spliceFromSwitch(self, messageType, xid):
+        """
+        splice filter of the switch connection. Replies to the 
+        proxy's requests in flight have to be picked out, and replies 
+        to remapped controller messages need their xid back.
+        """
+        return xid not in self.pendingRequests \
+            and xid not in self.remappedXids \
+            and self.switchPassthrough(messageType)
+
+    def spliceFromController(self, messageType, xid):
+        """
+        splice filter of the controller connection. A message whose 
+        xid a request of the proxy has isn't spliced, so it can get 
+        another one.
+        """
+        with self.requestLock:
+            self.noteControllerXid(xid)
+            collides = xid in self.pendingRequests
+        return not collides and self.controlPassthrough(messageType)
+
+    def connectController(self):
+        """
+        start a non-blocking connect to the controller.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        err = sock.connect_ex((self.controllerIp, self.controllerPort))
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            # retry connection until controller is up.
+            sock.close()
+            self.loop.callLater(self.connectRetryDelay, self.connectController)
+            return
+        self.connectingSock = sock
+        self.loop.register(sock.fileno(), None, self.finishConnectController)
+        self.loop.setInterest(sock.fileno(), False, True)
+
+    def finishConnectController(self):
+        sock = self.connectingSock
+        self.connectingSock = None
+        self.loop.unregister(sock.fileno())
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+            sock.close()
+            self.loop.callLater(self.connectRetryDelay, self.connectController)
+            return
+        self.controllerSock = sock
+        self.controllerConn.attach(sock)
+        self.controllerConnected = True
+        self.dprint ("\tcontroller connected.")
+        # listen for a connection from the switch.
+        self.listenSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listenSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listenSock.bind((self.switchListenIp, self.switchListenPort))
+        self.listenSock.listen(5)
+        self.listenSock.setblocking(0)
+        self.loop.register(self.listenSock.fileno(), self.acceptSwitch, None)
+        self.loop.setInterest(self.listenSock.fileno(), True, False)
+        self.dprint ("waiting for connection from switch. Listening on port: %s"%self.switchListenPort)
+
+    def acceptSwitch(self):
+        try:
+            sock, addr = self.listenSock.accept()
+        except socket.error as e:
+            if e.errno in retryErrors:
+                return
+            raise
+        # one switch per proxy.
+        self.loop.unregister(self.listenSock.fileno())
+        self.switchSock, self.switchAddr = sock, addr
+        self.switchConn.attach(sock)
+        self.switchConnected = True
+        self.dprint ("\tconnection from switch at %s recieved"%str(self.switchAddr))
+        # start up the echo loop to keep the switch alive.
+        self.dprint("starting echo loop to keep switch alive.")
+        self.loop.callLater(1, self.echoLoop)
+
+    def fromSwitch(self, data):
+        if self.pendingRequests and self.takeReply(data):
+            return
+        if self.remappedXids:
+            data = self.restoreXid(data)
+        if self.switchInterceptMethod == None:
+            self.controllerConn.send(data)
+        else:
+            self.switchInterceptMethod(data)
+
+    def fromController(self, data):
+        data = self.controllerXid(data)
+        if self.controlInterceptMethod == None:
+            self.switchConn.send(data)
+        else:
+            self.controlInterceptMethod(data)
+
+    def connectionEnded(self, conn):
+        """
+        end of a socket? Close the other side too.
+        """
+        self.dprint("SOCKET ENDED (%s)"%conn.name)
+        for other in (self.switchConn, self.controllerConn):
+            if other is not conn:
+                other.close()
+        if conn is self.switchConn and self.switchClosedMethod is not None:
+            self.switchClosedMethod()
+        # requests in flight won't get replies now.
+        for request in list(self.pendingRequests.values()):
+            self.failRequest(request, "connection closed")
+
+    def echoLoop(self):
+        """
+        sends an OpenFlow 1.3 echo request every echoInterval seconds.
+        This stops the switch from breaking the connection when it
+        is overloaded.
+        """
+        if self.switchConn.closed:
+            return
+        echoReqMsg = struct.pack("!BBHI", 4, 2, 8, 666)
+        self.switchConn.send(echoReqMsg)
+        self.loop.callLater(self.echoInterval, self.echoLoop)
@@ -0,0 +1,220 @@
+"""
+How full the switch's flow tables are with the rules that the agent
+installs for modules, so the tables don't fill up.
+Each table has a budget of rules. The rules of a table are kept in
+least recently used order: a rule is used when it is installed
+(again), and when its counters move between two flow stats polls.
+When a table is over its budget, the least recently used rules are
+evicted: the agent deletes them.
+Only rules with OFPFF_SEND_FLOW_REM are tracked. The switch reports
+their removal, for an eviction, a timeout or any other delete, with
+the rule's final counters, so the agent can give the counters back
+to the module that owns the rule (cookie = module id).
+A rule is identified by its table, priority and every field of its
+match, so flow mods, flow stats and flow removed messages all find
+it. The match is put in a canonical form first (see matchKey): the
+switch doesn't have to send it back in the order, or with the masks,
+that it was installed with.
+"""
+import struct, threading
+from collections import OrderedDict
+
+from ofFlowStats import FlowStatsTable, oxmHeader, OXM_CLASS_BASIC
+from flowModTemplate import OFPFC_ADD, OFPFC_DELETE_STRICT
+from flowModTemplate import OFPFF_SEND_FLOW_REM
+# ofp_flow_mod: table id, command, ..., priority, and flags.
+flowModFields = struct.Struct("!BB4xH12xH")
+flowModFieldsIdx = 24
+# ofp_flow_removed: cookie, priority, reason, table id, durations,
+# timeouts, packet count, byte count. The match is at 48.
+flowRemovedFields = struct.Struct("!QHBBIIHHQQ")
+flowRemovedFieldsIdx = 8
+matchIdx = 48
+
+oxmColumns = FlowStatsTable.oxmColumns
+
+
+def matchKey(data, off):
+    """
+    the OXM fields of the ofp_match at off, as a sorted tuple of 
+    (class, field, value). A masked field's value is the masked 
+    value followed by the mask. Fields with an all ones mask are 
+    unmasked, and ones with an all zeros mask are left out.
+    """
+    matchLen = struct.unpack_from("!H", data, off + 2)[0]
+    fields = []
+    pos = off + 4
+    end = off + matchLen
+    while pos + oxmHeader.size <= end:
+        oxmClass, fieldAndMask, oxmLen = oxmHeader.unpack_from(data, pos)
+        pos += oxmHeader.size
+        value = bytes(data[pos:pos+oxmLen])
+        pos += oxmLen
+        if fieldAndMask & 1:
+            half = oxmLen // 2
+            value, mask = bytearray(value[:half]), bytearray(value[half:])
+            if not any(mask):
+                continue
+            if all(b == 0xff for b in mask):
+                value = bytes(value)
+            else:
+                value = bytes(bytearray(v & m for v, m in zip(value, mask)) \
+                    + mask)
+        fields.append((oxmClass, fieldAndMask >> 1, value))
+    return tuple(sorted(fields))
+
+def ruleKey(tableId, priority, data, off):
+    """
+    the key of a rule, from its table, priority and the ofp_match 
+    at off in data.
+    """
+    return (tableId, priority, matchKey(data, off))
+
+def flowModRuleKey(data):
+    """
+    the key of the rule that a flow mod names, whatever its command.
+    """
+    tableId, command, priority, flags = flowModFields.unpack_from(data, \
+        flowModFieldsIdx)
+    return ruleKey(tableId, priority, data, matchIdx)
+
+def flowModRule(data):
+    """
+    the key of the rule that a flow mod adds, or None if the flow
+    mod isn't an add of a rule whose removal the switch reports.
+    """
+    tableId, command, priority, flags = flowModFields.unpack_from(data, \
+        flowModFieldsIdx)
+    if command != OFPFC_ADD or not flags & OFPFF_SEND_FLOW_REM:
+        return None
+    return ruleKey(tableId, priority, data, matchIdx)
+
+def flowRemovedKey(data):
+    """
+    the key of the rule in a flow removed message.
+    """
+    return flowRemovedRule(data)[0]
+
+def flowRemovedRule(data):
+    """
+    the key, cookie, packet count and byte count of the rule in a
+    flow removed message.
+    """
+    (cookie, priority, reason, tableId, durationSec, durationNsec, \
+        idleTimeout, hardTimeout, packetCount, byteCount) = \
+        flowRemovedFields.unpack_from(data, flowRemovedFieldsIdx)
+    key = ruleKey(tableId, priority, data, matchIdx)
+    return key, cookie, packetCount, byteCount
+
+def rowRule(flowTable, i):
+    """
+    the key of the rule in row i of a FlowStatsTable.
+    """
+    return ruleKey(flowTable.tableId[i], flowTable.priority[i], \
+        flowTable.matches[i], 0)
+
+def strictDelete(data):
+    """
+    a DELETE_STRICT of the rule that a flow mod adds.
+    """
+    data = bytearray(data)
+    data[flowModFieldsIdx + 1] = OFPFC_DELETE_STRICT
+    return bytes(data)
+
+
+def ruleFields(key):
+    """
+    the unmasked match fields of a rule key that have a column in a 
+    FlowStatsTable, by column name. (0 if the rule doesn't match on 
+    the field.)
+    """
+    fields = dict((name, 0) for name, fmt in oxmColumns.values())
+    for oxmClass, field, value in key[2]:
+        column = oxmColumns.get(field)
+        if oxmClass == OXM_CLASS_BASIC and column is not None \
+            and len(value) == struct.calcsize(column[1]):
+            fields[column[0]] = struct.unpack(column[1], value)[0]
+    return fields
+
+
+class Rule(object):
+    def __init__(self, key, moduleId, flowMod):
+        self.key = key
+        self.moduleId = moduleId
+        # the flow mod that added the rule.
+        self.flowMod = flowMod
+
+
+class RuleOccupancy(object):
+    def __init__(self, defaultBudget):
+        self.defaultBudget = defaultBudget
+        # table id -> budget, for the tables that don't have the default.
+        self.budgets = {}
+        # table id -> {rule key: Rule}, least recently used first.
+        self.tables = {}
+        # evicted rules, until the switch reports their removal.
+        self.evicting = {}
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(table) for table in self.tables.values())
+
+    def setBudget(self, tableId, budget):
+        with self.lock:
+            self.budgets[tableId] = budget
+
+    def admit(self, key, moduleId, flowMod):
+        """
+        a rule is being added (again). Returns the rules to evict to
+        keep its table within its budget, least recently used first.
+        """
+        with self.lock:
+            table = self.tables.setdefault(key[0], OrderedDict())
+            table.pop(key, None)
+            table[key] = Rule(key, moduleId, flowMod)
+            budget = self.budgets.get(key[0], self.defaultBudget)
+            victims = []
+            while len(table) > budget:
+                victimKey, victim = table.popitem(last=False)
+                self.evicting[victimKey] = victim
+                victims.append(victim)
+            self.evicted += len(victims)
+            return victims
+
+    def used(self, key):
+        """
+        the rule was used, if it is tracked.
+        """
+        with self.lock:
+            table = self.tables.get(key[0])
+            if table is not None and key in table:
+                table[key] = table.pop(key)
+
+    def touch(self, flowTable):
+        """
+        the rules in flowTable were used. (their counters moved.)
+        """
+        with self.lock:
+            for i in range(len(flowTable)):
+                key = rowRule(flowTable, i)
+                table = self.tables.get(key[0])
+                if table is not None and key in table:
+                    table[key] = table.pop(key)
+
+    def removed(self, key):
+        """
+        the rule is gone from the switch, or never got there. Returns 
+        its Rule, or None if it isn't tracked.
+        """
+        with self.lock:
+            # (an evicted rule can be added again before its removal 
+            # is reported.)
+            rule = self.evicting.pop(key, None)
+            if rule is not None:
+                return rule
+            table = self.tables.get(key[0])
+            if table is None:
+                return None
+            return table.pop(key, None)
@@ -20,12 +20,14 @@ def main():
     print ("done.")
     print ("configuring interconnects between all OFX agents and switches.")
     # Configure all the switches to interconnect with their OFX agent.
+    ofxCfgs = []
     for i in range(len(switchIds)):
         ofxCfg = OfxInstance(switchIds[i], switchNames[i], tapInterfaces[i], listenPorts[i], internalPorts[i])
         ofxCfg.setupFastPath()
         ofxCfg.setupControllerPath()
-        ofxCfg.getStartCommand()
+        ofxCfgs.append(ofxCfg)
         time.sleep(.1)
+    getStartCommand(ofxCfgs)
     print "to stop all agents, use stopAgents.sh"
 
 # compile OFX.
@@ -75,14 +77,23 @@ class OfxInstance(object):
         cmd = "sudo ovs-vsctl set bridge %s protocols=OpenFlow13,OpenFlow10,OpenFlow11"%self.switchName
         subprocess.Popen(cmd, shell=True)
         print ("done.")
-    def getStartCommand(self):
+    def agentArgs(self):
         """
-        Print the command that actually starts the OFX agent. 
+        The per switch arguments of switchAgent.py.
         """
-        cmd = ['sudo', 'python', 'switchAgent.py'] + ["mininet", controllerip, str(controllerport), '127.0.0.1', str(self.listenPort), self.switchName, self.tapInterface, str(self.datapathPort), str(self.internalPort)]
-        cmdStr = " ".join(cmd)
-        print ("to start OFX agent %s for switch %s, run:"%(self.agentId, self.switchName))
-        print cmdStr        
+        return ['127.0.0.1', str(self.listenPort), self.switchName, self.tapInterface, str(self.datapathPort), str(self.internalPort)]
+
+def getStartCommand(ofxCfgs):
+    """
+    Print the command that actually starts the OFX agents. 
+    One process runs the agents for all the switches.
+    """
+    cmd = ['sudo', 'python', 'switchAgent.py'] + ["mininet", controllerip, str(controllerport)]
+    for ofxCfg in ofxCfgs:
+        cmd += ofxCfg.agentArgs()
+    cmdStr = " ".join(cmd)
+    print ("to start the OFX agents for switches %s, run:"%(", ".join([c.switchName for c in ofxCfgs])))
+    print cmdStr        
 
 if __name__ == '__main__':
     main()
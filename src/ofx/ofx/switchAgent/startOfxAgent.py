@@ -15,16 +15,18 @@ internalPorts = [22000 + sid for sid in switchIds]
 def main():
     # compile OFX (for all switches)
     compileOFX()
-    # Start OFX Process for each switch that proxies between the switch and the controller, and has an 
+    # Set up an OFX instance for each switch that proxies between the switch and the controller, and has an 
     # additional fast-path connection to the switch.
     ofxObjs = []
     for i in range(len(switchIds)):
-        print ("spawning agent for switch %s"%i)
+        print ("setting up agent for switch %s"%i)
         ofxProc = OfxInstance(switchNames[i], tapInterfaces[i], listenPorts[i], internalPorts[i])
         ofxProc.spawnTap()
-        ofxProc.startAgent('127.0.0.1', 6633)
+        ofxProc.pointSwitchAtAgent()
         ofxObjs.append(ofxProc)
         time.sleep(.1)
+    # One OFX process runs the agents of all the switches.
+    agentProcess = startAgents(ofxObjs, '127.0.0.1', 6633)
     print ("OFX should be running, press ctrl-c to quit.")
     print ("waiting 10 seconds for OFX to start..")
     time.sleep(10)
@@ -63,28 +65,39 @@ class OfxInstance(object):
         cmd = "sudo ifconfig %s promisc"%self.tapInterface
         subprocess.call(cmd, shell=True)
 
-    def startAgent(self, controllerip, controllerport):
+    def pointSwitchAtAgent(self):
         """
-        Start the OFX agent for the switch.
-        echo "calling: sudo python switchAgent.py $1 $controllerip $controllerport $listenip $listenport $bridgename $ethinterface $ofport &"
-        sudo python switchAgent.py $1 $controllerip $controllerport $listenip $listenport $bridgename $ethinterface $ofport &        
+        Make the OFX agent the switch's controller.
         """
         cmd = 'sudo ovs-vsctl set-controller %s tcp:127.0.0.1:%s'%(self.switchName, self.listenPort)
         subprocess.Popen(cmd, shell=True)
 
-        cmd = ['sudo', 'python', 'switchAgent.py'] + ["mininet", controllerip, str(controllerport), '127.0.0.1', str(self.listenPort), self.switchName, self.tapInterface, str(self.datapathPort), str(self.internalPort)]
-        # cmd = "sudo python switchAgent.py %s %s %s %s %s %s %s %s &"%\
-        # ("mininet", controllerip, controllerport, '127.0.0.1', self.listenPort, self.switchName, self.tapInterface, self.datapathPort)
-        print cmd        
-        self.agentProcess = subprocess.Popen(cmd)
-        print ("agent started for %s"%self.switchName)
-    def shutDown(self):
+    def agentArgs(self):
         """
-        Shut down this OFX instance.
+        The per switch arguments of switchAgent.py.
         """
-        print ("shutting down OFX agent for %s"%self.switchName)
-        self.agentProcess.terminate()
-        return
+        return ['127.0.0.1', str(self.listenPort), self.switchName, self.tapInterface, str(self.datapathPort), str(self.internalPort)]
+
+def startAgents(ofxObjs, controllerip, controllerport):
+    """
+    Start one OFX agent process for all the switches.
+    sudo python switchAgent.py mininet $controllerip $controllerport [$listenip $listenport $bridgename $ethinterface $ofport $internalport]...
+    """
+    cmd = ['sudo', 'python', 'switchAgent.py', "mininet", controllerip, str(controllerport)]
+    for ofxObj in ofxObjs:
+        cmd += ofxObj.agentArgs()
+    print cmd
+    agentProcess = subprocess.Popen(cmd)
+    print ("agent started for %s"%", ".join([o.switchName for o in ofxObjs]))
+    return agentProcess
+
+def shutDown(agentProcess):
+    """
+    Shut down the OFX agent process.
+    """
+    print ("shutting down OFX agents")
+    agentProcess.terminate()
+    return
 
 if __name__ == '__main__':
     main()
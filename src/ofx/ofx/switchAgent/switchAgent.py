@@ -3,17 +3,22 @@ A driver that runs on the switch.
 """
 from __future__ import print_function
 import time, sys, struct, threading, socket, os, signal
-import cPickle as pickle
 import imp
 import importlib
 import subprocess
 import struct
 import random
+import Queue
 
 import twink.ofp4.build as ofbuild
 import twink.ofp4.parse as ofparse
 import twink.ofp4.oxm as oxm
 
+# the helpers shared with the controller library (ofxCodec, ofxStream, 
+# flowDeltas) live in controllerLib.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+    "..", "controllerLib"))
+
 # ryu imports to add flows faster.
 from ryu.controller import ofp_event
 from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER
@@ -21,7 +26,27 @@ from ryu.controller.handler import set_ev_cls
 from ryu.ofproto import ofproto_v1_3 as ofproto
 from ryu.ofproto import ofproto_v1_3_parser as parser
 
-import Queue
+from ofProxyCore import BaseProxy, getEventLoop, ofTypeCode, copyBytes
+from ofProxyCore import LANE_URGENT, LANE_EVENT, LANE_CONTROL, LANE_BULK
+from ofProxyCore import OFRequestError, OFPT_BARRIER_REQUEST
+from ofFlowStats import buildFlowStatsRequest, parseFlowStatsReplies, OFPTT_ALL
+from ofFlowStats import FlowStatsPoller, COOKIE_MASK_ALL
+from flowCounters import FlowCounterStore
+from flowModScheduler import FlowModScheduler
+from flowModScheduler import FLOWMOD_URGENT, FLOWMOD_NORMAL, FLOWMOD_BULK
+from flowModTemplate import FlowModTemplate, gotoTable, applyActions
+from flowModTemplate import outputAction, OFPP_FLOOD, OFPFC_DELETE_STRICT
+from flowModTemplate import ipv4Bytes, OFPFF_SEND_FLOW_REM
+from flowModTemplate import parseMatchPattern
+from ofPortDesc import buildPortDescRequest, parsePortDescReplies
+from flowShadowTable import FlowShadowTable
+from ruleOccupancy import RuleOccupancy, ruleFields, strictDelete
+from ruleOccupancy import flowModRule, flowRemovedRule
+from ofxCodec import Schema, BYTES, STRING
+from ofxStream import StreamSender, StreamReceiver, streamMessageKind
+from ofxStream import OFX_STREAM_MODULE, STREAM_FRAGMENT, STREAM_ACK
+from ofxStream import STREAM_HELLO
+from ofxStream import compressThreshold
 
 
 ofctlbin = None
@@ -34,9 +59,21 @@ OFX_MANAGEMENT_MODULE=0xffffffff
 # OFX management message types.
 # start load files message, send files, end message.
 OFX_LOAD_MODULE_START=0x1 # payload: string containing module name.
-OFX_LOAD_MODULE_FILE=0x2 # payload: pickled tuple: (filename, contents)
+OFX_LOAD_MODULE_FILE=0x2 # payload: moduleFileSchema: (filename, contents)
 OFX_LOAD_MODULE_END=0x3 # payload: compilation instructions.
-OFX_LOAD_MODULE_FILE_PIECE=0x4 # payload: pickled tuple: (filename, total len, contents)
+OFX_LOAD_MODULE_FILE_PIECE=0x4 # payload: moduleFilePieceSchema: (filename, total len, contents)
+
+moduleFileSchema = Schema(1, [('fileName', STRING), ('contents', BYTES)])
+moduleFilePieceSchema = Schema(1, [('fileName', STRING), ('totalLen', 'I'), \
+    ('contents', BYTES)])
+
+# Envelopes: many module messages in one OFX message (experimenter 
+# type OFX_ENVELOPE_MODULE). Each one is:
+# | module id (4) | message type (4) | content length (4) | content |
+OFX_ENVELOPE_MODULE=0xfffffffd
+envelopeHeader = struct.Struct("!Iii")
+# content bytes per envelope. (an OpenFlow message is at most 64kB.)
+envelopeMaxLen = 60000
 
 # OFX management agent <--> datapath agent format:
 # | Message length | Module ID | Message Type | Content 
@@ -59,35 +96,58 @@ OFX_ADD_TCP_FLOW = 0x4 # datapath -> management: add an OpenFlow Rule.
 # Add tcp flow counter message content: 12 bytes
 # | Src IP | Dst IP | Src Port | Dst Port | ( 4 | 4 | 2 | 2) 
 
+OFX_FLOW_DEMOTED = 0x5 # management -> datapath: a flow rule of the module was removed.
+# (demoted, evicted or timed out.) Its final counts:
+# | Src IP | Dst IP | Src Port | Dst Port | IP proto | pad | packet count | byte count
+# ( 4 | 4 | 2 | 2 | 1 | 3 | 8 | 8)
+flowDemotedStruct = struct.Struct("!4s4sHHB3xQQ")
+
+OFX_SET_OFFLOAD_BUDGET = 0x6 # management -> datapath: offload policy settings.
+# | Budget (flows with counting rules) | Min volume per epoch | ( 4 | 4 )
+
 
 class SwitchAgent(object):
 
-    flowModQueue = Queue.LifoQueue()
-    flowModRate = 10
-    flowModDelay = 1.0/flowModRate
-    # some definitions we don't use.
-    buffer_size = 4096
-    delay = 0.00001
+    # flow mods per second, at first. (the scheduler adapts it to 
+    # the switch.)
+    flowModRate = 100
+    # the dp agent promotes its heaviest udp flows to counting rules. 
+    # A rule that counts fewer than coldFlowPackets packets between 
+    # two polls is demoted.
+    offloadPollInterval = 5.0
+    coldFlowPackets = 10
+    # the rules that the agent installs for the datapath agents time 
+    # out when idle, and the switch reports their removal. Each table 
+    # holds at most tableRuleBudget of them: past that, the least 
+    # recently used ones are evicted. (use is polled every 
+    # ruleUsePollInterval.)
+    ruleIdleTimeout = 60
+    ruleHardTimeout = 0
+    tableRuleBudget = 1000
+    ruleUsePollInterval = 5.0
     # the name of the file that the data path agent loads. 
     # (must agree with definition in dp agent)
     dpAgentSharedObject = "ofxmodule.so"
     tempDir = "./tempFiles/"
     sys.path.insert(0, tempDir)
     actionTable=66
-    loadedModules = {}
-
-    # ordered lists of functions to call 
-    # for each type of OpenFlow message.
-
-    OFInterceptors = {\
-    'ofp_packet_in':[],\
-    'ofp_packet_out':[],\
-    'ofp_flow_mod':[],\
-    'ofp_multipart_reply':[]\
-    }
-    
-    moduleHandlers = {}
-    dpModuleHandlers = {}
+    # send lanes for injectToSwitch / injectToController, so modules 
+    # don't have to import the proxy core.
+    LANE_URGENT = LANE_URGENT
+    LANE_EVENT = LANE_EVENT
+    LANE_CONTROL = LANE_CONTROL
+    LANE_BULK = LANE_BULK
+    # raised by OFRequest.wait() (see sendOFRequest).
+    OFRequestError = OFRequestError
+    # cookie mask for a module's own flows (see subscribeFlowStats).
+    COOKIE_MASK_ALL = COOKIE_MASK_ALL
+    # per flow counter time series, for modules that compute rates.
+    FlowCounterStore = FlowCounterStore
+    # flow mod priority classes (see setFlowModClass).
+    FLOWMOD_URGENT = FLOWMOD_URGENT
+    FLOWMOD_NORMAL = FLOWMOD_NORMAL
+    FLOWMOD_BULK = FLOWMOD_BULK
+
     class FakeDp(object):
         class FakeProto(object):
             OFP_HEADER_SIZE= 8
@@ -110,27 +170,84 @@ class SwitchAgent(object):
         Startup that should be called after constructor.
         """
         # 3: spawn the proxy to the OpenFlow controller and switch.
+        # The proxy runs in the event loop shared by all the agents 
+        # in this process.
         self.OFProxy = BaseProxy(controllerOFIp, controllerOFPort, \
             switchListenIp, switchListenPort,\
             controlInterceptMethod = self.interceptFromControlOF,\
             switchInterceptMethod = self.interceptFromSwitchOF, \
-            switchAgent=self)
-        #    This does not return until the connections are established.
+            printfcn=self.dprint, loop=getEventLoop(), \
+            controlPassthrough = self.isPassthrough, \
+            switchPassthrough = self.isPassthrough, \
+            switchClosedMethod = self.flowMods.close)
+        #    This returns right away. The connections are made 
+        #    once the event loop runs.
         self.OFProxy.startProxy()
 
         # This adds a low priority rule to skip OFX. Need 
         # to correctly set up the pipeline.
+        # (queued until the switch connects.)
         self.setupOFXTables()
-        # now this thread can stick around and see if everything 
-        # is still running.
-        # proxy threads..
-        # data path agent...
     def __init__(self, platform, controllerOFIp, controllerOFPort, \
         switchListenIp, switchListenPort,\
         activeBridgeName, datapathLink, datapathLinkId, internalPort):
         global ofctlbin
         # Open the debug file.
         self.logf = sys.stdout
+        # per agent state. (many agents can share one process.)
+        self.loadedModules = {}
+        # ordered lists of functions to call 
+        # for each type of OpenFlow message, by type code.
+        # messages of other types are forwarded without parsing.
+        self.OFInterceptors = {}
+        # the message the interceptors are looking at, and its 
+        # twink parse, if an interceptor asked for it.
+        self.interceptedMessage = None
+        self.interceptedParse = None
+        self.moduleHandlers = {}
+        self.dpModuleHandlers = {}
+        # modules that the dp worker is importing, and the messages 
+        # to modules with no handler yet, held until they are loaded.
+        self.modulesLoading = 0
+        self.heldModuleMessages = []
+        # the module whose datapath component is loaded. Flows the 
+        # datapath agent asks for get its id as their cookie.
+        self.dpModuleId = 0
+        self.dpSock = None
+        # messages to the datapath agent, and datapath module loads, 
+        # are done in order by the dp worker thread, so the event 
+        # loop never waits for them.
+        self.startDpWorker()
+        # one flow table poll per interval, for every module.
+        self.statsPoller = FlowStatsPoller(self.requestFlowStats, self.dprint)
+        # paced, confirmed installation of the modules' flow mods.
+        self.flowMods = FlowModScheduler(self.sendOFRequest, \
+            self.sendBarrier, self.cancelOFRequest, getEventLoop(), \
+            self.dprint, self.flowModRate)
+        # the rules in the switch's tables, so redundant adds from 
+        # modules are dropped. It follows the controller's flow mods 
+        # and the switch's flow removed messages and errors too.
+        self.shadowTable = FlowShadowTable()
+        self.registerOFInterceptor('ofp_flow_mod', self.shadowFlowMod)
+        self.registerOFInterceptor('ofp_flow_removed', self.flowRemoved)
+        self.registerOFInterceptor('ofp_error_msg', self.shadowError)
+        # the datapath's counting rules, and their packet counts at 
+        # the last poll. (watched once the datapath offloads a flow, 
+        # for the module that the datapath runs.)
+        self.offloadWatch = None
+        self.offloadWatchModuleId = None
+        self.offloadedCounts = {}
+        # how full each flow table is with the modules' rules.
+        self.occupancy = RuleOccupancy(self.tableRuleBudget)
+        # flow stats subscriptions that touch the tracked rules, by 
+        # the cookie they poll.
+        self.ruleUseWatches = {}
+        self.ruleUseLock = threading.Lock()
+        self.setRuleTimeouts(self.ruleIdleTimeout, self.ruleHardTimeout)
+        # streams of large messages to and from the controller.
+        self.streamSender = StreamSender(self.sendStreamMessage)
+        self.streamReceiver = StreamReceiver(self.deliverStreamMessage, \
+            self.sendStreamMessage, self.dprint)
         # self.logf = open("%s-switchagent.log"%activeBridgeName,"w", buffering=1)
 
 
@@ -144,6 +261,12 @@ class SwitchAgent(object):
         self.datapathLink = datapathLink
         self.datapathLinkId = datapathLinkId
         self.internalPort = internalPort
+        # the switch's ports (PortDescs), and the datapath link's port 
+        # number, once the switch describes them. (see withDpLinkPort)
+        self.ports = None
+        self.dpLinkPort = None
+        self.portWaiters = []
+        self.portLock = threading.Lock()
         # 1) Open a socket for the datapath agent to connect to.
         self.dpSock = self.startDpSocket(self.internalPort)
         # 2) Start the datapath agent.        
@@ -198,29 +321,69 @@ class SwitchAgent(object):
     def handleOFMessage(self, data):
         """
         Handles OpenFlow messages.
+        data is a memoryview into the proxy's receive buffer. 
+        Interceptors get the view, and must copy it (data.tobytes()) 
+        to keep it past the call. Interceptors that want the parsed 
+        message call parsedOFMessage().
         """    
 
         # experimenter message -> ofx.
-        version = ord(data[0])
-        messageType = ord(data[1])
+        version, messageType = struct.unpack_from("!BB", data)
         mlen = len(data)
         # self.dprint ("version: %s type: %s len: %s"%(version, messageType, mlen))
         exp_id = None
         if messageType == 4:
-            exp_id, exp_type = struct.unpack("!II", data[8:16])
+            exp_id, exp_type = struct.unpack_from("!II", data, 8)
 
         if exp_id == OFX_MESSAGE:
-            contents = data[16::]
+            # modules keep what they get, so they get a copy.
+            contents = data[16::].tobytes()
             self.handleOFXMessage(exp_id, exp_type, contents)
         else:
-            ofMessage = ofparse.parse(data)
-            ofMessageType = ofMessage.__class__.__name__
             # else, run it through all the registered interceptors.
-            if ofMessageType in self.OFInterceptors:
-                for fcn in self.OFInterceptors[ofMessageType]:
-                    data = fcn(data)            
+            interceptors = self.OFInterceptors.get(messageType)
+            if not interceptors:
+                return data
+            self.interceptedMessage = data
+            self.interceptedParse = None
+            for fcn in interceptors:
+                data = fcn(data)
+                if data is None:
+                    break
+                if data is not self.interceptedMessage:
+                    # rewritten message, the old parse is stale.
+                    self.interceptedMessage = data
+                    self.interceptedParse = None
+            self.interceptedMessage = None
+            self.interceptedParse = None
             return data
 
+    def isPassthrough(self, messageType):
+        """
+        True if messages of the type go through the agent untouched, 
+        so the proxy can splice them. (not OFX, no interceptors.)
+        """
+        return messageType != 4 and not self.OFInterceptors.get(messageType)
+
+    def registerOFInterceptor(self, messageType, fcn):
+        """
+        call fcn(data) on every OpenFlow message of messageType 
+        (a type code, or a twink class name like 'ofp_packet_in').
+        fcn returns the message to pass on, or None to drop it. 
+        """
+        code = ofTypeCode(messageType)
+        self.OFInterceptors.setdefault(code, []).append(fcn)
+
+    def parsedOFMessage(self):
+        """
+        the twink parse of the message an interceptor is handling. 
+        Messages are only parsed when an interceptor asks.
+        """
+        if self.interceptedParse is None:
+            self.interceptedParse = ofparse.parse(\
+                copyBytes(self.interceptedMessage))
+        return self.interceptedParse
+
     def handleOFXMessage(self, exp_id, exp_type, contents):
         """
         Handles OFX messages (experimenter messages with appropriate 
@@ -232,13 +395,70 @@ class SwitchAgent(object):
         if ofxModuleId==OFX_MANAGEMENT_MODULE:
             self.handleOFXManagementMessage(contents)
 
+        # stream fragments and acks.
+        elif ofxModuleId==OFX_STREAM_MODULE:
+            self.handleStreamMessage(contents)
+
+        # many module messages.
+        elif ofxModuleId==OFX_ENVELOPE_MODULE:
+            self.handleEnvelope(contents)
+
         # else, send it to whatever module's function is registered to 
         # handle the id.
         elif ofxModuleId in self.moduleHandlers:
             self.moduleHandlers[ofxModuleId](contents)
+        elif self.modulesLoading:
+            # (probably for the module being loaded.)
+            self.heldModuleMessages.append((exp_id, ofxModuleId, \
+                copyBytes(contents)))
         else:
             self.dprint ("unknown  module id: %s"%ofxModuleId)
 
+    def handleEnvelope(self, contents):
+        """
+        Handles each module message in an envelope.
+        """
+        ptr = 0
+        while ptr + envelopeHeader.size <= len(contents):
+            moduleId, messageType, dataLen = \
+                envelopeHeader.unpack_from(contents, ptr)
+            end = ptr + envelopeHeader.size + dataLen
+            if dataLen < 0 or end > len(contents):
+                self.dprint ("envelope message of bad length %s, rest of "\
+                    "envelope dropped."%dataLen)
+                return
+            if moduleId == OFX_ENVELOPE_MODULE:
+                self.dprint ("envelope in an envelope dropped.")
+            else:
+                # (the message, from its type field on.)
+                self.handleOFXMessage(OFX_MESSAGE, moduleId, \
+                    contents[ptr+4:end])
+            ptr = end
+
+    def handleStreamMessage(self, contents):
+        """
+        Handles a fragment of (or hello for) a stream from the 
+        controller, or an ack of a stream to the controller.
+        """
+        kind = streamMessageKind(contents)
+        if kind == STREAM_FRAGMENT:
+            self.streamReceiver.handleFragment(contents)
+        elif kind == STREAM_HELLO:
+            self.streamReceiver.handleHello(contents)
+        elif kind == STREAM_ACK:
+            self.streamSender.handleAck(contents)
+
+    def deliverStreamMessage(self, moduleId, data):
+        """
+        handle a message reassembled from a stream, like an 
+        unfragmented message.
+        """
+        self.handleOFXMessage(OFX_MESSAGE, moduleId, data)
+
+    def sendStreamMessage(self, moduleId, content):
+        self.injectToController(self.buildOFXMessage(moduleId, content), \
+            LANE_BULK)
+
     # def handleOFMessageSlow(self, data):
     #     """
     #     Handles OpenFlow messages.
@@ -300,7 +520,7 @@ class SwitchAgent(object):
         """
         Load a file from a module.
         """
-        (fileName, bin) = pickle.loads(data)
+        (fileName, bin) = moduleFileSchema.decode(data)
         filePath = self.tempDir + fileName
         self.dprint ("got file %s (%s)"%(filePath, len(bin)))
         with open(filePath, "w") as f:
@@ -310,7 +530,7 @@ class SwitchAgent(object):
         """
         loads a part of a file from a module.
         """
-        (fileName, totalLen, binPart) = pickle.loads(data)
+        (fileName, totalLen, binPart) = moduleFilePieceSchema.decode(data)
         filePath = self.tempDir + fileName        
         self.currentBin += binPart
         if len(self.currentBin)>= totalLen:
@@ -323,35 +543,68 @@ class SwitchAgent(object):
 
     def loadModuleEnd(self, data):
         """
-        End a module loading. Do the import and all registration.
+        End a module loading. The dp worker imports the module (it 
+        reads files, and may import big libraries), then the loop 
+        thread registers it. Messages to the module that come in 
+        meanwhile wait for it.
+        """
+        moduleName = self.newModuleName
+        self.moduleTransferActive = False
+        self.modulesLoading += 1
+        def importModule():
+            try:
+                moduleObj = importlib.import_module(moduleName)
+            except Exception as e:
+                self.dprint ("module %s failed to import: %s"%(moduleName, e))
+                moduleObj = None
+            getEventLoop().callFromThread(self.registerModule, moduleName, \
+                moduleObj)
+        self.dpWork.put(importModule)
+
+    def registerModule(self, moduleName, moduleObj):
+        """
+        Do all the registration of an imported module, and hand it 
+        the messages that waited for it. (loop thread)
+        """
+        self.modulesLoading -= 1
+        if moduleObj is not None:
+            self.startModule(moduleName, moduleObj)
+        if not self.modulesLoading:
+            held = self.heldModuleMessages
+            self.heldModuleMessages = []
+            for exp_id, moduleId, contents in held:
+                self.handleOFXMessage(exp_id, moduleId, contents)
+
+    def startModule(self, moduleName, moduleObj):
+        """
+        Load an imported module's switch component, and register it.
         """
-        # import the module.
-        moduleObj = importlib.import_module(self.newModuleName)
         # load the switch component, pass it a self reference.
         newComponent = moduleObj.SwitchComponent(self)
-        self.loadedModules[self.newModuleName] = newComponent
+        self.loadedModules[moduleName] = newComponent
         # register the openflow message interceptors.
         for mtype, fcn in newComponent.OFInterceptors.items():
-            self.OFInterceptors[mtype].append(fcn)
+            self.registerOFInterceptor(mtype, fcn)
         # register the handler for messages to this module id.   
         self.dprint ("registering handler for module ID %s"%newComponent.MODULEID)     
         self.moduleHandlers[newComponent.MODULEID] = newComponent.mainHandler
         self.dpModuleHandlers[newComponent.MODULEID] = newComponent.dpHandler
+        self.dpModuleId = newComponent.MODULEID
 
-        self.dprint ("finished transferring module %s"%(self.newModuleName))
+        self.dprint ("finished transferring module %s"%(moduleName))
         # do any compilation required. (special instructions 
-        # could be in this message.)
-        self.dprint ("compiling datapath agent module:")
-        self.dprint ("----------------------------------")
-        self.compileDPModule(self.newModuleName+".c")
-        self.dprint ("----------------------------------")
-        self.moduleTransferActive = False
+        # could be in this message.) The dp worker does it, before 
+        # it sends the datapath any later messages.
+        fileName = moduleName+".c"
+        self.dpWork.put(lambda: self.compileDPModule(fileName))
 
     def compileDPModule(self, fileName):
         """
         Loads the packet processing component of an OFX module.
-        Has to be called ofxmodule.so, for now.
+        Has to be called ofxmodule.so, for now. (dp worker thread)
         """
+        self.dprint ("compiling datapath agent module:")
+        self.dprint ("----------------------------------")
         # go to the temp directory
         filePath = self.tempDir + fileName
         cmd = 'cd %s'%self.tempDir
@@ -368,6 +621,7 @@ class SwitchAgent(object):
         # signal the datapath agent to load the module...
         self.dpAgentProc.send_signal(14)
         self.dprint ("signal sent..")
+        self.dprint ("----------------------------------")
         time.sleep(1)
 
     #### functions a module can call. ####
@@ -382,6 +636,32 @@ class SwitchAgent(object):
         data = self.buildOFXMessage(moduleId, msg)
         return data        
 
+    def buildEnvelopeMessages(self, messages):
+        """
+        Packs module messages, (moduleId, messageType, content) tuples, 
+        into as few OFX messages as they fit in. The receiver hands 
+        each one to its module, in order, like a message of its own. 
+        (Each message must fit in an OpenFlow message: stream bigger 
+        ones.)
+        """
+        envelopes = []
+        parts = []
+        size = 0
+        for moduleId, messageType, content in messages:
+            entryLen = envelopeHeader.size + len(content)
+            if parts and size + entryLen > envelopeMaxLen:
+                envelopes.append(self.buildOFXMessage(OFX_ENVELOPE_MODULE, \
+                    b''.join(parts)))
+                parts = []
+                size = 0
+            parts.append(envelopeHeader.pack(moduleId, messageType, len(content)))
+            parts.append(content)
+            size += entryLen
+        if parts:
+            envelopes.append(self.buildOFXMessage(OFX_ENVELOPE_MODULE, \
+                b''.join(parts)))
+        return envelopes
+
     def buildOFXMessage(self, moduleId, content):
         """
         Builds an OFX message to send to a OFX agent.
@@ -402,38 +682,83 @@ class SwitchAgent(object):
     def redirectToDpAgent(self, matchPattern, moduleId):
         """
         adds a rule to redirect packets to a module id.
+        matchPattern is ovs-ofctl style ("priority=1, dl_type=0x0800").
         """
-        rerouteCmd = ofctlbin+ ' -O OpenFlow13 add-flow %s "%s,actions=output:%s"'%\
-        (self.activeBridgeName, matchPattern, self.datapathLinkId)
-        self.dprint ("switch agent adding rule:")
-        self.dprint ("\t%s"%rerouteCmd)
-        subprocess.call(rerouteCmd, shell=True)        
+        match, args = parseMatchPattern(matchPattern)
+        def install(dpLinkPort):
+            mod = FlowModTemplate(match, \
+                [applyActions([outputAction(dpLinkPort)])], **args)
+            self.dprint ("switch agent adding rule: %s -> port %s"\
+                %(matchPattern, dpLinkPort))
+            self.installFlowMod(mod.build(moduleId), moduleId)
+        self.withDpLinkPort(install)
 
     def tapToDpAgent(self, matchPattern, moduleId):
         """
-        adds a rule to tap packets to the dp agent. 
-        Need to do this with an OpenFlow message instead of ovs, 
-        so that we can use the "goto" command instead of resubmit.
-        (then you'd only need 1 rule, not 1 for each port)
-        """
-        rerouteCmd = ofctlbin+ ' -O OpenFlow13 add-flow %s "%s,in_port=1,actions=resubmit(1,1),output:%s"'%\
-        (self.activeBridgeName, matchPattern, self.datapathLinkId)
-        self.dprint ("switch agent adding rule:")
-        self.dprint ("\t%s"%rerouteCmd)
-        subprocess.call(rerouteCmd, shell=True)        
-
-        rerouteCmd = ofctlbin+ ' -O OpenFlow13 add-flow %s "%s,in_port=2,actions=resubmit(2,1),output:%s"'%\
-        (self.activeBridgeName, matchPattern, self.datapathLinkId)
-        self.dprint ("switch agent adding rule:")
-        self.dprint ("\t%s"%rerouteCmd)
-        subprocess.call(rerouteCmd, shell=True)        
-
-        rerouteCmd = ofctlbin+ ' -O OpenFlow13 add-flow %s "%s,in_port=3,actions=resubmit(3,1),output:%s"'%\
-        (self.activeBridgeName, matchPattern, self.datapathLinkId)
-        self.dprint ("switch agent adding rule:")
-        self.dprint ("\t%s"%rerouteCmd)
-        subprocess.call(rerouteCmd, shell=True)        
-
+        adds a rule to tap packets to the dp agent: one rule, on 
+        every port, that sends a copy of the packets to the dp agent 
+        and goes on to table 1. Packets that the dp agent sends back 
+        through the datapath link aren't tapped again: a rule one 
+        priority higher, with the same match on the link's port, 
+        sends them straight on to table 1.
+        """
+        match, args = parseMatchPattern(matchPattern)
+        def install(dpLinkPort):
+            if 'in_port' not in dict(match):
+                bypassArgs = dict(args)
+                bypassArgs['priority'] = args.get('priority', 0) + 1
+                bypass = FlowModTemplate([('in_port', dpLinkPort)] + match, \
+                    [gotoTable(1)], **bypassArgs)
+                self.installFlowMod(bypass.build(moduleId), moduleId)
+            mod = FlowModTemplate(match, \
+                [applyActions([outputAction(dpLinkPort)]), gotoTable(1)], \
+                **args)
+            self.dprint ("switch agent adding tap: %s -> port %s"\
+                %(matchPattern, dpLinkPort))
+            self.installFlowMod(mod.build(moduleId), moduleId)
+        self.withDpLinkPort(install)
+
+    def withDpLinkPort(self, fcn):
+        """
+        call fcn(port) with the switch's port number of the datapath 
+        link, which is looked up by name in the switch's port 
+        descriptions, once. (datapathLinkId, if no port has that name.)
+        fcn may run in the loop thread.
+        """
+        with self.portLock:
+            port = self.dpLinkPort
+            if port is None:
+                self.portWaiters.append(fcn)
+                if len(self.portWaiters) > 1:
+                    return
+        if port is not None:
+            fcn(port)
+            return
+        self.sendOFRequest(buildPortDescRequest(), self.portsDescribed, \
+            lane=LANE_CONTROL)
+
+    def portsDescribed(self, request):
+        """
+        the reply to the port desc request of withDpLinkPort.
+        """
+        port = None
+        if request.error is None:
+            self.ports = parsePortDescReplies(request.replies)
+            self.dprint ("switch ports: %s"%", ".join("%s (%s)"\
+                %(p.name, p.portNo) for p in self.ports))
+            port = next((p.portNo for p in self.ports \
+                if p.name == self.datapathLink), None)
+        else:
+            self.dprint ("port desc request failed: %s"%request.error)
+        with self.portLock:
+            if port is not None:
+                self.dpLinkPort = port
+            waiters = self.portWaiters
+            self.portWaiters = []
+        if port is None:
+            port = self.datapathLinkId
+        for fcn in waiters:
+            fcn(port)
 
     def redirectFromDpAgent(self, matchPattern, action, moduleId):
         """
@@ -526,70 +851,78 @@ class SwitchAgent(object):
         # actions=[parser.OFPActionOutput(ofproto.OFPP_FLOOD)]
         # self.add_flow_with_instructions(datapath, 10, match, actions, [], 66)
 
+    def requestFlowStats(self, cookie=0, cookieMask=0, \
+        tableId=OFPTT_ALL, callback=None, timeout=None):
+        """
+        send an OFPMP_FLOW request for the flows whose cookie matches 
+        cookie under cookieMask (all flows by default). Returns the 
+        OFRequest, see sendOFRequest. parseFlowStatsReplies turns 
+        its replies into a FlowStatsTable.
+        """
+        data = buildFlowStatsRequest(tableId, cookie, cookieMask)
+        return self.sendOFRequest(data, callback, timeout, LANE_BULK)
+
+    def callLater(self, delay, fcn, *args):
+        """
+        call fcn(*args) in the loop thread, after delay seconds. 
+        Module handlers run in the loop thread, which every switch's 
+        connections share: they defer work with this, and never sleep.
+        """
+        getEventLoop().callLater(delay, fcn, *args)
+
+    def subscribeFlowStats(self, callback, interval=1.0, cookie=0, \
+        cookieMask=0, match=None, changedOnly=False):
+        """
+        call callback(flowTable) with a FlowStatsTable every interval 
+        seconds. The flow table is polled once for all subscribers. 
+        Only flows whose cookie matches cookie under cookieMask, and 
+        whose fields have the values in match ({column name: value}) 
+        are passed on. Modules pass cookie=MODULEID and 
+        cookieMask=COOKIE_MASK_ALL to only get their own flows. 
+        With changedOnly, only flows whose counters moved since the 
+        last poll are passed on.
+        Returns an id for unsubscribeFlowStats.
+        Callbacks run in the poller's thread.
+        """
+        return self.statsPoller.subscribe(callback, interval, \
+            cookie, cookieMask, match, changedOnly)
+
+    def unsubscribeFlowStats(self, subscriptionId):
+        self.statsPoller.unsubscribe(subscriptionId)
+
     def getFlowStatsDict(self, moduleId, matchPattern=''):
         """
         Gets the statistics of all the flows added by the module.
         Put them into a dictionary, return the dictionary.
+        (blocks, like getFlowStats.)
         """
-        queryCmd = ofctlbin + " dump-flows %s"%self.activeBridgeName
-
-        ps = subprocess.Popen(queryCmd, shell=True, stdout=subprocess.PIPE)
-        flowrecs = ps.communicate()[0]
-        lines = flowrecs.split('\n')
-        flowrecs = lines[1:-1]
         flowStats = {}
-        for flowrec in flowrecs:
-            fields = flowrec.split(",")
-            src = None
-            dst = None
-            sport = None
-            dport = None
-            pct = None
-            bct = None
-            for field in fields:
-                kv = field.split("=")
-                if len(kv)<2:
-                    pass
-                else:
-                    key=kv[0]
-                    value = kv[1]
-                    if 'nw_src' in key:
-                        src = value.split(' ')[0]
-                    elif 'nw_dst' in key:
-                        dst = value.split(' ')[0]
-                    elif 'tp_src' in key:
-                        sport = int(value.split(' ')[0])
-                    elif 'tp_dst' in key:
-                        dport = int(value.split(' ')[0])
-                    elif 'n_packets' in key:
-                        pct = value.split(' ')[0]
-                    elif 'n_bytes' in key:
-                        bct = value.split(' ')[0]
-            if src!=None:
-                # make a flow record.
-                flowKey = (src, dst, sport, dport)
-                flowStats[flowKey] = {'bct':int(bct), 'pct':int(pct)}
+        for src, dst, sport, dport, pct, bct in \
+            self.getFlowStats(moduleId, matchPattern).ipFlows():
+            flowKey = (src, dst, sport, dport)
+            flowStats[flowKey] = {'bct':bct, 'pct':pct}
         return flowStats
 
     def getFlowStats(self, moduleId, matchPattern=''):
         """
-        Gets all the flows added by the module. 
-        (cookie=moduleId, for now.)
+        Gets all the flows added by the module (cookie=moduleId), 
+        as a FlowStatsTable. 
+        Blocks until the switch replies, so only a module's own 
+        threads can call it. In the loop thread (message handlers 
+        and interceptors) it raises OFRequestError: use 
+        subscribeFlowStats or sendOFRequest with a callback there.
         """
-        queryCmd = ofctlbin + " dump-flows %s"%self.activeBridgeName
-
-        ps = subprocess.Popen(queryCmd, shell=True, stdout=subprocess.PIPE)
-        output = ps.communicate()[0]
-        return output
+        request = self.requestFlowStats(moduleId, COOKIE_MASK_ALL)
+        return parseFlowStatsReplies(request.wait())
 
 
     def unpackModuleMessage(self, data):
         """
         Unpacks an OFX message.
         """
-        messageType = struct.unpack("!i", data[0:4])[0]
-        dataLen = struct.unpack("!i", data[4:8])[0]
-        return (messageType, data[8:8+dataLen])
+        messageType, dataLen = struct.unpack_from("!ii", data)
+        # (data may be a stream's reassembly buffer.)
+        return (messageType, memoryview(data)[8:8+dataLen].tobytes())
 
 
     def interceptFromSwitchOF(self, data):
@@ -611,25 +944,86 @@ class SwitchAgent(object):
             self.injectToSwitch(data)      
         self.dprint ("message controller -> switch")
 
-    def injectToSwitch(self, data):
+    def injectToSwitch(self, data, lane=None):
         """
         inject a message to the switch, on the OpenFlow channel.
+        lane is the send lane (LANE_URGENT, LANE_EVENT, LANE_CONTROL, 
+        or LANE_BULK). By default, messages stay in order with the 
+        proxied messages (LANE_CONTROL).
         """
-        while self.OFProxy.switchSock == None:
-            self.dprint ("trying to send msg, waiting for connection to openflow agent...") 
-            time.sleep(1)
-        self.OFProxy.switchSock.send(data)
+        self.OFProxy.sendToSwitch(data, lane)
 
-    def injectToController(self, data):
+    def injectToController(self, data, lane=None):
         """
         inject a message to the controller, on the OpenFlow channel.
+        lane is the send lane, as in injectToSwitch. Modules should 
+        send alerts on LANE_EVENT and bulk data on LANE_BULK.
         """
-        while self.OFProxy.controllerSock == None:
-            self.dprint ("trying to send msg, waiting for connection to openflow controller...") 
-            time.sleep(1)
-        self.OFProxy.controllerSock.send(data)
+        self.OFProxy.sendToController(data, lane)
+
+    def streamToController(self, moduleId, messageType, content):
+        """
+        send a module message of any size to the controller. It is 
+        split into fragments, and the controller's module handler 
+        gets it whole. Streamed messages arrive in the order they 
+        were sent, but not in order with messages sent by 
+        injectToController. Returns right away: the fragments go 
+        out on LANE_BULK as the controller acks the earlier ones.
+        """
+        return self.streamSender.send(moduleId, messageType, content)
+
+    def enableStreamCompression(self, moduleId, threshold=compressThreshold):
+        """
+        zlib compress the module's streamed messages of at least 
+        threshold bytes, if the controller can decompress them. 
+        Worth it for bulk records. (threshold None turns it off.)
+        """
+        self.streamSender.setCompression(moduleId, threshold)
+
+    def sendOFRequest(self, data, callback=None, timeout=None, lane=None):
+        """
+        send an OpenFlow request (stats, barrier, table features...) 
+        to the switch for a module. The proxy gives it its own xid, 
+        and its replies go to the returned OFRequest instead of the 
+        controller. Either call wait() on the request from a module 
+        thread, or pass callback(request), which runs in the proxy's 
+        loop thread. Many requests can be in flight at once.
+        """
+        return self.OFProxy.sendRequest(data, callback, timeout, lane)
+
+    def cancelOFRequest(self, request):
+        """
+        stop waiting for replies to a request that won't get any.
+        """
+        self.OFProxy.cancelRequest(request)
+
+    def sendBarrier(self, callback=None, timeout=None):
+        """
+        send a barrier request. It finishes once the switch has 
+        processed every message injected before it.
+        """
+        data = self.getHeader(OFPT_BARRIER_REQUEST, 8)
+        return self.sendOFRequest(data, callback, timeout)
 
     ####### SOCKET TO DATA PATH AGENT ################################
+    def startDpWorker(self):
+        """
+        start the thread that does the work queued in self.dpWork 
+        (functions without arguments), in order.
+        """
+        self.dpWork = Queue.Queue()
+        dpWorkerThread = threading.Thread(target = self.dpWorkLoop)
+        dpWorkerThread.daemon = True
+        dpWorkerThread.start()
+
+    def dpWorkLoop(self):
+        while True:
+            work = self.dpWork.get()
+            try:
+                work()
+            except (socket.error, OSError) as e:
+                self.dprint ("datapath agent work failed: %s"%e)
+
     def startDpSocket(self, listenPort):
         # start socket.
         dpSockThread = threading.Thread(target = self.socketListenLoop, args = (listenPort,))
@@ -678,7 +1072,9 @@ class SwitchAgent(object):
 
     def sendToDp(self, moduleId, messageType, messageContent):
         """
-        sends a message to the datapath socket. 
+        sends a message to the datapath socket. Returns right away: 
+        the dp worker sends the messages in the order they were 
+        queued, once the socket is connected.
         Header format:
         struct ofxDpHeader {
             uint32_t len;
@@ -686,13 +1082,19 @@ class SwitchAgent(object):
             uint32_t messageType;
         };
         """
-        while self.dpSock == None:
-            self.dprint ("waiting for socket to data path.")
-            time.sleep(1)
         totalLen = len(messageContent) + 12
         msg = struct.pack("!III", totalLen, moduleId, messageType)
         msg += messageContent
-        self.dpSock.send(msg)
+        self.dpWork.put(lambda: self.sendDpMessage(msg))
+
+    def sendDpMessage(self, msg):
+        """
+        (dp worker thread)
+        """
+        while self.dpSock == None:
+            self.dprint ("waiting for socket to data path.")
+            time.sleep(1)
+        self.dpSock.sendall(msg)
 
     def dpSockHandler(self, msgLen, moduleId, msgType, msgContent):
         """
@@ -712,45 +1114,161 @@ class SwitchAgent(object):
             src = socket.inet_ntoa(msgContent[0:4])
             dst = socket.inet_ntoa(msgContent[4:8])
             sport, dport = struct.unpack("!HH", msgContent[8::])
-            self.addUDPCounterFlow(src, dst, sport, dport)
+            self.watchOffloadedFlows()
+            def added(installed, error):
+                if not installed:
+                    # free the flow's offload budget.
+                    self.sendToDp(OFX_MANAGEMENT_AGENT, OFX_FLOW_DEMOTED, \
+                        flowDemotedStruct.pack(msgContent[0:4], \
+                        msgContent[4:8], sport, dport, 17, 0, 0))
+            self.addUDPCounterFlow(src, dst, sport, dport, self.dpModuleId, \
+                added)
         elif msgType == OFX_ADD_UDP_DSCP_FLOW:
             src = socket.inet_ntoa(msgContent[0:4])
             dst = socket.inet_ntoa(msgContent[4:8])
             sport, dport = struct.unpack("!HH", msgContent[8:12])
             dscp = struct.unpack("!I", msgContent[12::])[0]
-            self.addUdpDscpFlow(src, dst, sport, dport, dscp)
+            self.addUdpDscpFlow(src, dst, sport, dport, dscp, self.dpModuleId)
         elif msgType == OFX_PACKET_UP:
             self.sendPacketIn(msgContent)
         elif msgType == OFX_ADD_TCP_FLOW:
             src = socket.inet_ntoa(msgContent[0:4])
             dst = socket.inet_ntoa(msgContent[4:8])
             sport, dport = struct.unpack("!HH", msgContent[8::])
-            self.addTCPFloodFlow(src, dst, sport, dport)
+            self.addTCPFloodFlow(src, dst, sport, dport, self.dpModuleId)
         else:
             self.dprint("unknown system message type: %s"%msgType)
 
     ##### Flow installation functions #####
+    def installFlowMod(self, data, moduleId, callback=None):
+        """
+        queue a flow mod for a module. The flow mod scheduler sends 
+        it when the switch has capacity, after the flow mods of 
+        higher priority classes, and resends it until a barrier 
+        confirms it. A queued flow mod of the same kind (add or 
+        delete) for the same match is replaced, and an add of a rule that is already in the switch 
+        (see FlowShadowTable) is dropped. callback(installed, error) 
+        is called in the loop thread once the switch installed or 
+        refused it.
+        Adds with OFPFF_SEND_FLOW_REM count against their table's 
+        budget (see RuleOccupancy), and can evict other rules.
+        """
+        key = flowModRule(data)
+        if not self.shadowTable.install(data):
+            # (the rule is used again, but takes no more room.)
+            if key is not None:
+                self.occupancy.used(key)
+            if callback is not None:
+                getEventLoop().callFromThread(callback, True, None)
+            return
+        if key is not None:
+            self.watchRuleUse(struct.unpack_from("!Q", data, 8)[0])
+            for rule in self.occupancy.admit(key, moduleId, copyBytes(data)):
+                self.evictRule(rule)
+        def done(installed, error):
+            if not installed:
+                self.shadowTable.refused(data)
+                if key is not None:
+                    self.occupancy.removed(key)
+            if callback is not None:
+                callback(installed, error)
+        self.flowMods.submit(data, moduleId, done)
+
+    def shadowFlowMod(self, data):
+        """
+        a flow mod from the controller.
+        """
+        self.shadowTable.controllerFlowMod(data)
+        return data
+
+    def flowRemoved(self, data):
+        """
+        the switch removed a rule. The removal of a rule that the 
+        agent installed for a module isn't passed on to the 
+        controller: the rule's counters go back to the module.
+        """
+        self.shadowTable.flowRemoved(data)
+        key, cookie, packetCount, byteCount = flowRemovedRule(copyBytes(data))
+        rule = self.occupancy.removed(key)
+        if rule is None:
+            return data
+        fields = ruleFields(key)
+        if rule.moduleId == self.dpModuleId and fields['ipProto'] in (6, 17):
+            self.sendToDp(OFX_MANAGEMENT_AGENT, OFX_FLOW_DEMOTED, \
+                flowDemotedStruct.pack(ipv4Bytes(fields['ipv4Src']), \
+                ipv4Bytes(fields['ipv4Dst']), fields['tpSrc'], \
+                fields['tpDst'], fields['ipProto'], packetCount, byteCount))
+        return None
+
+    def evictRule(self, rule):
+        """
+        delete a rule to make room in its table. The switch reports 
+        the removal. (see flowRemoved)
+        """
+        def done(installed, error):
+            if not installed:
+                self.occupancy.removed(rule.key)
+        self.installFlowMod(strictDelete(rule.flowMod), rule.moduleId, done)
+
+    def watchRuleUse(self, cookie):
+        """
+        poll the flows with the cookie of a tracked rule, so rules 
+        whose counters move count as recently used. The polls are 
+        scoped by cookie, so they share the modules' own cookie 
+        scoped requests, and never ask for the whole table.
+        """
+        if cookie in self.ruleUseWatches:
+            return
+        with self.ruleUseLock:
+            if cookie not in self.ruleUseWatches:
+                self.ruleUseWatches[cookie] = self.subscribeFlowStats( \
+                    self.occupancy.touch, self.ruleUsePollInterval, \
+                    cookie=cookie, cookieMask=COOKIE_MASK_ALL, \
+                    changedOnly=True)
+
+    def setRuleTimeouts(self, idleTimeout, hardTimeout=0):
+        """
+        the timeouts of the rules that the datapath agents ask for, 
+        from now on. (0: no timeout)
+        """
+        self.tcpFlowMod = tcpFlowTemplate.retimed(idleTimeout, hardTimeout)
+        self.udpFlowMod = udpFlowTemplate.retimed(idleTimeout, hardTimeout)
+        self.udpDscpFlowMod = udpDscpFlowTemplate.retimed(idleTimeout, \
+            hardTimeout)
+        self.ipFloodMod = ipFloodTemplate.retimed(idleTimeout, hardTimeout)
+
+    def setTableRuleBudget(self, tableId, budget):
+        """
+        the most rules that the agent installs in a table for modules.
+        """
+        self.occupancy.setBudget(tableId, budget)
+
+    def shadowError(self, data):
+        self.shadowTable.switchError(data)
+        return data
+
+    def setFlowModClass(self, moduleId, flowModClass):
+        """
+        the priority class of a module's flow mods: FLOWMOD_URGENT, 
+        FLOWMOD_NORMAL (the default) or FLOWMOD_BULK.
+        """
+        self.flowMods.setClass(moduleId, flowModClass)
+
     def addIpCounterFlow(self, src, dst, cookie=0):
         """
         adds a IP flow counter rule to the switch.
         With a cookie, so the module can query for it easily. 
         """
-        match = parser.OFPMatch(ipv4_src=src, ipv4_dst=dst, eth_type=0x0800)
-        actions = [parser.OFPActionOutput(ofproto.OFPP_FLOOD)]
-        inst = [parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, actions)]        
-        priority = 10
-        table_id=0
-        mod = parser.OFPFlowMod(datapath=self.fakedp, priority=priority,
-                                    match=match, instructions=inst, table_id=table_id, \
-                                    cookie=cookie)
-        mod.serialize()
-        self.injectToSwitch(mod.buf)
+        mod = self.ipFloodMod.build(cookie, src, dst)
+        self.installFlowMod(mod, cookie)
 
 
-    def addUDPCounterFlow(self, src, dst, sport, dport):
+    def addUDPCounterFlow(self, src, dst, sport, dport, cookie=0, \
+        callback=None):
         """
         adds a udp flow counter rule to the switch.
-        Needs to add a counter for a specific module.
+        The cookie is the id of the module the counter is for. 
+        callback: see installFlowMod.
         """
         # self.dprint("adding udp counting flow: %s (%s) -> %s (%s)\n"%(src, dst, sport, dport))
 
@@ -764,10 +1282,10 @@ class SwitchAgent(object):
         #                             match=match, instructions=inst, table_id=table_id)
         # mod.serialize()
         # self.injectToSwitch(mod.buf)
-        mbuf = writeMod(src, dst, sport, dport, 'udp')
-        self.injectToSwitch(mbuf)
+        mod = self.udpFlowMod.build(cookie, src, dst, sport, dport)
+        self.installFlowMod(mod, cookie, callback)
 
-    def addTCPFloodFlow(self, src, dst, sport, dport):
+    def addTCPFloodFlow(self, src, dst, sport, dport, cookie=0):
         """
         adds a tcp flood rule to the switch.
         Can be used to model a module sending a DO NOT PROCESS message.
@@ -783,11 +1301,11 @@ class SwitchAgent(object):
         #                             match=match, instructions=inst, table_id=table_id)
         # mod.serialize()        
         # self.injectToSwitch(mod.buf)
-        mbuf = writeMod(src, dst, sport, dport, 'tcp')
-        self.injectToSwitch(mbuf)
+        mod = self.tcpFlowMod.build(cookie, src, dst, sport, dport)
+        self.installFlowMod(mod, cookie)
 
 
-    def addUdpDscpFlow(self, src, dst, sport, dport, dscp):
+    def addUdpDscpFlow(self, src, dst, sport, dport, dscp, cookie=0):
         """
         adds a udp flow with a particular dscp tag.
         """
@@ -804,12 +1322,69 @@ class SwitchAgent(object):
         #                             match=match, instructions=inst, table_id=table_id)
         # mod.serialize()
         # self.injectToSwitch(mod.buf)
-        mbuf = writeMod(src, dst, sport, dport, 'dscp')
-        self.injectToSwitch(mbuf)
-        # self.flowModQueue.put(mbuf)
-        # self.injectToSwitch(mbuf)
+        mod = self.udpDscpFlowMod.build(cookie, dscp, src, dst, sport, dport)
+        self.installFlowMod(mod, cookie)
+
 
 
+    ##### ASIC offload of the datapath's flows #####
+    def setOffloadBudget(self, budget, minVolume=1):
+        """
+        the most udp flows that the dp agent gives counting rules, 
+        and the least volume (in the module's units: bytes, packets) 
+        that a flow needs in an epoch to get one.
+        """
+        self.sendToDp(OFX_MANAGEMENT_AGENT, OFX_SET_OFFLOAD_BUDGET, \
+            struct.pack("!II", budget, minVolume))
+
+    def watchOffloadedFlows(self):
+        """
+        poll the datapath's udp counting rules, to demote the cold 
+        ones. A new datapath module's rules replace the old one's. 
+        (dp socket thread)
+        """
+        moduleId = self.dpModuleId
+        if self.offloadWatch is not None:
+            if self.offloadWatchModuleId == moduleId:
+                return
+            self.unsubscribeFlowStats(self.offloadWatch)
+        self.offloadedCounts = {}
+        self.offloadWatchModuleId = moduleId
+        self.offloadWatch = self.subscribeFlowStats(self.demoteColdFlows, \
+            self.offloadPollInterval, cookie=moduleId, \
+            cookieMask=COOKIE_MASK_ALL, match={'ipProto':17})
+
+    def demoteColdFlows(self, flowTable):
+        """
+        demote the counting rules that counted fewer than 
+        coldFlowPackets packets since the last poll. (poller thread)
+        """
+        moduleId = self.dpModuleId
+        lastCounts = self.offloadedCounts
+        self.offloadedCounts = {}
+        for i in range(len(flowTable)):
+            # (a poll for the last datapath module.)
+            if flowTable.cookie[i] != moduleId:
+                continue
+            flowId = flowTable.flowId(i)
+            packetCount = flowTable.packetCount[i]
+            lastCount = lastCounts.get(flowId)
+            if lastCount is None or \
+                packetCount - lastCount >= self.coldFlowPackets:
+                self.offloadedCounts[flowId] = packetCount
+                continue
+            self.demoteFlow(flowTable.ipv4Src[i], flowTable.ipv4Dst[i], \
+                flowTable.tpSrc[i], flowTable.tpDst[i], moduleId)
+
+    def demoteFlow(self, src, dst, sport, dport, moduleId):
+        """
+        remove a udp counting rule of the datapath module moduleId. 
+        The switch reports the removal, and flowRemoved sends the 
+        rule's counts to the dp agent, which counts the flow in 
+        software again.
+        """
+        mod = udpFlowDeleteTemplate.build(moduleId, src, dst, sport, dport)
+        self.installFlowMod(mod, moduleId)
 
     def sendPacketIn(self, pktBytes):
         """
@@ -831,7 +1406,7 @@ class SwitchAgent(object):
         # prepend OF buffer.        
         msgbuf = self.getHeader(10, 8+len(inner)) + inner
         # send the OF packet to the controller.
-        self.injectToController(msgbuf)
+        self.injectToController(msgbuf, LANE_EVENT)
 
     def getHeader(self, messageType, messageLen):
         """
@@ -855,220 +1430,35 @@ class SwitchAgent(object):
         return data
 
 
-class BaseProxy(object):
-    """
-    Simple proxy between an OpenFlow switch and a controller. 
-    The proxy can take an intercept method for each direction. 
-    If one is provided, the proxy passes messages to that method, 
-    instead of forwarding them. 
-    Also start a keepalive thread for the switch. 
-    """
-    buffer_size = 4096
-    delay = 0.00001
-
-    def __init__(self, controllerIp, controllerPort, \
-        switchListenIp, switchListenPort, \
-        controlInterceptMethod = None, switchInterceptMethod = None,
-        switchAgent = None):
-        self.controllerIp = controllerIp
-        self.controllerPort = controllerPort
-        self.switchListenIp = switchListenIp
-        self.switchListenPort = switchListenPort
-        self.switchInterceptMethod = switchInterceptMethod
-        self.controlInterceptMethod = controlInterceptMethod
-        self.dprint = switchAgent.dprint
-        # socket to switch and controller.
-        self.switchSock = None
-        self.controllerSock = None
-
-        self.controllerConnected = False
-        self.switchConnected = False
-        # OFProxThread = threading.Thread(target = self.startProxy)
-        # OFProxThread.start()        
-        # return when both connections are complete. 
-        # while (not self.controllerConnected) and (not self.switchConnected):
-        #     time.sleep(.1)
-        # return 1
-
-
-    def startProxy(self):
-        """
-        Starts the proxy. 
-        """
-        # Open the port that listens for a connection from the switch. 
-        self.listenSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.listenSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.listenSock.bind((self.switchListenIp, self.switchListenPort))
-        self.listenSock.listen(5)
-        # used to be a while loop here.
-        # connect to the controller.
-        self.dprint ("connecting to controller at IP: %s port: %s (retrying every second)"%(self.controllerIp, self.controllerPort))            
-        while 1:
-            try:
-                self.controllerSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.controllerSock.connect((self.controllerIp, self.controllerPort))
-                break
-            except socket.error: # retry connection until controller is up.
-                time.sleep(1)
-        #  listen for a connection from the switch.
-        self.controllerConnected = True
-        self.dprint ("\tcontroller connected.")
-        self.dprint ("waiting for connection from switch. Listening on port: %s"%self.switchListenPort)
-        self.switchSock, self.switchAddr = self.listenSock.accept()
-        self.dprint ("\tconnection from switch at %s recieved"%str(self.switchAddr))
-        self.switchConnected = True
-        # start up the forwarding threads.
-        self.dprint ("spawning forwarding threads")
-        d1 = threading.Thread(target = self.forwardData, args = (self.switchSock, self.controllerSock, self.switchInterceptMethod, "s->c"))
-        d2 = threading.Thread(target = self.forwardData, args = (self.controllerSock, self.switchSock, self.controlInterceptMethod, "c->s"))
-        d1.start()
-        d2.start()
-        time.sleep(1)
-        # start up the echo loop to keep the switch alive. 
-        self.dprint("calling echo loop to keep switch alive.")
-        echothread = threading.Thread(target = self.echoLoop, args = ())
-        echothread.start()
-        return
-        # d1.join()
-        # d2.join()
-        # self.dprint ("forwarding threads finished.")
-    def forwardData(self, inSocket, outSocket, interceptMethod = None, direction="?"):
-        """
-        forwards data from inSocket to outSocket. 
-        Passes data through an intercept function first.
-        """
-
-        while True:
-            # get 4 bytes of the header.
-            data = self.recv_n_bytes(inSocket, 4)
-            if data == None: # end of socket? Close connection to outSocket and return.
-                self.dprint("SOCKET ENDED (%s)"%direction)
-                outSocket.close()
-                break
-            size = struct.unpack("!H", data[2:])[0]-4
-            remainingData = self.recv_n_bytes(inSocket, size)
-            if remainingData == None:
-                self.dprint("SOCKET ENDED (%s)"%direction)
-                outSocket.close()
-                break
-            data = data + remainingData                
-            if interceptMethod == None:
-                outSocket.send(data)
-            else:
-                interceptMethod(data)
-            time.sleep(self.delay)
-
-
-    def echoLoop(self):
-        echoReqMsg = chr(4) + chr(2) + struct.pack("!H",8) + struct.pack("!I",666)    
-        self.dprint ("starting echo loop.")
-        while True:
-            self.switchSock.send(echoReqMsg)
-            time.sleep(2)
-
-    def recv_n_bytes(self, socket, n):
-        """
-        recieve a fixed number of bytes from socket.
-        """
-        data = ''
-        while len(data)< n:
-            chunk = socket.recv(n - len(data))
-            if chunk == '':
-                return None
-            data += chunk
-        return data
-
-
-
 #### Flow mod messages ####
-# some hard coded junk to make writing flow mods easier.
-tcpBinStr = ['00', '01', '00', '2b', '80', '00', '0a', '02', '08', '00', '80', '00', '14', '01', '06', '80', '00', '16', '04', '01', '01', '01', '01', '80', '00', '18', '04', '01', '01', '01', '02', '80', '00', '1a', '02', '01', '4d', '80', '00', '1c', '02', '01', 'bc', '00', '00', '00', '00', '00']
-tcpBin = bytearray(''.join([x.decode("hex") for x in tcpBinStr]))
-
-udpBinStr = ['00', '01', '00', '2b', '80', '00', '0a', '02', '08', '00', '80', '00', '14', '01', '11', '80', '00', '16', '04', '01', '01', '01', '01', '80', '00', '18', '04', '01', '01', '01', '02', '80', '00', '1e', '02', '01', '4d', '80', '00', '20', '02', '01', 'bc', '00', '00', '00', '00', '00']
-udpBin = bytearray(''.join([x.decode("hex") for x in udpBinStr]))
-
-dscpBinStr = ['00', '01', '00', '30', '80', '00', '0a', '02', '08', '00', '80', '00', '10', '01', '01', '80', '00', '14', '01', '11', '80', '00', '16', '04', '01', '01', '01', '01', '80', '00', '18', '04', '01', '01', '01', '02', '80', '00', '1e', '02', '01', '4d', '80', '00', '20', '02', '01', 'bc']
-dscpBin = bytearray(''.join([x.decode("hex") for x in dscpBinStr]))
-
-# flood output.
-# flowModBinStr = ['04', '0e', '00', '78', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '0a', 'ff', 'ff', 'ff', 'ff', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '01', '00', '2b', '80', '00', '0a', '02', '08', '00', '80', '00', '14', '01', '06', '80', '00', '16', '04', '01', '01', '01', '01', '80', '00', '18', '04', '01', '01', '01', '02', '80', '00', '1a', '02', '01', '4d', '80', '00', '1c', '02', '01', 'bc', '00', '00', '00', '00', '00', '00', '04', '00', '18', '00', '00', '00', '00', '00', '00', '00', '10', 'ff', 'ff', 'ff', 'fb', 'ff', 'e5', '00', '00', '00', '00', '00', '00']
-
-# output to 1 and 2 instead of flooding.
-# flowModBinStr = ['04', '0e', '00', '88', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '0a', 'ff', 'ff', 'ff', 'ff', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '01', '00', '2b', '80', '00', '0a', '02', '08', '00', '80', '00', '14', '01', '06', '80', '00', '16', '04', '01', '01', '01', '01', '80', '00', '18', '04', '01', '01', '01', '02', '80', '00', '1a', '02', '01', '4d', '80', '00', '1c', '02', '01', 'bc', '00', '00', '00', '00', '00', '00', '04', '00', '28', '00', '00', '00', '00', '00', '00', '00', '10', '00', '00', '00', '01', 'ff', 'e5', '00', '00', '00', '00', '00', '00', '00', '00', '00', '10', '00', '00', '00', '02', 'ff', 'e5', '00', '00', '00', '00', '00', '00']
-
-# output to JUST 2.
-# flowModBinStr = ['04', '0e', '00', '78', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '0a', 'ff', 'ff', 'ff', 'ff', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '01', '00', '2b', '80', '00', '0a', '02', '08', '00', '80', '00', '14', '01', '06', '80', '00', '16', '04', '01', '01', '01', '01', '80', '00', '18', '04', '01', '01', '01', '02', '80', '00', '1a', '02', '01', '4d', '80', '00', '1c', '02', '01', 'bc', '00', '00', '00', '00', '00', '00', '04', '00', '18', '00', '00', '00', '00', '00', '00', '00', '10', '00', '00', '00', '02', 'ff', 'e5', '00', '00', '00', '00', '00', '00']
-
-# goto table 1.
-flowModBinStr = ['04', '0e', '00', '68', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '0a', 'ff', 'ff', 'ff', 'ff', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '00', '01', '00', '2b', '80', '00', '0a', '02', '08', '00', '80', '00', '14', '01', '06', '80', '00', '16', '04', '01', '01', '01', '01', '80', '00', '18', '04', '01', '01', '01', '02', '80', '00', '1a', '02', '01', '4d', '80', '00', '1c', '02', '01', 'bc', '00', '00', '00', '00', '00', '00', '01', '00', '08', '01', '00', '00', '00']
-
-flowModBin = bytearray(''.join([x.decode("hex") for x in flowModBinStr]))
-
-matchIdx = 48
-
-def writeTcpMod(src, dst, sport, dport):
-    srcOffset = 19
-    dstOffset = 27
-    sportOffset = 35
-    dportOffset = 41
-    src = socket.inet_aton(src)
-    dst = socket.inet_aton(dst)
-    sport = struct.pack("!H", sport)
-    dport = struct.pack("!H", dport)
-    tcpBin[srcOffset:srcOffset+4] = src
-    tcpBin[dstOffset:dstOffset+4] = dst
-    tcpBin[sportOffset:sportOffset+2] = sport
-    tcpBin[dportOffset:dportOffset+2] = dport
-    flowModBin[matchIdx:matchIdx+len(tcpBin)] = tcpBin
-    # parseMatch(tcpBin)
-    return flowModBin
-
-def writeUdpMod(src, dst, sport, dport):
-    srcOffset = 19
-    dstOffset = 27
-    sportOffset = 35
-    dportOffset = 41
-    src = socket.inet_aton(src)
-    dst = socket.inet_aton(dst)
-    sport = struct.pack("!H", sport)
-    dport = struct.pack("!H", dport)
-    udpBin[srcOffset:srcOffset+4] = src
-    udpBin[dstOffset:dstOffset+4] = dst
-    udpBin[sportOffset:sportOffset+2] = sport
-    udpBin[dportOffset:dportOffset+2] = dport
-    flowModBin[matchIdx:matchIdx+len(udpBin)] = udpBin
-    return flowModBin
-
-def writeDscpMod(src, dst, sport, dport, dscp):
-    dscpOffset = 14
-    srcOffset = 24
-    dstOffset = 32
-    sportOffset = 40
-    dportOffset = 46
-    src = socket.inet_aton(src)
-    dst = socket.inet_aton(dst)
-    sport = struct.pack("!H", sport)
-    dport = struct.pack("!H", dport)
-    dscpBin[srcOffset:srcOffset+4] = src
-    dscpBin[dstOffset:dstOffset+4] = dst
-    dscpBin[sportOffset:sportOffset+2] = sport
-    dscpBin[dportOffset:dportOffset+2] = dport
-    dscpBin[dscpOffset] = dscp
-    flowModBin[matchIdx:matchIdx+len(dscpBin)] = dscpBin
-    return flowModBin
-
-def writeMod(src, dst, sport, dport, mtype):
-    mod = None
-    if mtype == 'tcp':
-        mod =  writeTcpMod(src, dst, sport, dport)
-    elif mtype == 'udp':
-        mod = writeUdpMod(src, dst, sport, dport)
-    elif mtype == 'dscp':
-        mod = writeDscpMod(src, dst, sport, dport, 1)
-    retmod = bytearray()
-    retmod[:] = mod
-    return retmod
+# the flow mods that the datapath agents ask for. (fill: cookie, 
+# then the None fields, in order.) The switch reports their 
+# removal. (agents add their timeouts, see setRuleTimeouts.)
+# count a tcp / udp flow in the ASIC, then go on to table 1.
+tcpFlowTemplate = FlowModTemplate([('eth_type', 0x0800), ('ip_proto', 6), \
+    ('ipv4_src', None), ('ipv4_dst', None), \
+    ('tcp_src', None), ('tcp_dst', None)], [gotoTable(1)], priority=10, \
+    flags=OFPFF_SEND_FLOW_REM)
+udpFlowTemplate = FlowModTemplate([('eth_type', 0x0800), ('ip_proto', 17), \
+    ('ipv4_src', None), ('ipv4_dst', None), \
+    ('udp_src', None), ('udp_dst', None)], [gotoTable(1)], priority=10, \
+    flags=OFPFF_SEND_FLOW_REM)
+# remove a udp flow's counting rule.
+udpFlowDeleteTemplate = FlowModTemplate([('eth_type', 0x0800), \
+    ('ip_proto', 17), ('ipv4_src', None), ('ipv4_dst', None), \
+    ('udp_src', None), ('udp_dst', None)], [], priority=10, \
+    command=OFPFC_DELETE_STRICT)
+# a udp flow whose packets carry a dscp tag.
+udpDscpFlowTemplate = FlowModTemplate([('eth_type', 0x0800), \
+    ('ip_dscp', None), ('ip_proto', 17), \
+    ('ipv4_src', None), ('ipv4_dst', None), \
+    ('udp_src', None), ('udp_dst', None)], [gotoTable(1)], priority=10, \
+    flags=OFPFF_SEND_FLOW_REM)
+# flood the packets between two hosts.
+ipFloodTemplate = FlowModTemplate([('eth_type', 0x0800), \
+    ('ipv4_src', None), ('ipv4_dst', None)], \
+    [applyActions([outputAction(OFPP_FLOOD)])], priority=10, \
+    flags=OFPFF_SEND_FLOW_REM)
 
 def genFlowKey():
     dstip = socket.inet_ntoa(struct.pack('!I', random.randint(1, 0xffffffff)))
@@ -1080,10 +1470,10 @@ def genFlowKey():
 # make switchAgent obj global for the exit handler.
 
 def sigterm_handler(signal, frame):
-    print ("forwarding SIGTERM to datapath agent.")
-    agentPtr.dpAgentProc.send_signal(signal)
+    print ("forwarding SIGTERM to datapath agents.")
+    for agent in agentPtrs:
+        agent.dpAgentProc.send_signal(signal)
     print ("exiting.")
-    agentPtr.logf.close()
     sys.exit()
 
 def sigint_handler(signal, frame):
@@ -1091,23 +1481,39 @@ def sigint_handler(signal, frame):
     print ("ignoring SIGINT.")
     return
 
+agentPtrs = []
+
 def main():
-    global agentPtr
-    platform, controllerIp, controllerPort, switchIp, switchPort, activeBridgeName, datapathLink, datapathLinkId, internalPort = sys.argv[1::]
+    """
+    usage: switchAgent.py platform controllerIp controllerPort 
+        switchIp switchPort bridgeName datapathLink datapathLinkId internalPort 
+        [switchIp switchPort bridgeName datapathLink datapathLinkId internalPort ...]
+    One agent runs for each group of switch arguments. All of their 
+    proxies share one event loop, in the main thread.
+    """
+    args = sys.argv[1::]
+    if len(args) < 9 or (len(args)-3) % 6 != 0:
+        print (main.__doc__)
+        sys.exit(1)
+    platform, controllerIp, controllerPort = args[0:3]
     controllerPort = int(controllerPort)
-    switchPort = int(switchPort)
-    datapathLinkId = int(datapathLinkId)
-    sa = SwitchAgent(platform, controllerIp, controllerPort, \
-        switchIp, switchPort, \
-        activeBridgeName, datapathLink, datapathLinkId, internalPort)
+    switchArgs = [args[i:i+6] for i in range(3, len(args), 6)]
+    for switchIp, switchPort, activeBridgeName, datapathLink, datapathLinkId, internalPort in switchArgs:
+        switchPort = int(switchPort)
+        datapathLinkId = int(datapathLinkId)
+        sa = SwitchAgent(platform, controllerIp, controllerPort, \
+            switchIp, switchPort, \
+            activeBridgeName, datapathLink, datapathLinkId, internalPort)
+        agentPtrs.append(sa)
+        sa.init(platform, controllerIp, controllerPort, \
+            switchIp, switchPort, \
+            activeBridgeName, datapathLink, datapathLinkId, internalPort)
+    # register the exit signal handlers.
     print ("registering exit signal handlers.")
     signal.signal(signal.SIGINT, sigint_handler)
     signal.signal(signal.SIGTERM, sigterm_handler)
-    agentPtr = sa
-    sa.init(platform, controllerIp, controllerPort, \
-        switchIp, switchPort, \
-        activeBridgeName, datapathLink, datapathLinkId, internalPort)
-    # register the exit signal handlers.
+    # run all of the proxies.
+    getEventLoop().run()
 #
 if __name__ == '__main__':
           main()  
@@ -0,0 +1,87 @@
+"""
+Tests of the per flow counter store.
+"""
+import os, sys, unittest
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(here, "..", "switchAgent"), \
+    os.path.join(here, "..", "controllerLib")]
+
+from flowCounters import FlowCounterStore
+
+a = (1, 2, 5000, 53)
+b = (1, 3, 5000, 53)
+
+
+class FlowCounterStoreTest(unittest.TestCase):
+
+    def test_rate_and_window_sum(self):
+        store = FlowCounterStore(('asic', 'dp'), ringSize=4)
+        store.update('asic', [a, b], [100, 0], now=0)
+        store.update('asic', [a, b], [300, 50], now=2)
+        store.update('dp', [a], [10], now=0)
+        store.update('dp', [a], [30], now=1)
+        self.assertEqual(list(store.rate(source='asic')), [100, 25])
+        self.assertEqual(store.rate(total=True), 145)
+        self.assertEqual(list(store.windowSum()), [220, 50])
+
+    def test_missing_flow_keeps_its_count(self):
+        store = FlowCounterStore(('asic',))
+        store.update('asic', [a, b], [100, 100], now=0)
+        store.update('asic', [b], [150], now=1)
+        self.assertEqual(list(store.rate()), [0, 50])
+
+    def test_counter_going_down_is_no_change(self):
+        store = FlowCounterStore(('asic',))
+        store.update('asic', [a], [100], now=0)
+        store.update('asic', [a], [10], now=1)
+        self.assertEqual(store.rate(total=True), 0)
+
+    def test_grows_past_capacity(self):
+        store = FlowCounterStore(('asic',), capacity=2)
+        keys = [(i, 0, 0, 0) for i in range(5)]
+        store.update('asic', keys, [0] * 5, now=0)
+        store.update('asic', keys, range(5), now=1)
+        self.assertEqual(len(store), 5)
+        self.assertEqual(list(store.rate()), list(range(5)))
+
+    def test_flat_flows_expire(self):
+        store = FlowCounterStore(('asic', 'dp'), ringSize=2, expireAfter=3)
+        keys = [a, b]
+        for now in range(4):
+            store.update('asic', keys, [100, 100 + now], now=now)
+            store.update('dp', keys, [5, 5], now=now)
+        self.assertEqual(store.keys, [b])
+        self.assertEqual(list(store.rate(source='asic')), [1])
+        # it comes back with the same count: nothing new.
+        store.update('asic', keys, [100, 104], now=4)
+        self.assertEqual(store.keys, [b, a])
+        self.assertEqual(list(store.rate(source='asic')), [1, 0])
+        self.assertEqual(list(store.rate(source='dp')), [0, 0])
+        store.update('asic', keys, [150, 105], now=5)
+        self.assertEqual(list(store.rate(source='asic')), [1, 50])
+
+    def test_demotion_counts_once(self):
+        """
+        the datapath takes over a flow, and adds everything its ASIC
+        rule counted (1000 bytes, 800 of them already polled) to
+        its own counter.
+        """
+        store = FlowCounterStore(('asic', 'dp'))
+        store.update('asic', [a], [800], now=0)
+        store.update('dp', [a], [50], now=0)
+        polled = store.latest('asic', [a])
+        self.assertEqual(list(polled), [800])
+        store.rebase('dp', [a], -polled)
+        store.rebase('asic', [a], polled)
+        store.update('asic', [], [], now=1)
+        store.update('dp', [a], [50 + 1000 + 20], now=1)
+        self.assertEqual(store.windowSum(total=True), 200 + 20)
+        # the flow's next rule counts from what the ASIC already had.
+        store.update('asic', [a], [30], now=2)
+        store.update('dp', [a], [50 + 1000 + 20], now=2)
+        self.assertEqual(store.windowSum(total=True), 30)
+        self.assertEqual(store.windowSum(window=2, total=True), 250)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+"""
+Tests of the delta encoded flow counter reports.
+"""
+import os, sys, unittest
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(here, "..", "switchAgent"), \
+    os.path.join(here, "..", "controllerLib")]
+
+from flowDeltas import FlowDeltaEncoder, FlowDeltaDecoder
+from flowDeltas import writeVarint, readVarint, reportHeader
+from flowDeltas import FULL_REPORT, DELTA_REPORT
+
+keyFormat = "IIHH"
+a = (1, 2, 5000, 53)
+b = (1, 3, 5000, 53)
+c = (1, 4, 5000, 53)
+
+def kind(report):
+    return reportHeader.unpack_from(report)[1]
+
+
+class VarintTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        values = [0, 1, -1, 63, -64, 64, 2**31, -2**32, 2**63]
+        out = bytearray()
+        for value in values:
+            writeVarint(out, value)
+        ptr = 0
+        for value in values:
+            decoded, ptr = readVarint(out, ptr)
+            self.assertEqual(decoded, value)
+        self.assertEqual(ptr, len(out))
+
+    def test_small_values_are_one_byte(self):
+        for value in (0, 1, -1, 63, -64):
+            out = bytearray()
+            writeVarint(out, value)
+            self.assertEqual(len(out), 1)
+
+
+class FlowDeltaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.encoder = FlowDeltaEncoder(keyFormat, counterCt=2, \
+            snapshotEvery=4)
+        self.decoder = FlowDeltaDecoder(keyFormat, counterCt=2)
+
+    def report(self, flows):
+        """
+        encode flows, apply the report and ack it. Returns the report.
+        """
+        keys = list(flows)
+        report = self.encoder.encode(keys, [flows[k][0] for k in keys], \
+            [flows[k][1] for k in keys])
+        epoch = self.decoder.apply(report)
+        self.assertIsNotNone(epoch)
+        self.encoder.ack(epoch)
+        self.assertEqual(self.decoder.flows, flows)
+        return report
+
+    def test_deltas_after_ack(self):
+        first = self.report({a: (10, 1000), b: (5, 500)})
+        self.assertEqual(kind(first), FULL_REPORT)
+        # only a changed, c is new and b is gone.
+        delta = self.report({a: (12, 1200), c: (1, 100)})
+        self.assertEqual(kind(delta), DELTA_REPORT)
+        self.assertEqual(reportHeader.unpack_from(delta)[4:], (2, 1))
+        self.assertEqual(self.decoder.totals(), [13, 1300])
+
+    def test_unchanged_flows_are_left_out(self):
+        flows = dict((((1, i, 0, 0), (i, i * 100)) for i in range(50)))
+        full = self.report(flows)
+        delta = self.report(flows)
+        self.assertEqual(reportHeader.unpack_from(delta)[4:], (0, 0))
+        self.assertTrue(len(delta) < len(full))
+
+    def test_counter_going_down(self):
+        self.report({a: (10, 1000)})
+        self.report({a: (1, 60)})
+
+    def test_periodic_snapshot(self):
+        kinds = [kind(self.report({a: (i, i)})) for i in range(1, 9)]
+        self.assertEqual(kinds, [FULL_REPORT, DELTA_REPORT, DELTA_REPORT, \
+            DELTA_REPORT, FULL_REPORT, DELTA_REPORT, DELTA_REPORT, \
+            DELTA_REPORT])
+
+    def test_unacked_reports_stay_relative_to_the_acked_epoch(self):
+        self.report({a: (1, 1)})
+        # lost reports: the next one still decodes.
+        self.encoder.encode([a], [2], [2])
+        self.encoder.encode([a], [3], [3])
+        report = self.encoder.encode([a, b], [4, 1], [4, 1])
+        self.assertIsNotNone(self.decoder.apply(report))
+        self.assertEqual(self.decoder.flows, {a: (4, 4), b: (1, 1)})
+
+    def test_decoder_without_base_waits_for_snapshot(self):
+        self.report({a: (1, 1)})
+        self.report({a: (2, 2)})
+        fresh = FlowDeltaDecoder(keyFormat, counterCt=2)
+        self.assertIsNone(fresh.apply(self.encoder.encode([a], [3], [3])))
+        self.encoder.encode([a], [4], [4])
+        # (the 5th epoch is a snapshot.)
+        self.assertIsNotNone(fresh.apply(self.encoder.encode([a], [5], [5])))
+        self.assertEqual(fresh.flows, {a: (5, 5)})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+"""
+Tests of the switch agent's flow mod scheduler.
+"""
+import os, sys, struct, unittest
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(here, "..", "switchAgent"), \
+    os.path.join(here, "..", "controllerLib")]
+
+from flowModScheduler import FlowModScheduler, FLOWMOD_URGENT, FLOWMOD_BULK
+from flowModScheduler import OFPFC_ADD, OFPFC_DELETE_STRICT
+from flowModScheduler import OFPET_FLOW_MOD_FAILED, OFPFMFC_TABLE_FULL
+
+
+def flowMod(port, command=OFPFC_ADD, priority=10, cookie=0):
+    """
+    a flow mod that matches udp_dst = port.
+    """
+    match = struct.pack("!HHIH", 1, 10, 0x80002002, port)
+    match += b'\0' * (-len(match) % 8)
+    body = struct.pack("!QQBBHHHIIIH2x", cookie, 0, 0, command, 0, 0, \
+        priority, 0xffffffff, 0xffffffff, 0xffffffff, 0) + match
+    return struct.pack("!BBHI", 4, 14, 8+len(body), 0) + body
+
+def portOf(data):
+    return struct.unpack_from("!H", data, 56)[0]
+
+
+class Loop(object):
+    """
+    runs the calls that the scheduler makes from other threads when
+    it's run.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def callFromThread(self, fcn, *args):
+        self.calls.append((fcn, args))
+
+    def callLater(self, delay, fcn, *args):
+        self.calls.append((fcn, args))
+
+    def run(self):
+        while self.calls:
+            fcn, args = self.calls.pop(0)
+            fcn(*args)
+
+
+class Request(object):
+    def __init__(self, error=None):
+        self.error = error
+
+    def done(self):
+        return True
+
+
+class Switch(object):
+    """
+    records the flow mods and barriers that the scheduler sends.
+    """
+    def __init__(self):
+        self.sent = []
+        self.barriers = []
+        self.errors = {}
+
+    def request(self, data, callback, timeout):
+        self.sent.append(data)
+        return Request(self.errors.get(portOf(data)))
+
+    def barrier(self, callback, timeout):
+        self.barriers.append(callback)
+
+    def cancel(self, request):
+        pass
+
+    def confirm(self, error=None):
+        barriers, self.barriers = self.barriers, []
+        for callback in barriers:
+            callback(Request(error))
+
+
+class FlowModSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = Loop()
+        self.switch = Switch()
+        self.scheduler = FlowModScheduler(self.switch.request, \
+            self.switch.barrier, self.switch.cancel, self.loop, \
+            printfcn=lambda message: None)
+        self.results = []
+
+    def callback(self, name):
+        return lambda installed, error: \
+            self.results.append((name, installed, error))
+
+    def test_batch_is_installed_after_its_barrier(self):
+        for port in (1, 2, 3):
+            self.scheduler.submit(flowMod(port), 0x10, self.callback(port))
+        self.loop.run()
+        self.assertEqual([portOf(m) for m in self.switch.sent], [1, 2, 3])
+        self.assertEqual(len(self.switch.barriers), 1)
+        self.assertEqual(self.results, [])
+        self.switch.confirm()
+        self.assertEqual(self.results, [(1, True, None), (2, True, None), \
+            (3, True, None)])
+        self.assertEqual(self.scheduler.installed, 3)
+
+    def test_urgent_class_goes_first(self):
+        self.scheduler.setClass(0x20, FLOWMOD_URGENT)
+        self.scheduler.submit(flowMod(1), 0x10)
+        self.scheduler.submit(flowMod(2), 0x20)
+        self.loop.run()
+        self.assertEqual([portOf(m) for m in self.switch.sent], [2, 1])
+
+    def test_same_flow_is_sent_once(self):
+        self.scheduler.submit(flowMod(1), 0x10, self.callback('a'))
+        self.scheduler.submit(flowMod(1), 0x10, self.callback('b'))
+        self.loop.run()
+        self.assertEqual(len(self.switch.sent), 1)
+        self.switch.confirm()
+        self.assertEqual(self.results, [('a', True, None), ('b', True, None)])
+
+    def test_add_and_delete_are_both_sent(self):
+        self.scheduler.submit(flowMod(1), 0x10)
+        self.scheduler.submit(flowMod(1, OFPFC_DELETE_STRICT), 0x10)
+        self.loop.run()
+        self.assertEqual([struct.unpack_from("!B", m, 25)[0] \
+            for m in self.switch.sent], [OFPFC_ADD, OFPFC_DELETE_STRICT])
+
+    def test_merge_moves_to_the_new_module_class(self):
+        """
+        a bulk module's queued mod, replaced by an urgent module's
+        mod for the same flow, goes out with the urgent mods.
+        """
+        self.scheduler.setClass(0x10, FLOWMOD_BULK)
+        self.scheduler.setClass(0x20, FLOWMOD_URGENT)
+        self.scheduler.submit(flowMod(1), 0x10, self.callback('bulk'))
+        self.scheduler.submit(flowMod(2), 0x30)
+        self.scheduler.submit(flowMod(1, cookie=0x20), 0x20, \
+            self.callback('urgent'))
+        self.assertEqual(self.scheduler.pending(), 2)
+        self.loop.run()
+        self.assertEqual([portOf(m) for m in self.switch.sent], [1, 2])
+        self.assertEqual(struct.unpack_from("!Q", self.switch.sent[0], 8)[0], \
+            0x20)
+        self.switch.confirm()
+        self.assertEqual(self.results, [('bulk', True, None), \
+            ('urgent', True, None)])
+
+    def test_failed_barrier_retries(self):
+        self.scheduler.submit(flowMod(1), 0x10, self.callback(1))
+        self.loop.run()
+        self.switch.confirm("timeout")
+        self.assertEqual(self.results, [])
+        self.scheduler.retryAt = 0
+        self.loop.run()
+        self.assertEqual(len(self.switch.sent), 2)
+        self.switch.confirm()
+        self.assertEqual(self.results, [(1, True, None)])
+        self.assertEqual(self.scheduler.retried, 1)
+
+    def test_refused_mod_fails(self):
+        error = struct.pack("!BBHIHH", 4, 1, 12, 0, OFPET_FLOW_MOD_FAILED, \
+            OFPFMFC_TABLE_FULL)
+        self.switch.errors[1] = error
+        self.scheduler.submit(flowMod(1), 0x10, self.callback(1))
+        self.loop.run()
+        self.switch.confirm()
+        self.assertEqual(self.results, [(1, False, error)])
+
+    def test_close_fails_queued_and_later_mods(self):
+        self.scheduler.submit(flowMod(1), 0x10, self.callback(1))
+        self.scheduler.close()
+        self.scheduler.submit(flowMod(2), 0x10, self.callback(2))
+        self.loop.run()
+        self.assertEqual(self.switch.sent, [])
+        self.assertEqual(self.results, [(1, False, "connection closed"), \
+            (2, False, "connection closed")])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+"""
+Tests of the switch agent's shadow flow table.
+"""
+import os, sys, struct, unittest
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(here, "..", "switchAgent"), \
+    os.path.join(here, "..", "controllerLib")]
+
+from flowShadowTable import FlowShadowTable
+from flowModTemplate import FlowModTemplate, gotoTable, OFPFC_DELETE_STRICT
+from flowModTemplate import OFPFF_SEND_FLOW_REM
+
+udpFields = [('eth_type', 0x0800), ('ip_proto', 17), ('ipv4_src', None), \
+    ('ipv4_dst', None), ('udp_src', None), ('udp_dst', None)]
+udpFlow = FlowModTemplate(udpFields, [gotoTable(1)], priority=10, \
+    idleTimeout=60, flags=OFPFF_SEND_FLOW_REM)
+# the same rule, with the match in the order that OVS sends it back.
+reordered = FlowModTemplate([udpFields[i] for i in (2, 3, 0, 1, 4, 5)], \
+    [gotoTable(1)], priority=10)
+flow = ('10.0.0.1', '10.0.0.2', 5000, 53)
+
+def flowRemoved(flowMod, cookie=0x30, priority=10, tableId=0):
+    """
+    a flow removed message for the rule with flowMod's match.
+    """
+    matchLen = struct.unpack_from("!H", flowMod, 50)[0]
+    match = flowMod[48:48+((matchLen+7)//8)*8]
+    body = struct.pack("!QHBBIIHHQQ", cookie, priority, 0, tableId, 1, 0, \
+        60, 0, 10, 1000) + match
+    return struct.pack("!BBHI", 4, 11, 8+len(body), 0) + body
+
+
+class FlowShadowTableTest(unittest.TestCase):
+    def setUp(self):
+        self.table = FlowShadowTable()
+        self.add = udpFlow.build(0x30, *flow)
+
+    def test_redundant_add_is_dropped(self):
+        self.assertTrue(self.table.install(self.add))
+        self.assertFalse(self.table.install(self.add))
+        self.assertEqual(self.table.suppressed, 1)
+
+    def test_other_cookie_is_not_redundant(self):
+        self.table.install(self.add)
+        self.assertTrue(self.table.install(udpFlow.build(0x31, *flow)))
+
+    def test_flow_removed_with_reordered_match(self):
+        self.table.install(self.add)
+        self.table.flowRemoved(flowRemoved(reordered.build(0x30, *flow)))
+        self.assertEqual(len(self.table), 0)
+        # the rule is gone, so adding it again goes to the switch.
+        self.assertTrue(self.table.install(self.add))
+
+    def test_strict_delete_with_reordered_match(self):
+        self.table.install(self.add)
+        delete = bytearray(reordered.build(0x30, *flow))
+        delete[25] = OFPFC_DELETE_STRICT
+        self.assertTrue(self.table.install(bytes(delete)))
+        self.assertTrue(self.table.install(self.add))
+
+    def test_refused_add_is_forgotten(self):
+        self.table.install(self.add)
+        self.table.refused(self.add)
+        self.assertTrue(self.table.install(self.add))
+
+    def test_rule_with_idle_timeout_and_no_removal_is_not_kept(self):
+        unreported = FlowModTemplate(udpFields, [gotoTable(1)], \
+            priority=10, idleTimeout=60).build(0x30, *flow)
+        self.table.install(unreported)
+        self.assertTrue(self.table.install(unreported))
+
+
+if __name__ == '__main__':
+    unittest.main()
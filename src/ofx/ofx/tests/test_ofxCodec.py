@@ -0,0 +1,68 @@
+"""
+Tests of the OFX message body codec.
+"""
+import os, sys, unittest
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(here, "..", "switchAgent"), \
+    os.path.join(here, "..", "controllerLib")]
+
+from ofxCodec import Schema, OfxCodecError, IPV4, BYTES, STRING
+
+flowSchema = Schema(1, [('src', IPV4), ('dst', IPV4), ('sport', 'H'), \
+    ('dport', 'H'), ('byteCt', 'Q')])
+fileSchema = Schema(2, [('name', STRING), ('size', 'I'), ('data', BYTES)])
+
+
+class SchemaTest(unittest.TestCase):
+
+    def test_fixed_round_trip(self):
+        flow = ('10.0.0.1', '10.0.0.2', 5000, 53, 2**40)
+        data = flowSchema.encode(*flow)
+        self.assertEqual(len(data), 1 + 4 + 4 + 2 + 2 + 8)
+        self.assertEqual(flowSchema.decode(data), flow)
+
+    def test_variable_round_trip(self):
+        data = fileSchema.encode(u'module.py', 5, b'\x00\x01\xff\x02\x03')
+        name, size, content = fileSchema.decode(data)
+        self.assertEqual(name, u'module.py')
+        self.assertEqual(size, 5)
+        self.assertEqual(content, b'\x00\x01\xff\x02\x03')
+
+    def test_decode_from_bytearray(self):
+        data = fileSchema.encode(u'a', 0, b'xyz')
+        self.assertEqual(fileSchema.decode(bytearray(data))[2], b'xyz')
+
+    def test_seq_round_trip(self):
+        flows = [('10.0.0.%s'%i, '10.0.1.1', i, 53, i * 100) \
+            for i in range(1, 5)]
+        self.assertEqual(flowSchema.decodeSeq(flowSchema.encodeSeq(flows)), \
+            flows)
+        counts = Schema(3, [('key', 'I'), ('count', 'Q')])
+        rows = [(1, 10), (2, 20)]
+        self.assertEqual(counts.decodeSeq(counts.encodeSeq(rows)), rows)
+
+    def test_wrong_version(self):
+        data = Schema(9, flowSchemaFields()).encode('10.0.0.1', '10.0.0.2', \
+            1, 2, 3)
+        self.assertRaises(OfxCodecError, flowSchema.decode, data)
+
+    def test_truncated_body(self):
+        data = fileSchema.encode(u'module.py', 5, b'12345')
+        self.assertRaises(OfxCodecError, fileSchema.decode, data[:-1])
+        self.assertRaises(OfxCodecError, flowSchema.decode, b'\x01\x00')
+        seq = flowSchema.encodeSeq([('10.0.0.1', '10.0.0.2', 1, 2, 3)])
+        self.assertRaises(OfxCodecError, flowSchema.decodeSeq, seq[:-1])
+
+    def test_bad_values(self):
+        self.assertRaises(OfxCodecError, flowSchema.encode, '10.0.0.1')
+        self.assertRaises(OfxCodecError, flowSchema.encode, '10.0.0.1', \
+            '10.0.0.2', 70000, 53, 0)
+        self.assertRaises(OfxCodecError, fileSchema.encodeSeq, [])
+
+
+def flowSchemaFields():
+    return list(zip(flowSchema.names, flowSchema.types))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+"""
+Tests of OFX streams, with a sender and a receiver joined by an 
+in-memory link.
+"""
+import os, sys, struct, unittest
+from collections import deque
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(here, "..", "switchAgent"), \
+    os.path.join(here, "..", "controllerLib")]
+
+from ofxStream import StreamSender, StreamReceiver, streamMessageKind
+from ofxStream import fragmentHeader, moduleHeader, OFX_STREAM_MODULE
+from ofxStream import STREAM_FRAGMENT, STREAM_ACK, STREAM_HELLO, STREAM_ZLIB
+
+OFX_MANAGEMENT_MODULE = 0xffffffff
+# the module push message types (see ofxLib.pushModulesToSwitch).
+LOAD_START, LOAD_FILE, LOAD_END = 0x1, 0x2, 0x3
+
+
+class Link(object):
+    """
+    a sender and a receiver. Messages in flight are queued, and 
+    delivered by run(), as a network would, so neither end is 
+    called back from inside the other.
+    """
+    def __init__(self, decompress=True, window=16, size=60000):
+        self.inFlight = deque()
+        self.fragments = []
+        self.delivered = []
+        self.sender = StreamSender(lambda moduleId, content: \
+            self.inFlight.append(('toReceiver', content)), window, size)
+        self.receiver = StreamReceiver(self.deliver, lambda moduleId, content: \
+            self.inFlight.append(('toSender', content)), decompress=decompress)
+
+    def deliver(self, moduleId, data):
+        messageType, dataLen = moduleHeader.unpack_from(bytes(data))
+        self.delivered.append((moduleId, messageType, \
+            bytes(data[moduleHeader.size:moduleHeader.size+dataLen])))
+
+    def run(self):
+        while self.inFlight:
+            direction, content = self.inFlight.popleft()
+            kind = streamMessageKind(content)
+            if direction == 'toSender':
+                self.sender.handleAck(content)
+            elif kind == STREAM_HELLO:
+                self.receiver.handleHello(content)
+            else:
+                self.fragments.append(content)
+                self.receiver.handleFragment(content)
+
+
+def moduleFile(name, size):
+    # module source: compressible text.
+    line = b"    self.ofxAgent.sendToDp(MODULEID, GETFLOWS, '')\n"
+    return name + b"\0" + (line * (size // len(line) + 1))[:size]
+
+
+class StreamTest(unittest.TestCase):
+    def test_small_message(self):
+        link = Link()
+        link.sender.send(0x30, 7, b"hello")
+        link.run()
+        self.assertEqual(link.delivered, [(0x30, 7, b"hello")])
+
+    def test_large_message_in_order(self):
+        link = Link(window=4, size=1000)
+        big = bytes(bytearray(i % 251 for i in range(25000)))
+        link.sender.send(0x30, 1, big)
+        link.sender.send(0x30, 2, b"after")
+        link.run()
+        self.assertEqual(link.delivered, [(0x30, 1, big), (0x30, 2, b"after")])
+        self.assertEqual(link.sender.pending(), 0)
+
+    def test_fresh_module_push_is_compressed(self):
+        link = Link()
+        link.sender.setCompression(OFX_MANAGEMENT_MODULE)
+        # the messages of a push are all queued before any ack.
+        messages = [(LOAD_START, b"ddosdetectorModule"), \
+            (LOAD_FILE, moduleFile(b"ddosdetectorModule.py", 20000)), \
+            (LOAD_FILE, moduleFile(b"ddosdetectorModule.c", 30000)), \
+            (LOAD_FILE, moduleFile(b"uthash.h", 70000)), \
+            (LOAD_END, b"")]
+        for messageType, content in messages:
+            link.sender.send(OFX_MANAGEMENT_MODULE, messageType, content)
+        link.run()
+        self.assertEqual(link.delivered, [(OFX_MANAGEMENT_MODULE, t, c) \
+            for t, c in messages])
+        flags = dict((fragmentHeader.unpack_from(f)[2], \
+            fragmentHeader.unpack_from(f)[1]) for f in link.fragments)
+        # the files go out compressed, the small messages don't.
+        self.assertEqual([flags[streamId] & STREAM_ZLIB for streamId in \
+            range(5)], [0, STREAM_ZLIB, STREAM_ZLIB, STREAM_ZLIB, 0])
+        sentBytes = sum(len(f) for f in link.fragments)
+        self.assertLess(sentBytes, sum(len(c) for t, c in messages) // 10)
+
+    def test_receiver_that_does_not_decompress(self):
+        link = Link(decompress=False)
+        link.sender.setCompression(0x30)
+        content = moduleFile(b"report", 5000)
+        link.sender.send(0x30, 1, content)
+        link.run()
+        self.assertEqual(link.delivered, [(0x30, 1, content)])
+        self.assertFalse(any(fragmentHeader.unpack_from(f)[1] & STREAM_ZLIB \
+            for f in link.fragments))
+
+    def test_small_messages_dont_wait_for_the_hello(self):
+        link = Link()
+        link.sender.setCompression(0x30)
+        link.sender.send(0x30, 1, b"x" * 10)
+        self.assertEqual([streamMessageKind(c) for d, c in link.inFlight], \
+            [STREAM_FRAGMENT])
+
+    def test_compression_context_spans_messages(self):
+        link = Link()
+        link.sender.setCompression(0x30, 1)
+        record = moduleFile(b"flows", 4000)
+        for i in range(3):
+            link.sender.send(0x30, 1, record)
+        link.run()
+        self.assertEqual([c for m, t, c in link.delivered], [record] * 3)
+        sizes = [len(f) for f in link.fragments]
+        # later copies compress against the first.
+        self.assertLess(sizes[2], sizes[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+"""
+Tests of the switch agent's flow table occupancy tracking.
+"""
+import os, sys, struct, unittest
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(here, "..", "switchAgent"), \
+    os.path.join(here, "..", "controllerLib")]
+
+from ruleOccupancy import RuleOccupancy, flowModRule, flowRemovedRule
+from ruleOccupancy import matchKey, ruleFields, strictDelete, flowModRuleKey
+from ofFlowStats import FlowStatsTable
+from flowModTemplate import FlowModTemplate, gotoTable, OFPFF_SEND_FLOW_REM
+from flowModTemplate import OFPFC_DELETE_STRICT
+
+udpFields = [('eth_type', 0x0800), ('ip_proto', 17), ('ipv4_src', None), \
+    ('ipv4_dst', None), ('udp_src', None), ('udp_dst', None)]
+udpFlow = FlowModTemplate(udpFields, [gotoTable(1)], priority=10, \
+    idleTimeout=60, flags=OFPFF_SEND_FLOW_REM)
+reordered = FlowModTemplate([udpFields[i] for i in (5, 4, 3, 2, 1, 0)], \
+    [gotoTable(1)], priority=10)
+
+def add(port, cookie=0x30):
+    return udpFlow.build(cookie, '10.0.0.1', '10.0.0.2', 5000, port)
+
+def key(port):
+    return flowModRule(add(port))
+
+def statsTable(*flowMods):
+    """
+    a FlowStatsTable with a row for the rule of each flow mod.
+    """
+    table = FlowStatsTable()
+    for data in flowMods:
+        matchLen = struct.unpack_from("!H", data, 50)[0]
+        table.tableId.append(struct.unpack_from("!B", data, 24)[0])
+        table.priority.append(struct.unpack_from("!H", data, 30)[0])
+        table.matches.append(data[48:48+matchLen])
+    return table
+
+
+class RuleKeyTest(unittest.TestCase):
+
+    def test_only_reported_adds_are_tracked(self):
+        self.assertIsNotNone(flowModRule(add(53)))
+        unreported = FlowModTemplate(udpFields, [gotoTable(1)], \
+            priority=10).build(0x30, '10.0.0.1', '10.0.0.2', 5000, 53)
+        self.assertIsNone(flowModRule(unreported))
+        self.assertIsNone(flowModRule(strictDelete(add(53))))
+
+    def test_field_order_does_not_matter(self):
+        other = reordered.build(0x30, 53, 5000, '10.0.0.2', '10.0.0.1')
+        self.assertEqual(flowModRuleKey(other), key(53))
+        self.assertNotEqual(key(53), key(54))
+
+    def test_flow_removed(self):
+        data = add(53)
+        matchLen = struct.unpack_from("!H", data, 50)[0]
+        match = data[48:48+((matchLen+7)//8)*8]
+        body = struct.pack("!QHBBIIHHQQ", 0x30, 10, 0, 0, 1, 0, 60, 0, \
+            7, 700) + match
+        removed = struct.pack("!BBHI", 4, 11, 8+len(body), 0) + body
+        self.assertEqual(flowRemovedRule(removed), (key(53), 0x30, 7, 700))
+
+    def test_masks(self):
+        """
+        an all ones mask is no mask, and an all zeros mask no field.
+        """
+        def match(*fields):
+            body = b''.join(struct.pack("!HBB", 0x8000, field, len(value)) \
+                + value for field, value in fields)
+            return struct.pack("!HH", 1, 4 + len(body)) + body
+        # ipv4_src (11), with and without its mask bit.
+        exact = match((11 << 1, b'\x0a\x00\x00\x01'))
+        ones = match(((11 << 1) | 1, b'\x0a\x00\x00\x01\xff\xff\xff\xff'))
+        zeros = match(((11 << 1) | 1, b'\x0a\x00\x00\x01\x00\x00\x00\x00'))
+        self.assertEqual(matchKey(ones, 0), matchKey(exact, 0))
+        self.assertEqual(matchKey(zeros, 0), ())
+
+    def test_rule_fields(self):
+        fields = ruleFields(key(53))
+        self.assertEqual(fields['ipProto'], 17)
+        self.assertEqual(fields['tpDst'], 53)
+        self.assertEqual(fields['inPort'], 0)
+
+
+class RuleOccupancyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.occupancy = RuleOccupancy(3)
+        for port in (1, 2, 3):
+            self.assertEqual(self.occupancy.admit(key(port), 0x30, \
+                add(port)), [])
+
+    def test_least_recently_used_is_evicted(self):
+        self.occupancy.used(key(1))
+        victims = self.occupancy.admit(key(4), 0x30, add(4))
+        self.assertEqual([rule.key for rule in victims], [key(2)])
+        self.assertEqual(len(self.occupancy), 3)
+        self.assertEqual(self.occupancy.evicted, 1)
+
+    def test_touched_rules_are_used(self):
+        self.occupancy.touch(statsTable(reordered.build(0x30, 1, 5000, \
+            '10.0.0.2', '10.0.0.1'), add(2)))
+        victims = self.occupancy.admit(key(4), 0x30, add(4))
+        self.assertEqual([rule.key for rule in victims], [key(3)])
+
+    def test_table_budget(self):
+        self.occupancy.setBudget(0, 1)
+        victims = self.occupancy.admit(key(4), 0x30, add(4))
+        self.assertEqual([rule.key for rule in victims], \
+            [key(1), key(2), key(3)])
+
+    def test_removed(self):
+        rule = self.occupancy.removed(key(2))
+        self.assertEqual((rule.key, rule.moduleId), (key(2), 0x30))
+        self.assertIsNone(self.occupancy.removed(key(2)))
+        self.assertEqual(len(self.occupancy), 2)
+
+    def test_evicted_rule_added_again(self):
+        """
+        the removal of an evicted rule that was added again before
+        the switch reported it is the evicted rule's.
+        """
+        self.occupancy.setBudget(0, 2)
+        victims = self.occupancy.admit(key(4), 0x30, add(4))
+        self.assertEqual([rule.key for rule in victims], [key(1), key(2)])
+        self.occupancy.admit(key(1), 0x31, add(1, 0x31))
+        self.assertEqual(self.occupancy.removed(key(1)).moduleId, 0x30)
+        self.assertEqual(self.occupancy.removed(key(1)).moduleId, 0x31)
+
+
+if __name__ == '__main__':
+    unittest.main()